@@ -0,0 +1,344 @@
+"""
+This script measures the statistics kernels (`h`, `g0`, `g`, `calc_prob_between`, `make_ab_analysis`,
+`calc_uplift`, `make_best_analysis` and `make_best_analysis_many`) on a grid of impressions (from 10 to 10^8) and
+conversion rates (from 0.01% to 50%), where the test group has about one standard deviation more conversions than
+the control one (so that the probabilities are neither 0 nor 1, where any kernel would be accurate).
+`make_best_analysis` compares the two groups, so its reference is the one of the A/B probability, while
+`make_best_analysis_many` analyzes at once `BEST_ROWS` cohorts with three groups (the third one has another
+standard deviation more conversions), and it has no reference. For each kernel and case it records:
+
+* the latency of a call (the best of a few repetitions, with the caches of the results disabled);
+* the memory allocated by a call (the peak traced by `tracemalloc`, so only what Python allocates);
+* the error against a reference evaluated with 30 digits by `mpmath` (absolute for the probabilities,
+  relative for the other values, unless the reference is below the range of the floats); the probabilities have
+  a reference only when the exact sum has at most `--max-reference` terms, and without `mpmath` the accuracy
+  is not checked.
+
+The results are compared with a baseline (by default `benchmarks/baselines/kernels.json`), and the script fails
+if a kernel became slower, allocates more or is less accurate than the baseline allows:
+
+    python benchmarks/bench_kernels.py [--quick] [--latency-tolerance 0.25] [--error-factor 2]
+
+and with `--save` the results become the new baseline. The latencies depend on the machine, so the baseline
+should be saved on the same machine where the gate runs (its description is stored with it).
+"""
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mixbaba import beta_utils, mixbaba_utils  # noqa: E402
+from mixbaba.beta_utils import BetaPosterior, h, g0, g, calc_prob_between  # noqa: E402
+from mixbaba.mixbaba_utils import make_ab_analysis, make_best_analysis, make_best_analysis_many, \
+    calc_uplift  # noqa: E402
+
+try:
+    import mpmath
+except ImportError:
+    mpmath = None
+
+IMPRESSIONS = [10, 100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8]
+RATES = [1e-4, 1e-3, 1e-2, 0.1, 0.5]
+QUICK_IMPRESSIONS = [100, 10 ** 4, 10 ** 6]
+QUICK_RATES = [1e-3, 0.1]
+# the cohorts analyzed at once by `make_best_analysis_many`
+BEST_ROWS = 100
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'kernels.json')
+
+
+def make_case(imps: int, rate: float) -> dict:
+    """
+    This function create a case of the grid
+
+    :param imps: the impressions of each group
+    :param rate: the conversion rate of the control group
+    :return: a dict with the counts and the parameters of the posteriors (a, b for control, c, d for test)
+    """
+    convs_1 = int(round(imps * rate))
+    convs_2 = min(convs_1 + max(int(round(convs_1 ** 0.5)), 1), imps)
+    convs_3 = min(convs_2 + max(int(round(convs_1 ** 0.5)), 1), imps)
+    return {'name': f'{imps:.0e}|{rate:g}', 'imps_1': imps, 'convs_1': convs_1, 'imps_2': imps, 'convs_2': convs_2,
+            'a': convs_1 + 1., 'b': imps - convs_1 + 1., 'c': convs_2 + 1., 'd': imps - convs_2 + 1.,
+            'best_imps': [[imps] * 3] * BEST_ROWS, 'best_convs': [[convs_1, convs_2, convs_3]] * BEST_ROWS}
+
+
+def mp_gsum(a, b, c, d):
+    """
+    This function evaluate the sum of `mixbaba.beta_utils.gsum` with `mpmath`, each term from the previous one
+
+    :return: the sum, as `mpmath.mpf`
+    """
+    a, b, c = mpmath.mpf(a), mpmath.mpf(b), mpmath.mpf(c)
+    lg = mpmath.loggamma
+    total = mpmath.exp(lg(a + b) + lg(a + c) - lg(a + b + c) - lg(a))
+    if d > 1:
+        term = mpmath.exp(lg(a + c) + lg(a + b) - lg(a) - lg(b) - lg(c) + lg(b + 1) + lg(c + 1) - lg(a + b + c + 1))
+        total += term
+        for i in range(1, int(d) - 1):
+            term *= (b + i) * (c + i) / ((i + 1) * (a + b + c + i))
+            total += term
+    return total
+
+
+def mp_g(a, b, c, d, max_terms: float):
+    """
+    This function evaluate the probability for Beta(a, b) to be greater than Beta(c, d) with `mpmath`,
+    with the same symmetries of `mixbaba.beta_utils.g`
+
+    :param max_terms: the maximum number of terms of the sum
+    :return: the probability, as `mpmath.mpf`, or None if the sum would be too long
+    """
+    params = [a, b, c, d]
+    which = min(range(4), key=lambda i: params[i])
+    if params[which] > max_terms:
+        return None
+    if which == 0:
+        return mp_gsum(d, c, b, a)
+    elif which == 1:
+        return 1 - mp_gsum(c, d, a, b)
+    elif which == 2:
+        return 1 - mp_gsum(b, a, d, c)
+    return mp_gsum(a, b, c, d)
+
+
+def references(case: dict, max_terms: float) -> dict:
+    """
+    This function evaluate the references of the kernels for a case
+
+    :param case: the case
+    :param max_terms: the maximum number of terms of the exact sum of the probability
+    :return: a dict with the kernels as keys, and the references (or None) as values
+    """
+    if mpmath is None:
+        return {}
+    a, b, c, d = case['a'], case['b'], case['c'], case['d']
+    lg = mpmath.loggamma
+    prob = mp_g(c, d, a, b, max_terms)
+    return {'h': mpmath.exp(lg(a + c) + lg(b + d) + lg(a + b) + lg(c + d) -
+                            (lg(a) + lg(b) + lg(c) + lg(d) + lg(a + b + c + d))),
+            'g0': mpmath.exp(lg(a + b) + lg(a + c) - (lg(a + b + c) + lg(a))),
+            'g': prob, 'calc_prob_between': prob, 'make_ab_analysis': prob, 'make_best_analysis': prob,
+            'calc_uplift': (mpmath.mpf(c) / (c + d) - mpmath.mpf(a) / (a + b)) / (mpmath.mpf(a) / (a + b))}
+
+
+def kernels(max_exact: float) -> OrderedDict:
+    """
+    This function return the kernels, each as a function of a case returning the value to be checked
+    (or None when the kernel would take too long), and whether its error is relative
+
+    :param max_exact: the largest parameter for which the exact `g` is measured
+    """
+    def run_g(case):
+        if min(case['a'], case['b'], case['c'], case['d']) > max_exact:
+            return None
+        return g(case['c'], case['d'], case['a'], case['b'])
+
+    return OrderedDict([
+        ('h', (lambda case: h(case['a'], case['b'], case['c'], case['d']), True)),
+        ('g0', (lambda case: g0(case['a'], case['b'], case['c']), True)),
+        ('g', (run_g, False)),
+        ('calc_prob_between', (lambda case: calc_prob_between(BetaPosterior(case['c'], case['d']),
+                                                              BetaPosterior(case['a'], case['b'])), False)),
+        ('make_ab_analysis', (lambda case: make_ab_analysis(case['imps_1'], case['convs_1'], case['imps_2'],
+                                                            case['convs_2'])[1], False)),
+        ('calc_uplift', (lambda case: calc_uplift(BetaPosterior(case['a'], case['b']),
+                                                  BetaPosterior(case['c'], case['d'])), True)),
+        ('make_best_analysis', (lambda case: make_best_analysis([case['imps_1'], case['imps_2']],
+                                                                [case['convs_1'], case['convs_2']])[1], False)),
+        ('make_best_analysis_many', (lambda case: make_best_analysis_many(case['best_imps'],
+                                                                          case['best_convs'])[0, 1], False))])
+
+
+def measure_latency(function, min_time: float = 0.005, repeat: int = 3) -> float:
+    """
+    This function measure the time of a call, calling it as many times as needed to last at least `min_time`
+
+    :param function: the function, without arguments
+    :param min_time: the minimum duration of a measurement, in seconds
+    :param repeat: how many measurements are made (the best one is kept)
+    :return: the time of a call, in seconds
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def measure_allocations(function) -> int:
+    """
+    This function measure the peak of the memory allocated by Python during a call
+
+    :param function: the function, without arguments
+    :return: the bytes
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(impressions: list, rates: list, max_exact: float, max_reference: float) -> OrderedDict:
+    """
+    This function measure all the kernels on the grid
+
+    :return: an OrderedDict with the keys "kernel|impressions|rate", and dicts with latency (s), allocations
+        (bytes) and error (None if there is no reference) as values
+    """
+    # the caches would measure the lookups instead of the kernels
+    caches = [beta_utils.prob_cache, mixbaba_utils.analysis_cache]
+    sizes = [cache.maxsize for cache in caches]
+    for cache in caches:
+        cache.clear()
+        cache.maxsize = 0
+
+    results = OrderedDict()
+    try:
+        for imps in impressions:
+            for rate in rates:
+                case = make_case(imps, rate)
+                refs = references(case, max_reference)
+                for name, (kernel, relative) in kernels(max_exact).items():
+                    value = kernel(case)
+                    if value is None:
+                        continue
+                    ref = refs.get(name)
+                    error = None
+                    if ref is not None:
+                        error = abs(value - ref)
+                        if relative and abs(ref) >= sys.float_info.min:
+                            error /= abs(ref)
+                        error = float(error)
+                    results[f"{name}|{case['name']}"] = {
+                        'latency': measure_latency(lambda: kernel(case)),
+                        'allocations': measure_allocations(lambda: kernel(case)),
+                        'error': error}
+    finally:
+        for cache, size in zip(caches, sizes):
+            cache.maxsize = size
+    return results
+
+
+def compare(results: dict, baseline: dict, latency_tolerance: float = 0.25, case_tolerance: float = 1.,
+            latency_floor: float = 1e-6, allocation_tolerance: float = 0.5, allocation_floor: int = 1024,
+            error_factor: float = 2., error_floor: float = 1e-13) -> list:
+    """
+    This function compare the results with the baseline. The single latencies are noisy, so a kernel regresses if
+    it is slower than the baseline by more than `latency_tolerance` (a fraction) on the whole grid (as geometric mean
+    of the ratios), and a case regresses if:
+
+    * its latency is above the baseline by more than `case_tolerance` (a fraction) and `latency_floor` (seconds);
+    * its allocations are above the baseline by more than `allocation_tolerance` and `allocation_floor` (bytes);
+    * its error is above `error_factor` times the baseline plus `error_floor`.
+
+    :param results: the results (see `run`)
+    :param baseline: the results of the baseline
+    :return: the list of the regressions, as texts
+    """
+    regressions = []
+    log_ratios = OrderedDict()
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        log_ratios.setdefault(key.split('|')[0], []).append(math.log(result['latency'] / base['latency']))
+        if result['latency'] > base['latency'] * (1. + case_tolerance) and \
+                result['latency'] - base['latency'] > latency_floor:
+            regressions.append(f"{key}: latency {result['latency'] * 1e6:.2f} us "
+                               f"(baseline {base['latency'] * 1e6:.2f} us)")
+        if result['allocations'] > base['allocations'] * (1. + allocation_tolerance) + allocation_floor:
+            regressions.append(f"{key}: allocations {result['allocations']} B (baseline {base['allocations']} B)")
+        if base['error'] is not None and result['error'] is not None and \
+                result['error'] > base['error'] * error_factor + error_floor:
+            regressions.append(f"{key}: error {result['error']:.3g} (baseline {base['error']:.3g})")
+
+    for kernel, ratios in log_ratios.items():
+        ratio = math.exp(sum(ratios) / len(ratios))
+        if ratio > 1. + latency_tolerance:
+            regressions.append(f"{kernel}: {ratio:.2f} times slower than the baseline on the grid")
+    return regressions
+
+
+def machine() -> dict:
+    import numba
+    import numpy
+
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': numpy.__version__, 'numba': numba.__version__}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--quick", action='store_true', help="Measure only a small part of the grid")
+    parser.add_argument("--baseline", default=BASELINE, help="The file of the baseline")
+    parser.add_argument("--save", action='store_true', help="Save the results as the new baseline")
+    parser.add_argument("--max-exact", type=float, default=1e6,
+                        help="The largest parameter for which the exact `g` is measured")
+    parser.add_argument("--max-reference", type=float, default=2e5,
+                        help="The maximum number of terms of the reference of the probabilities")
+    parser.add_argument("--latency-tolerance", type=float, default=0.25,
+                        help="How much slower (as a fraction) a kernel can be than the baseline, on the whole grid")
+    parser.add_argument("--case-tolerance", type=float, default=1.,
+                        help="How much slower (as a fraction) a single case can be than the baseline")
+    parser.add_argument("--allocation-tolerance", type=float, default=0.5,
+                        help="How much more memory (as a fraction) a kernel can allocate than the baseline")
+    parser.add_argument("--error-factor", type=float, default=2.,
+                        help="How many times the error of the baseline the error can be")
+    args = parser.parse_args()
+
+    if mpmath is None:
+        print("mpmath is not installed: the accuracy is not checked")
+    impressions, rates = (QUICK_IMPRESSIONS, QUICK_RATES) if args.quick else (IMPRESSIONS, RATES)
+    # the first calls compile, or load, the kernels
+    run(impressions[:1], rates[:1], args.max_exact, 0)
+    results = run(impressions, rates, args.max_exact, args.max_reference)
+
+    print(f"{'kernel|impressions|rate':40s} {'latency (us)':>14s} {'allocated (B)':>14s} {'error':>10s}")
+    for key, result in results.items():
+        error = f"{result['error']:.2e}" if result['error'] is not None else '-'
+        print(f"{key:40s} {result['latency'] * 1e6:14.2f} {result['allocations']:14d} {error:>10s}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as file:
+            json.dump({'machine': machine(), 'results': results}, file, indent=1)
+        print(f"baseline saved in {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"there is no baseline in {args.baseline}: run with --save to create it")
+        sys.exit(1)
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline.get('machine') != machine():
+        print("note: the baseline was saved on a different machine, the latencies may not be comparable")
+    regressions = compare(results, baseline['results'], latency_tolerance=args.latency_tolerance,
+                          case_tolerance=args.case_tolerance,
+                          allocation_tolerance=args.allocation_tolerance, error_factor=args.error_factor)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(results)} measurements, {len(regressions)} regressions")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
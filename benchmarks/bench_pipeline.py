@@ -0,0 +1,121 @@
+"""
+This script measures the whole command line tool, end to end, against the local stand-in of Mixpanel
+(see `fake_mixpanel.py`): for each number of funnels, it writes a funnels file with the given discriminants
+and cohorts, runs `bin/mixbaba` on it and reports the wall time, the requests per second, the peak memory (RSS)
+and the time of each stage of the run.
+
+Usage:
+
+    python benchmarks/bench_pipeline.py [--funnels 1 10 100] [--discriminants 2] [--cohorts 10] [-x] [-c]
+        [--latency 0.05] [--jobs 8] [--json results.json]
+
+The other options (e.g. `-c`) are given to the tool as they are. The requests are not limited by the rate governor.
+"""
+from argparse import ArgumentParser
+import ast
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_mixpanel import FakeMixpanel, IMPRESSION_STEP, CONVERSION_STEP
+
+STAGES_LINE = "time of the stages (s): "
+
+
+def write_funnels(path: str, n_funnels: int, n_discriminants: int, n_cohorts: int, days: int):
+    """
+    This function write a funnels file for the fake server
+
+    :param path: the file
+    :param n_funnels: the number of the funnels
+    :param n_discriminants: the number of the discriminants of each funnel
+    :param n_cohorts: the number of the cohorts of each discriminant
+    :param days: the length of the period of the funnels
+    """
+    filters = {f'user.d{i}': [f'c{j}' for j in range(n_cohorts)] for i in range(n_discriminants)}
+    to_date = f'2019-{1 + (days - 1) // 28:02d}-{1 + (days - 1) % 28:02d}' if days <= 12 * 28 else '2019-12-28'
+    funnels = [{'ID': i, 'From Date': '2019-01-01', 'To Date': to_date,
+                'Impression field name': IMPRESSION_STEP, 'Conversion field name': CONVERSION_STEP,
+                'By': 'properties.assignment', 'AB Groups': {'Control': 'control', 'Test': 'test'},
+                'filters': filters}
+               for i in range(1, n_funnels + 1)]
+    with open(path, 'w') as file:
+        json.dump(funnels, file)
+
+
+def run_tool(root: str, folder: str, endpoint: str, jobs: int, extra: list) -> (float, float, dict):
+    """
+    This function run the command line tool and measure it
+
+    :param root: the folder of the repository
+    :param folder: the folder with the funnels file, where the tool is run
+    :param endpoint: the address of the fake server
+    :param jobs: the number of the requests at the same time
+    :param extra: other options for the tool
+    :return: a tuple with the wall time (in seconds), the peak RSS (in MB) and the time of the stages
+    """
+    command = [sys.executable, os.path.join(root, 'bin', 'mixbaba'), '-f', 'funnels.json', '-k', 'any',
+               '--endpoint', endpoint, '-rl', '1e9', '-mc', str(max(jobs, 1)), '-j', str(jobs), '-v'] + extra
+    env = dict(os.environ, PYTHONPATH=root)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out = process.stdout.read().decode()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
+        raise RuntimeError(f"the tool failed:\n{out[-2000:]}")
+
+    stages = {}
+    for line in out.splitlines():
+        if line.startswith(STAGES_LINE):
+            stages = ast.literal_eval(line[len(STAGES_LINE):])
+    # on Linux the peak RSS is in KB
+    return wall, usage.ru_maxrss / 1024., stages
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--funnels", type=int, nargs='+', default=[1, 10, 100],
+                        help="The numbers of the funnels of the runs")
+    parser.add_argument("--discriminants", type=int, default=2, help="The number of the discriminants of a funnel")
+    parser.add_argument("--cohorts", type=int, default=10, help="The number of the cohorts of a discriminant")
+    parser.add_argument("--days", type=int, default=28, help="The length of the period of the funnels")
+    parser.add_argument("--latency", type=float, default=0.05, help="The time taken by each response, in seconds")
+    parser.add_argument("--jobs", type=int, default=8, help="How many requests are made at the same time")
+    parser.add_argument("--json", default=None, help="A file where the results are saved")
+    args, extra = parser.parse_known_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for n_funnels in args.funnels:
+        server = FakeMixpanel(n_funnels=n_funnels, n_cohorts=args.cohorts, latency=args.latency)
+        server.start()
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                write_funnels(os.path.join(folder, 'funnels.json'), n_funnels, args.discriminants, args.cohorts,
+                              args.days)
+                wall, peak_rss, stages = run_tool(root, folder, server.endpoint, args.jobs, extra)
+        finally:
+            server.stop()
+
+        result = {'funnels': n_funnels, 'cohorts': args.discriminants * args.cohorts, 'requests': server.n_requests,
+                  'bytes': server.bytes_sent, 'wall': wall, 'requests_per_second': server.n_requests / wall,
+                  'peak_rss_mb': peak_rss, 'stages': stages,
+                  'startup_and_rest': wall - sum(stages.values())}
+        results.append(result)
+        print(f"{n_funnels} funnels x {result['cohorts']} cohorts: {wall:.2f} s, {server.n_requests} requests "
+              f"({result['requests_per_second']:.1f}/s), peak RSS {peak_rss:.0f} MB")
+        print("    " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in stages.items()) +
+              f", startup and the rest {result['startup_and_rest']:.2f} s")
+
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump({'options': vars(args), 'extra': extra, 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
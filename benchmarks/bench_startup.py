@@ -0,0 +1,81 @@
+"""
+This script measures the cold start of MixBABA: the time needed, in a fresh interpreter, to import the modules used
+by the command line tool and to run the first analysis (i.e. including the loading of the compiled kernels).
+
+Usage:
+
+    python benchmarks/bench_startup.py [-n 10] [--max-seconds 1.5]
+
+With `--max-seconds` the script exits with an error if the median time is above the given value.
+"""
+from argparse import ArgumentParser
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SNIPPET = """
+from mixbaba.mixbaba_utils import MixpanelAPI, get_funnels_list, analyze_funnel, make_ab_analysis
+from mixbaba.output_utils import return_output
+from mixbaba.inputs import parse_args
+make_ab_analysis(10000, 100, 10000, 120)
+"""
+
+HEAVY_MODULES = ['matplotlib', 'pandas', 'tabulate']
+
+
+def run_once(root: str) -> float:
+    """
+    This function run the snippet in a new interpreter and return the elapsed time
+
+    :param root: the folder of the repository
+    :return: the time in seconds
+    """
+    env = dict(os.environ, PYTHONPATH=root)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', SNIPPET], env=env, check=True)
+    return time.perf_counter() - start
+
+
+def heavy_imported(root: str) -> list:
+    """
+    This function return the heavy modules which are (wrongly) loaded by the command line tool at startup
+
+    :param root: the folder of the repository
+    :return: a list with the names of the modules
+    """
+    env = dict(os.environ, PYTHONPATH=root)
+    check = SNIPPET + f"import sys\nprint(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    out = subprocess.run([sys.executable, '-c', check], env=env, check=True, stdout=subprocess.PIPE)
+    return out.stdout.decode().split()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=10, help="How many times the cold start is measured")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Fail if the median time is above this value")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    # the first run fills the cache of the compiled kernels
+    run_once(root)
+    times = [run_once(root) for _ in range(args.repeat)]
+    median = statistics.median(times)
+    print(f"cold start: median {median * 1e3:.0f} ms, min {min(times) * 1e3:.0f} ms, max {max(times) * 1e3:.0f} ms")
+
+    failed = False
+    heavy = heavy_imported(root)
+    if heavy:
+        print(f"heavy modules loaded at startup: {', '.join(heavy)}")
+        failed = True
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f"the median cold start is above {args.max_seconds} s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
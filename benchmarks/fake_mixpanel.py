@@ -0,0 +1,237 @@
+"""
+A local stand-in for the Mixpanel query API, to run the whole command line tool without credentials (see
+`bench_pipeline.py`). It answers `funnels/list` and `funnels` with synthetic data, which depend only on the funnel,
+the days of the bucket, the group and the cohorts of the query: the same cohort has the same counts whether it is
+asked alone (with `where`) or in a segmented query (with `on`), so the results of the consolidated mode can be
+compared. The users are counted once in each bucket, as Mixpanel does (see `FakeMixpanel.counts`), so the counts of a
+month are consistent with, and fewer than the sum of, those of its days.
+
+Usage:
+
+    python benchmarks/fake_mixpanel.py [--port 8080] [--funnels 10] [--cohorts 4] [--latency 0.05]
+
+and then
+
+    mixbaba -f [funnel_file.json] -k any --endpoint http://127.0.0.1:8080/api -rl 1000000 -mc 100
+
+The funnels have the steps `Impression` and `Payment`, the groups are `control` and `test` (and `test2`, ... with
+`--tests`), and the cohorts of every property are `c0`, `c1`, ...
+"""
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import datetime
+import gzip
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mixbaba.export_utils import date_bucket, parse_expressions  # noqa: E402
+
+IMPRESSION_STEP = 'Impression'
+CONVERSION_STEP = 'Payment'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        splitted = urllib.parse.urlsplit(self.path)
+        method = splitted.path.strip('/').split('/', 2)[-1]
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(splitted.query).items()}
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        try:
+            if method == 'funnels/list':
+                answer = self.server.funnels_list()
+            elif method == 'funnels':
+                answer = self.server.funnel(params)
+            else:
+                self.reply(404, b'{"error": "unknown method"}')
+                return
+        except (KeyError, ValueError) as e:
+            self.reply(400, json.dumps({'error': str(e)}).encode())
+            return
+        self.reply(200, json.dumps(answer).encode())
+
+    def reply(self, status: int, body: bytes):
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body, compresslevel=1)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.n_requests += 1
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeMixpanel(ThreadingHTTPServer):
+    """
+    The fake server; `start` serves the requests in a thread, and `endpoint` is the address to give to the tool
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple = ('127.0.0.1', 0), n_funnels: int = 10, n_cohorts: int = 4,
+                 n_tests: int = 1, latency: float = 0., seed: int = 0, max_segments: int = None):
+        """
+        :param address: the host and the port (0 for any free port)
+        :param n_funnels: the number of the funnels in the list (any funnel can be asked, anyway)
+        :param n_cohorts: the number of the cohorts of each property
+        :param n_tests: the number of the test groups
+        :param latency: the time, in seconds, taken by each response
+        :param seed: the seed of the synthetic data
+        :param max_segments: optional, the most values of a segmentation returned whatever the `limit` of the query
+            (those with the most impressions), to mimic the segments which Mixpanel leaves out
+        """
+        super().__init__(address, Handler)
+        self.max_segments = max_segments
+        self.n_funnels = n_funnels
+        self.cohorts = [f'c{i}' for i in range(n_cohorts)]
+        self.groups = ['control', 'test'] + [f'test{i}' for i in range(2, n_tests + 1)]
+        self.latency = latency
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.bytes_sent = 0
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api'
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def funnels_list(self) -> list:
+        return [{'funnel_id': i, 'name': f'Funnel {i}'} for i in range(1, self.n_funnels + 1)]
+
+    def counts(self, funnel_id, days: list, group: str, cohorts: tuple) -> (int, int):
+        """
+        This function return the synthetic impressions and conversions of a group in a cohort over some days.
+        As in Mixpanel, they are the users counted once in the days: each cohort has a population of users, which
+        are active on a day with a probability of that day, so the counts of a month are fewer than the sum of the
+        counts of its days.
+
+        :param funnel_id: the funnel
+        :param days: the days of the counts (the days of a bucket within the range of the query)
+        :param group: the group
+        :param cohorts: the couples (property, cohort) of the cohort, sorted
+        :return: a tuple (impressions, conversions)
+        """
+        key = json.dumps([self.seed, funnel_id, group, cohorts])
+        rand = random.Random(zlib.crc32(key.encode()))
+        population = rand.randint(2000, 20000) // (1 + len(cohorts))
+        rate = 0.05 + (0.005 if group != 'control' else 0.) + rand.uniform(-0.01, 0.01)
+        inactive = 1.
+        for day in days:
+            inactive *= 1. - random.Random(zlib.crc32(f'{key}{day}'.encode())).uniform(0.01, 0.1)
+        impressions = int(population * (1. - inactive))
+        return impressions, int(impressions * rate)
+
+    def funnel(self, params: dict) -> dict:
+        """
+        This function answer a funnel query
+
+        :param params: the parameters of the query
+        :return: the response, in the format of Mixpanel
+        """
+        on_props, separator, ins, _ = parse_expressions(params['on'], params.get('where'))
+        unit = params.get('unit', 'day')
+        day = datetime.date.fromisoformat(params['from_date'])
+        to_date = datetime.date.fromisoformat(params['to_date'])
+        # the days of each bucket
+        buckets = {}
+        while day <= to_date:
+            buckets.setdefault(date_bucket(day, unit), []).append(day.isoformat())
+            day += datetime.timedelta(days=1)
+
+        # the conditions on the properties of the segments restrict their values, the others fix a cohort
+        fixed, allowed = [], {}
+        for alternatives in ins:
+            prop = alternatives[0][1:]
+            if prop in on_props[1:]:
+                allowed[prop] = {cohort for cohort, _, _ in alternatives}
+            elif len(alternatives) == 1:
+                fixed.append((f'{prop[0]}.{prop[1]}', alternatives[0][0]))
+            else:
+                raise ValueError(f"unsupported filter: {params.get('where')}")
+        segments = list(itertools.product(*[[cohort for cohort in self.cohorts
+                                              if prop not in allowed or cohort in allowed[prop]]
+                                             for prop in on_props[1:]]))
+
+        data = {}
+        impressions_of = {}
+        for date, days in buckets.items():
+            data[date] = groups = {}
+            overall = [0, 0]
+            for group in self.groups:
+                for segment in segments:
+                    cohorts = tuple(sorted(set(fixed + [(f'{discr_type}.{name}', cohort) for (discr_type, name), cohort
+                                                        in zip(on_props[1:], segment)])))
+                    impressions, conversions = self.counts(params['funnel_id'], days, group, cohorts)
+                    overall[0] += impressions
+                    overall[1] += conversions
+                    value = separator.join((group,) + segment)
+                    impressions_of[value] = impressions_of.get(value, 0) + impressions
+                    groups[value] = [
+                        {'count': impressions, 'step_label': IMPRESSION_STEP, 'goal': IMPRESSION_STEP},
+                        {'count': conversions, 'step_label': CONVERSION_STEP, 'goal': CONVERSION_STEP}]
+            groups['$overall'] = [{'count': overall[0], 'step_label': IMPRESSION_STEP, 'goal': IMPRESSION_STEP},
+                                  {'count': overall[1], 'step_label': CONVERSION_STEP, 'goal': CONVERSION_STEP}]
+
+        # as Mixpanel, only the top values of the segmentation (255 by default)
+        limit = int(params.get('limit', 255))
+        if self.max_segments is not None:
+            limit = min(limit, self.max_segments)
+        if len(impressions_of) > limit:
+            kept = set(sorted(impressions_of, key=lambda value_: -impressions_of[value_])[:limit])
+            for groups in data.values():
+                for value in list(groups):
+                    if value != '$overall' and value not in kept:
+                        del groups[value]
+        return {'meta': {'dates': list(buckets)}, 'data': data}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--funnels", type=int, default=10, help="The number of the funnels in the list")
+    parser.add_argument("--cohorts", type=int, default=4, help="The number of the cohorts of each property")
+    parser.add_argument("--tests", type=int, default=1, help="The number of the test groups")
+    parser.add_argument("--latency", type=float, default=0., help="The time taken by each response, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeMixpanel((args.host, args.port), n_funnels=args.funnels, n_cohorts=args.cohorts,
+                          n_tests=args.tests, latency=args.latency, seed=args.seed)
+    print(f"serving on {server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
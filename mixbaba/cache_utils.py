@@ -0,0 +1,357 @@
+from collections import OrderedDict
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class LRUCache(object):
+    """
+    A bounded cache which forgets the least recently used entries, and keeps track of hits and misses.
+    Keys are tuples of numbers and strings, values are tuples of numbers, so that the cache can be saved on disk
+    as JSON and loaded back in a following run. It can be shared among threads.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple):
+        """
+        This function return the value associated to the key, or None if the key is not in the cache
+
+        :param key: the key
+        :return: the value, or None
+        """
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value: tuple):
+        """
+        This function insert a value in the cache, eventually forgetting the oldest one
+
+        :param key: the key
+        :param value: the value
+        """
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self) -> dict:
+        """
+        This function return the statistics of the usage of the cache
+
+        :return: a dict with hits, misses, actual and maximum size
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
+
+    def dump(self) -> list:
+        """
+        This function return the content of the cache as a list of [key, value] couples, ready to become JSON
+
+        :return: the list, from the oldest entry to the most recent one
+        """
+        with self.lock:
+            return [[list(key), list(value)] for key, value in self.data.items()]
+
+    def update(self, dumped: list):
+        """
+        This function insert in the cache the entries of a list created by `dump`
+
+        :param dumped: the list
+        """
+        for key, value in dumped:
+            self.put(tuple(key), tuple(value))
+
+
+def save_caches(caches: dict, filename: str):
+    """
+    This function save several caches in a single JSON file
+
+    :param caches: a dict with the names of the caches as keys and the caches as values
+    :param filename: the name of the file
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump({name: cache.dump() for name, cache in caches.items()}, file)
+    # so that an interrupted run does not leave a broken file
+    os.replace(tmp_filename, filename)
+
+
+def load_caches(caches: dict, filename: str):
+    """
+    This function fill the caches with the content of a file saved with `save_caches`.
+    Nothing happens if the file does not exist.
+
+    :param caches: a dict with the names of the caches as keys and the caches as values
+    :param filename: the name of the file
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'r') as file:
+        saved = json.load(file)
+    for name, cache in caches.items():
+        cache.update(saved.get(name, []))
+
+
+def integer_key(*values):
+    """
+    This function return the tuple of the values converted to integers, if all of them are integer numbers,
+    otherwise None (e.g. for `nan` or for non integer parameters, which are not cached)
+
+    :param values: the numbers
+    :return: a tuple, or None
+    """
+    key = []
+    for value in values:
+        try:
+            if value != int(value):
+                return None
+        except (ValueError, OverflowError, TypeError):
+            return None
+        key.append(int(value))
+    return tuple(key)
+
+
+def query_key(methods: list, params: dict) -> str:
+    """
+    This function create the key of a query to Mixpanel, independent on the order of the parameters
+
+    :param methods: the methods of the query
+    :param params: the parameters of the query
+    :return: the key
+    """
+    canonical = json.dumps({'methods': list(methods), 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def response_ttl(params: dict, short_ttl: float, today: datetime.date = None):
+    """
+    This function decide how long a response of Mixpanel can be kept. Data about days already passed do not change,
+    so if the range of dates of the query ends at least two days ago (to be safe w.r.t. the timezone of the project)
+    the response never expires. Otherwise, or if there are no dates, it expires after `short_ttl` seconds.
+
+    :param params: the parameters of the query
+    :param short_ttl: the time to live, in seconds, for responses which can still change
+    :param today: optional, the current date
+    :return: the time to live in seconds, or None if the response never expires
+    """
+    today = today or datetime.date.today()
+    try:
+        to_date = datetime.date.fromisoformat(str(params['to_date']))
+    except (KeyError, ValueError):
+        return short_ttl
+    if to_date < today - datetime.timedelta(days=1):
+        return None
+    return short_ttl
+
+
+class ResponseCache(object):
+    """
+    A cache on disk (SQLite) for the responses of Mixpanel, stored compressed. Entries are keyed on the method and
+    the (canonicalized) parameters of the query, and have a time to live (see `response_ttl`).
+    When the total size goes above `max_bytes`, the least recently used entries are removed.
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 1024 ** 3, short_ttl: float = 3600, bypass: bool = False):
+        """
+        :param filename: the file of the database, created if it does not exist
+        :param max_bytes: the maximum size of the (compressed) responses kept
+        :param short_ttl: the time to live, in seconds, of the responses which can still change
+        :param bypass: if True, the cache is never read (but it is still filled with the new responses)
+        """
+        self.max_bytes = max_bytes
+        self.short_ttl = short_ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, "
+                                "expires REAL, accessed REAL, size INTEGER)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(methods: list, params: dict) -> str:
+        return query_key(methods, params)
+
+    def get(self, methods: list, params: dict):
+        """
+        This function return the cached response of a query, or None if it is not cached (or it is expired)
+
+        :param methods: the methods of the query
+        :param params: the parameters of the query
+        :return: the body of the response, or None
+        """
+        if self.bypass:
+            return None
+        key = self.make_key(methods, params)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT body FROM responses WHERE key = ? AND "
+                                          "(expires IS NULL OR expires > ?)", (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        return zlib.decompress(row[0])
+
+    def put(self, methods: list, params: dict, body: bytes):
+        """
+        This function store the response of a query, and eventually remove the oldest ones
+
+        :param methods: the methods of the query
+        :param params: the parameters of the query
+        :param body: the body of the response
+        """
+        key = self.make_key(methods, params)
+        compressed = zlib.compress(body)
+        now = time.time()
+        ttl = response_ttl(params, self.short_ttl)
+        expires = None if ttl is None else now + ttl
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                    (key, compressed, expires, now, len(compressed)))
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """
+        This function remove the expired entries and, if needed, the least recently used ones, until the total size
+        is below the limit. It has to be called with the lock held.
+        """
+        self.connection.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_delete = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    def stats(self) -> dict:
+        """
+        This function return the statistics of the usage of the cache
+
+        :return: a dict with hits, misses, number of entries and their total size
+        """
+        with self.lock:
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) "
+                                                    "FROM responses").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class QueryMemo(object):
+    """
+    The responses of the queries which are made more than once in a run. Each query is made only once, also
+    when the same one is asked by several threads at the same time, and its response is kept until it has been
+    given as many times as planned (see `mixbaba.plan_utils.plan_run`). Queries which are not planned are not kept.
+    """
+
+    def __init__(self, uses: dict):
+        """
+        :param uses: a dict with the keys of the queries (see `query_key`) and the number of times they are made
+        """
+        self.uses = dict(uses)
+        self.bodies = {}
+        # the queries being made, whose responses will be kept
+        self.pending = set()
+        self.hits = 0
+        self.condition = threading.Condition()
+
+    def fetch(self, key: str, function) -> bytes:
+        """
+        This function return the response of a query, making it only if it is not already kept
+
+        :param key: the key of the query
+        :param function: the function making the query
+        :return: the response
+        """
+        with self.condition:
+            # the same query is running in another thread
+            while key in self.pending:
+                self.condition.wait()
+            if key in self.bodies:
+                self.hits += 1
+                return self.take(key)
+            keep = self.uses.get(key, 0) > 1
+            if keep:
+                self.pending.add(key)
+            else:
+                # the last (or the only) use: nothing to keep
+                self.uses.pop(key, None)
+        if not keep:
+            return function()
+
+        try:
+            body = function()
+        except BaseException:
+            with self.condition:
+                self.pending.discard(key)
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.pending.discard(key)
+            self.bodies[key] = body
+            self.condition.notify_all()
+            return self.take(key)
+
+    def take(self, key: str) -> bytes:
+        """
+        This function give a kept response, and forget it after its last use. It has to be called with the lock held.
+
+        :param key: the key of the query
+        :return: the response
+        """
+        body = self.bodies[key]
+        self.uses[key] -= 1
+        if self.uses[key] <= 0:
+            del self.bodies[key]
+            del self.uses[key]
+        return body
+
+    def stats(self) -> dict:
+        """
+        This function return the statistics of the usage of the memo
+
+        :return: a dict with the number of queries not made again, and of the responses still kept
+        """
+        with self.condition:
+            return {'hits': self.hits, 'kept': len(self.bodies)}
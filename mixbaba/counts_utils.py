@@ -0,0 +1,377 @@
+from array import array
+from collections import OrderedDict
+import datetime
+import sqlite3
+import threading
+from itertools import chain, repeat
+from operator import itemgetter
+import io
+import json
+import numpy as np
+from mixbaba.metrics import timed
+
+try:
+    # a faster JSON parser, if available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # to parse the responses incrementally, if available
+    import ijson
+except ImportError:
+    ijson = None
+
+# the responses larger than this (in bytes) are parsed incrementally, if `ijson` is available:
+# it takes a bit longer than parsing them at once, but a small fraction of the memory
+STREAM_THRESHOLD = 8 * 1024 ** 2
+
+
+class FunnelCounts(object):
+    """
+    The counts of a funnel summed over the dates, as a matrix with a row for each group (e.g. control, test)
+    and a column for each step. The counts are accumulated in buffers, which are summed in the matrix
+    every `flush_size` entries, so that, with the response read incrementally (see `iter_funnel_dates`), the memory
+    needed besides the body does not grow with the length of the response.
+    """
+
+    def __init__(self, flush_size: int = 65536):
+        self.flush_size = flush_size
+        self.groups = OrderedDict()
+        self.steps = OrderedDict()
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+        self.present = np.zeros((0, 0), dtype=bool)
+        self.rows = array('q')
+        self.cols = array('q')
+        self.values = array('q')
+
+    def add_date(self, data: dict):
+        """
+        This function add the counts of a date of the response
+
+        :param data: a dict with the groups as keys and the list of their steps as values
+        """
+        if len(data) == 0:
+            return
+        # all the steps of all the groups at once, to leave the loops to the builtins
+        contents = list(data.values())
+        steps = list(chain.from_iterable(contents))
+        labels = list(map(itemgetter('step_label'), steps))
+        cols = list(map(self.steps.get, labels))
+        if None in cols:
+            cols = [self.steps.setdefault(label, len(self.steps)) for label in labels]
+        rows = list(map(self.groups.get, data.keys()))
+        if None in rows:
+            rows = [self.groups.setdefault(group, len(self.groups)) for group in data.keys()]
+        self.cols.extend(cols)
+        self.rows.extend(chain.from_iterable(map(repeat, rows, map(len, contents))))
+        self.values.extend(map(itemgetter('count'), steps))
+        if len(self.values) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        This function sum the buffered counts in the matrix
+        """
+        n_groups, n_steps = len(self.groups), len(self.steps)
+        if self.counts.shape != (n_groups, n_steps):
+            counts = np.zeros((n_groups, n_steps), dtype=np.int64)
+            present = np.zeros((n_groups, n_steps), dtype=bool)
+            counts[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+            present[:self.present.shape[0], :self.present.shape[1]] = self.present
+            self.counts, self.present = counts, present
+        if len(self.values) == 0:
+            return
+        flat = np.frombuffer(self.rows, dtype=np.int64) * n_steps + np.frombuffer(self.cols, dtype=np.int64)
+        values = np.frombuffer(self.values, dtype=np.int64)
+        self.counts += np.bincount(flat, weights=values, minlength=n_groups * n_steps).astype(np.int64).reshape(
+            n_groups, n_steps)
+        self.present.ravel()[flat] = True
+        self.rows, self.cols, self.values = array('q'), array('q'), array('q')
+
+    def count(self, group: str, step: str):
+        """
+        This function return the count of a step for a group
+
+        :param group: the name of the group (ex. "control")
+        :param step: the label of the step (ex. "Payment")
+        :return: the count, or nan if there is none
+        """
+        self.flush()
+        try:
+            row, col = self.groups[group], self.steps[step]
+        except KeyError:
+            return np.nan
+        return int(self.counts[row, col]) if self.present[row, col] else np.nan
+
+    def to_dict(self) -> OrderedDict:
+        """
+        This function return the counts in the same form of `mixbaba.mixbaba_utils.aggregate_mix_data`,
+        e.g. {'control': {'Payment': {'count': 12}, ...}, ...}
+
+        :return: an OrderedDict
+        """
+        self.flush()
+        steps = list(self.steps)
+        aggregated = OrderedDict()
+        for group, row in self.groups.items():
+            aggregated[group] = OrderedDict((steps[col], {'count': int(self.counts[row, col])})
+                                            for col in np.flatnonzero(self.present[row]))
+        return aggregated
+
+    def split(self, separator: str, n_fields: int) -> OrderedDict:
+        """
+        This function split counts whose groups are made of several values joined by `separator`
+        (see `mixbaba.mixbaba_utils.get_mixpanel_data_segmented`) in the counts of each combination
+        of the values after the first one. Groups with a different number of values (e.g. '$overall') are dropped.
+
+        :param separator: the separator of the values
+        :param n_fields: the number of values in a group
+        :return: an OrderedDict with the tuples of values as keys and `FunnelCounts` as values
+        """
+        self.flush()
+        splitted = OrderedDict()
+        for group, row in self.groups.items():
+            values = group.split(separator)
+            if len(values) != n_fields:
+                continue
+            splitted.setdefault(tuple(values[1:]), []).append((values[0], row))
+
+        parts = OrderedDict()
+        for key, rows in splitted.items():
+            part = FunnelCounts(self.flush_size)
+            part.groups = OrderedDict((group, i) for i, (group, _) in enumerate(rows))
+            part.steps = OrderedDict(self.steps)
+            indices = [row for _, row in rows]
+            part.counts = self.counts[indices]
+            part.present = self.present[indices]
+            parts[key] = part
+        return parts
+
+
+def iter_funnel_dates(body, stream_threshold: int = STREAM_THRESHOLD):
+    """
+    This function read the response of a funnel query (the JSON, as bytes or as a file) one date at a time.
+    With `ijson`, large responses are read incrementally, without building the parsed response in memory
+    (the body itself is kept whole, since the cache and the memo of the queries need it).
+
+    :param body: the response, as bytes or as a binary file
+    :param stream_threshold: the size (in bytes) above which the response is read incrementally
+    :return: a generator of the couples (date, dict with the groups as keys and the lists of their steps as values)
+    """
+    is_bytes = isinstance(body, (bytes, bytearray))
+    if ijson is not None and (not is_bytes or len(body) > stream_threshold):
+        yield from ijson.kvitems(io.BytesIO(body) if is_bytes else body, 'data', use_float=True)
+    else:
+        yield from json_loads(body if is_bytes else body.read())['data'].items()
+
+
+@timed()
+def parse_funnel_response(body, stream_threshold: int = STREAM_THRESHOLD) -> FunnelCounts:
+    """
+    This function read the response of a funnel query (see `iter_funnel_dates`) and sum the counts of all the dates
+
+    :param body: the response, as bytes or as a binary file
+    :param stream_threshold: the size (in bytes) above which the response is read incrementally
+    :return: the counts
+    """
+    counts = FunnelCounts()
+    for date, data in iter_funnel_dates(body, stream_threshold):
+        counts.add_date(data)
+    counts.flush()
+    return counts
+
+
+class CountsStore(object):
+    """
+    A columnar store of the counts of many funnels and cohorts: each count is a row of integer columns
+    (funnel, cohort, group, step, count), where the values of the first four are encoded as integers
+    (see the `funnels`, `cohorts`, `groups` and `steps` dicts, from the value to its code).
+    The impressions or conversions of all the cohorts of a funnel are extracted at once with `extract`.
+    """
+    COLUMNS = ('funnel', 'cohort', 'group', 'step', 'count')
+
+    def __init__(self):
+        self.funnels = OrderedDict()
+        self.cohorts = OrderedDict()
+        self.groups = OrderedDict()
+        self.steps = OrderedDict()
+        self.columns = {name: array('q') for name in self.COLUMNS}
+        # the counts as a dense array indexed by the codes, built when needed
+        self.dense = None
+
+    @staticmethod
+    def cohort_key(filters: dict) -> tuple:
+        """
+        This function return the key of the cohort selected by the filters
+
+        :param filters: the filters (ex. {"user.goal": "PREVENT", "user.$country_code": "US"})
+        :return: a tuple with the couples (discriminant, cohort)
+        """
+        return tuple(filters.items())
+
+    def add(self, funnel_id, filters: dict, counts: FunnelCounts):
+        """
+        This function add the counts of a cohort
+
+        :param funnel_id: the funnel identifier
+        :param filters: the filters selecting the cohort
+        :param counts: the counts
+        """
+        counts.flush()
+        funnel = self.funnels.setdefault(funnel_id, len(self.funnels))
+        cohort = self.cohorts.setdefault(self.cohort_key(filters), len(self.cohorts))
+        groups = np.array([self.groups.setdefault(group, len(self.groups)) for group in counts.groups],
+                          dtype=np.int64)
+        steps = np.array([self.steps.setdefault(step, len(self.steps)) for step in counts.steps], dtype=np.int64)
+        rows, cols = np.nonzero(counts.present)
+        self.columns['funnel'].extend(array('q', [funnel]) * len(rows))
+        self.columns['cohort'].extend(array('q', [cohort]) * len(rows))
+        self.columns['group'].frombytes(groups[rows].tobytes())
+        self.columns['step'].frombytes(steps[cols].tobytes())
+        self.columns['count'].frombytes(counts.counts[rows, cols].astype(np.int64).tobytes())
+        self.dense = None
+
+    def __len__(self):
+        return len(self.columns['count'])
+
+    def table(self) -> np.ndarray:
+        """
+        This function return the store as a structured array, with a record for each count
+
+        :return: the structured array
+        """
+        table = np.empty(len(self), dtype=[(name, np.int64) for name in self.COLUMNS])
+        for name in self.COLUMNS:
+            table[name] = np.frombuffer(self.columns[name], dtype=np.int64)
+        return table
+
+    def build_dense(self) -> np.ndarray:
+        """
+        This function return the counts as an array indexed by (funnel, cohort, group, step), with nan where
+        there is no count
+
+        :return: the array
+        """
+        if self.dense is None:
+            dense = np.full((len(self.funnels), len(self.cohorts), len(self.groups), len(self.steps)), np.nan)
+            columns = [np.frombuffer(self.columns[name], dtype=np.int64) for name in self.COLUMNS]
+            dense[tuple(columns[:4])] = columns[4]
+            self.dense = dense
+        return self.dense
+
+    def extract(self, funnel_id, filters_list: list, groups: list, step: str) -> np.ndarray:
+        """
+        This function return the counts of a step for many cohorts and groups at once
+
+        :param funnel_id: the funnel identifier
+        :param filters_list: the filters selecting the cohorts
+        :param groups: the names of the groups
+        :param step: the label of the step (ex. "Payment")
+        :return: an array with a row for each cohort and a column for each group, with nan where there is no count
+        """
+        result = np.full((len(filters_list), len(groups)), np.nan)
+        if funnel_id not in self.funnels or step not in self.steps:
+            return result
+        cohorts = np.array([self.cohorts.get(self.cohort_key(filters), -1) for filters in filters_list],
+                           dtype=np.int64)
+        group_codes = np.array([self.groups.get(group, -1) for group in groups], dtype=np.int64)
+        found_cohorts, found_groups = np.flatnonzero(cohorts >= 0), np.flatnonzero(group_codes >= 0)
+        dense = self.build_dense()[self.funnels[funnel_id], :, :, self.steps[step]]
+        result[np.ix_(found_cohorts, found_groups)] = dense[np.ix_(cohorts[found_cohorts],
+                                                                   group_codes[found_groups])]
+        return result
+
+
+class MonthlyStore(object):
+    """
+    A store on disk (SQLite) of the counts of the funnel queries month by month, so that a following run has to ask
+    Mixpanel only the months after the last complete one (see `mixbaba.mixbaba_utils.fetch_funnel_counts`).
+    The months are the buckets of the queries (whose unit is 'month'), so that the counts keep their meaning:
+    Mixpanel counts the users once in each bucket, and the sum of the days of a month would be larger.
+    A query is identified by everything but its dates (see `mixbaba.cache_utils.query_key`).
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: the file of the database, created if it does not exist
+        """
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        # the first day of the bucket of each month, which is the first day of the query for the first month
+        self.connection.execute("CREATE TABLE IF NOT EXISTS month_counts (query TEXT, first_day TEXT, grp TEXT, "
+                                "step TEXT, count INTEGER, PRIMARY KEY (query, first_day, grp, step))")
+        # for each query, the days stored, the last one being the end of a complete month or of the range of the query
+        self.connection.execute("CREATE TABLE IF NOT EXISTS month_queries (query TEXT PRIMARY KEY, first_day TEXT, "
+                                "last_day TEXT)")
+        self.connection.commit()
+
+    def stored_range(self, query: str):
+        """
+        This function return the range of the days of the complete buckets stored for a query
+
+        :param query: the key of the query
+        :return: a tuple (first day, last day) as `datetime.date`, or None if nothing is stored
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT first_day, last_day FROM month_queries WHERE query = ?",
+                                          (query,)).fetchone()
+        if row is None:
+            return None
+        return datetime.date.fromisoformat(row[0]), datetime.date.fromisoformat(row[1])
+
+    def save(self, query: str, months, first_day: datetime.date, last_day: datetime.date):
+        """
+        This function store the counts of some months, replacing those already stored for the same months and
+        forgetting those after the last day
+
+        :param query: the key of the query
+        :param months: an iterable of couples (first day of the bucket, dict with the groups as keys and the lists of
+            their steps as values)
+        :param first_day: the first day stored for the query
+        :param last_day: the last day of the last complete bucket stored for the query
+        """
+        with self.lock:
+            for month, data in months:
+                self.connection.execute("DELETE FROM month_counts WHERE query = ? AND first_day = ?", (query, month))
+                self.connection.executemany("INSERT OR REPLACE INTO month_counts VALUES (?, ?, ?, ?, ?)",
+                                            ((query, month, group, cont['step_label'], int(cont['count']))
+                                             for group, content in data.items() for cont in content))
+            self.connection.execute("DELETE FROM month_counts WHERE query = ? AND first_day > ?",
+                                    (query, last_day.isoformat()))
+            self.connection.execute("INSERT OR REPLACE INTO month_queries VALUES (?, ?, ?)",
+                                    (query, first_day.isoformat(), last_day.isoformat()))
+            self.connection.commit()
+
+    def clear(self, query: str):
+        """
+        This function forget all the counts of a query
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM month_counts WHERE query = ?", (query,))
+            self.connection.execute("DELETE FROM month_queries WHERE query = ?", (query,))
+            self.connection.commit()
+
+    def load(self, query: str, last_day: datetime.date) -> FunnelCounts:
+        """
+        This function sum the stored counts of a query over the months until a day
+
+        :param query: the key of the query
+        :param last_day: the last day of the last month summed
+        :return: the counts
+        """
+        counts = FunnelCounts()
+        with self.lock:
+            rows = self.connection.execute("SELECT grp, step, SUM(count) FROM month_counts WHERE query = ? "
+                                           "AND first_day <= ? GROUP BY grp, step ORDER BY MIN(rowid)",
+                                           (query, last_day.isoformat())).fetchall()
+        data = OrderedDict()
+        for group, step, count in rows:
+            data.setdefault(group, []).append({'step_label': step, 'count': count})
+        counts.add_date(data)
+        counts.flush()
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,438 @@
+from collections import Counter, OrderedDict
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zlib
+from mixbaba.cache_utils import query_key
+from mixbaba.metrics import timed
+
+try:
+    # a faster JSON parser, if available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# the default conversion window of the funnels, in days (as in Mixpanel)
+DEFAULT_WINDOW = 30
+
+# the references to a property in the expressions, e.g. properties["assignment"] or user["goal"]
+PROPERTY_RE = re.compile(r'(properties|user)\["((?:[^"\\]|\\.)*)"\]')
+# the conditions made by `mixbaba.mixbaba_utils.create_where`
+IN_RE = re.compile(r'\("((?:[^"\\]|\\.)*)" in (properties|user)\["((?:[^"\\]|\\.)*)"\]\)')
+DEFINED_RE = re.compile(r'\(defined \((properties|user)\["((?:[^"\\]|\\.)*)"\]\)\)')
+# the alternatives made by `mixbaba.mixbaba_utils.create_segmented_query`, e.g. (("A" in user["x"]) or ("B" in user["x"]))
+ANY_RE = re.compile(r'\(((?:\("(?:[^"\\]|\\.)*" in (?:properties|user)\["(?:[^"\\]|\\.)*"\]\)(?: or )?)+)\)')
+# the separator of the segments made by `mixbaba.mixbaba_utils.create_segmented_query`
+SEPARATOR_RE = re.compile(r'\+ "((?:[^"\\]|\\.)*)" \+')
+
+
+def open_export(path: str):
+    """
+    This function open an export file as text, decompressing it if its name ends with .gz
+
+    :param path: the file
+    :return: the file object
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def to_string(value) -> str:
+    """
+    This function convert a property to text, as `string()` does in the Mixpanel expressions
+
+    :param value: the value of the property
+    :return: the text
+    """
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def matches(cohort: str, value) -> bool:
+    """
+    This function evaluate the condition `"cohort" in value` of the Mixpanel expressions:
+    a list must contain the cohort, a text must contain it as substring, other values must be equal to it
+
+    :param cohort: the value looked for
+    :param value: the value of the property (not None)
+    :return: whether the condition holds
+    """
+    if isinstance(value, list):
+        return cohort in map(to_string, value)
+    if isinstance(value, str):
+        return cohort in value
+    return cohort == to_string(value)
+
+
+def parse_expressions(on: str, where: str = None) -> (list, str, list, list):
+    """
+    This function read the `on` and `where` expressions of a funnel query, as they are made by
+    `mixbaba.mixbaba_utils.create_funnel_query` and `mixbaba.mixbaba_utils.create_segmented_query`
+
+    :param on: the expression of the segments
+    :param where: optional, the expression of the filter
+    :return: a tuple with the list of the properties of the segments (as couples (type, name), where the type is
+        'properties' or 'user'), their separator, the list of the `in` conditions (each one as a list of alternatives,
+        the tuples (cohort, type, name), at least one of which must hold) and the list of the properties which must
+        be defined
+    """
+    on_props = PROPERTY_RE.findall(on)
+    if len(on_props) == 0:
+        raise ValueError(f"the segments of the query cannot be computed from the export: {on}")
+    separator = SEPARATOR_RE.search(on)
+    separator = separator.group(1) if separator is not None else ''
+
+    ins, defined = [], []
+    if where:
+        ins = [IN_RE.findall(alternatives) for alternatives in ANY_RE.findall(where)]
+        single = ANY_RE.sub('', where)
+        ins += [[condition] for condition in IN_RE.findall(single)]
+        defined = DEFINED_RE.findall(where)
+        # what is left must be only the glue of the conditions
+        rest = DEFINED_RE.sub('', IN_RE.sub('', single)).replace('and', '').strip()
+        if rest:
+            raise ValueError(f"the filter of the query cannot be computed from the export: {where}")
+    return on_props, separator, ins, defined
+
+
+def date_bucket(day: datetime.date, unit: str) -> str:
+    """
+    This function return the date under which a day is counted in a response
+
+    :param day: the day
+    :param unit: 'day', 'week' (starting on Monday) or 'month'
+    :return: the date, formatted like "2018-01-28"
+    """
+    if unit == 'month':
+        day = day.replace(day=1)
+    elif unit == 'week':
+        day = day - datetime.timedelta(days=day.weekday())
+    return day.isoformat()
+
+
+def map_export_file(job: tuple) -> (int, int):
+    """
+    This function read an export file and write the events of the steps of a funnel in the partitions, each user
+    always in the same partition, so that the partitions can be read independently (see `reduce_partition`).
+    Each kept event is a line [distinct_id, time, steps, properties], where only the events of the first step keep
+    their properties. A people file (the export of the profiles) gives lines [distinct_id, None, None, properties].
+
+    :param job: a tuple (index of the file, file, list of the names of the steps, number of partitions, folder of the
+        partitions, whether it is a people file)
+    :return: a tuple with the number of the lines read and of those kept
+    """
+    index, path, steps, n_partitions, folder, is_people = job
+    step_ids = {}
+    for step_id, step in enumerate(steps):
+        step_ids.setdefault(step, []).append(step_id)
+
+    outputs = {}
+    n_read = n_kept = 0
+    try:
+        with open_export(path) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                n_read += 1
+                record = json_loads(line)
+                if is_people:
+                    distinct_id = record.get('$distinct_id')
+                    entry = [distinct_id, None, None, record.get('$properties', {})]
+                else:
+                    step_id = step_ids.get(record.get('event'))
+                    if step_id is None:
+                        continue
+                    props = record.get('properties', {})
+                    distinct_id = props.get('distinct_id')
+                    if props.get('time') is None:
+                        continue
+                    entry = [distinct_id, props.get('time'), step_id, props if step_id[0] == 0 else None]
+                if distinct_id is None:
+                    continue
+                distinct_id = to_string(distinct_id)
+                entry[0] = distinct_id
+                partition = zlib.crc32(distinct_id.encode('utf-8')) % n_partitions
+                output = outputs.get(partition)
+                if output is None:
+                    output = outputs[partition] = open(os.path.join(folder, f"{partition}-{index}.jsonl"), 'w',
+                                                       encoding='utf-8')
+                output.write(json.dumps(entry))
+                output.write('\n')
+                n_kept += 1
+    finally:
+        for output in outputs.values():
+            output.close()
+    return n_read, n_kept
+
+
+def user_level(events: list, n_steps: int, start: float, end: float, window: float) -> (int, dict, float):
+    """
+    This function rebuild the funnel of a user: it starts with the first event of the first step in [start, end),
+    and the following steps are counted if they are made in order within the conversion window
+
+    :param events: the events of the user, as tuples (time, steps, properties), sorted by time
+    :param n_steps: the number of the steps of the funnel
+    :param start: the first moment of the funnel (as a UNIX time, in seconds)
+    :param end: the moment after the last one at which the funnel can be started
+    :param window: the conversion window, in seconds
+    :return: a tuple with the number of the steps made (0 if the funnel was not started), the properties of the
+        first event and its time
+    """
+    for i_entry, (entry_time, step_ids, props) in enumerate(events):
+        if step_ids[0] == 0 and start <= entry_time < end:
+            break
+    else:
+        return 0, None, None
+
+    level = 1
+    deadline = entry_time + window
+    for time, step_ids, _ in events[i_entry + 1:]:
+        if level >= n_steps or time > deadline:
+            break
+        if level in step_ids:
+            level += 1
+    return level, props, entry_time
+
+
+def reduce_partition(job: tuple) -> Counter:
+    """
+    This function count the users of a partition (see `map_export_file`) at each step of a funnel, with its filter
+    and segments
+
+    :param job: a tuple (folder of the partitions, partition, number of steps, start, end, window (see `user_level`),
+        unit of the dates, the properties of the segments, their separator, the `in` conditions and the properties
+        which must be defined (see `parse_expressions`))
+    :return: a Counter with the tuples (date, segment, number of the steps made) as keys, and the users as values
+    """
+    folder, partition, n_steps, start, end, window, unit, on_props, separator, ins, defined = job
+    events, people = {}, {}
+    for path in glob.glob(os.path.join(folder, f"{partition}-*.jsonl")):
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                distinct_id, time, step_ids, props = json_loads(line)
+                if step_ids is None:
+                    people[distinct_id] = props
+                else:
+                    events.setdefault(distinct_id, []).append((time, step_ids, props))
+
+    counts = Counter()
+    for distinct_id, user_events in events.items():
+        user_events.sort(key=lambda event: event[0])
+        level, props, entry_time = user_level(user_events, n_steps, start, end, window)
+        if level == 0:
+            continue
+        sources = {'properties': props, 'user': people.get(distinct_id, {})}
+        if any(sources[discr_type].get(name) is None for discr_type, name in defined):
+            continue
+        if not all(any(sources[discr_type].get(name) is not None and matches(cohort, sources[discr_type][name])
+                       for cohort, discr_type, name in alternatives) for alternatives in ins):
+            continue
+        values = [sources[discr_type].get(name) for discr_type, name in on_props]
+        if None in values:
+            continue
+        day = datetime.datetime.fromtimestamp(entry_time, datetime.timezone.utc).date()
+        counts[(date_bucket(day, unit), separator.join(map(to_string, values)), level)] += 1
+    return counts
+
+
+class OfflineAPI(object):
+    """
+    A stand-in for `mixbaba.mixbaba_utils.MixpanelAPI` which answers the funnel queries from the raw event export
+    of Mixpanel (JSONL files, possibly gzipped), so that the analyses run unchanged on local data.
+
+    The steps of each funnel are its "Steps" (by default its impression and conversion fields), and the conversion
+    window is its "Window" in days. The events of a funnel are read once from all the files (in parallel, one file
+    per process) and split by user in partitions on disk; each query then reads the partitions (in parallel too),
+    so that the memory needed is that of the users of one partition, not of the whole export.
+    The `user` properties come from the export of the profiles (the people file), if given.
+    The times are read as UTC.
+    """
+
+    def __init__(self, files: list, funnels: list, people: str = None, processes: int = None,
+                 n_partitions: int = 64, folder: str = None, memo=None):
+        """
+        :param files: the export files of the events
+        :param funnels: the list with the details of the funnels (the content of the JSON file)
+        :param people: optional, the export file of the profiles
+        :param processes: the number of processes; by default, as many as the cores; 1 means no extra process
+        :param n_partitions: the number of the partitions of the users
+        :param folder: optional, where the partitions are written (by default, a temporary folder)
+        :param memo: optional, the `mixbaba.cache_utils.QueryMemo` of the run
+        """
+        self.files = list(files)
+        self.people = people
+        self.processes = processes or os.cpu_count()
+        self.n_partitions = n_partitions
+        self.folder = tempfile.mkdtemp(prefix='mixbaba-', dir=folder)
+        self.memo = memo
+        self.monthly_store = None
+        self.funnels = OrderedDict()
+        for funnel_details in funnels:
+            steps = funnel_details.get('Steps', [funnel_details['Impression field name'],
+                                                 funnel_details['Conversion field name']])
+            self.funnels[funnel_details['ID']] = (funnel_details.get('Name', str(funnel_details['ID'])), steps,
+                                                  funnel_details.get('Window', DEFAULT_WINDOW))
+        self.executor = None
+        self.lock = threading.Lock()
+        self.mapped = {}
+        self.n_queries = 0
+        self.n_read = 0
+        self.n_kept = 0
+
+    def run(self, function, jobs: list) -> list:
+        """
+        This function run the jobs in the pool of processes (or here, with a single process)
+
+        :param function: the function to be run on each job
+        :param jobs: the list of the jobs
+        :return: the list of the results
+        """
+        if self.processes == 1 or len(jobs) < 2:
+            return [function(job) for job in jobs]
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+                import multiprocessing
+
+                # forking a process where the parallel kernels already started their threads can deadlock
+                self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        return list(self.executor.map(function, jobs))
+
+    def partitions(self, funnel_id) -> str:
+        """
+        This function split the events of a funnel in the partitions, the first time it is asked
+
+        :param funnel_id: the funnel
+        :return: the folder of the partitions
+        """
+        with self.lock:
+            entry = self.mapped.get(funnel_id)
+            if entry is None:
+                entry = self.mapped[funnel_id] = [threading.Event(), None]
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            entry[0].wait()
+            if entry[1] is None:
+                raise RuntimeError(f"the export of the funnel {funnel_id} could not be read")
+            return entry[1]
+
+        try:
+            folder = os.path.join(self.folder, str(funnel_id))
+            os.makedirs(folder, exist_ok=True)
+            steps = self.funnels[funnel_id][1]
+            jobs = [(index, path, steps, self.n_partitions, folder, False) for index, path in enumerate(self.files)]
+            if self.people is not None:
+                jobs.append((len(jobs), self.people, steps, self.n_partitions, folder, True))
+            for n_read, n_kept in self.run(map_export_file, jobs):
+                with self.lock:
+                    self.n_read += n_read
+                    self.n_kept += n_kept
+            entry[1] = folder
+            return folder
+        finally:
+            entry[0].set()
+
+    def funnel_response(self, params: dict) -> dict:
+        """
+        This function answer a funnel query, in the format of Mixpanel
+
+        :param params: the parameters of the query (see `mixbaba.mixbaba_utils.create_funnel_query`)
+        :return: the response
+        """
+        funnel_id = params['funnel_id']
+        if funnel_id not in self.funnels:
+            raise KeyError(f"the funnel {funnel_id} is not in the list of the funnels")
+        name, steps, window = self.funnels[funnel_id]
+        on_props, separator, ins, defined = parse_expressions(params['on'], params.get('where'))
+        unit = params.get('unit', 'day')
+        start = datetime.datetime.combine(datetime.date.fromisoformat(params['from_date']), datetime.time(),
+                                          datetime.timezone.utc)
+        end = datetime.datetime.combine(datetime.date.fromisoformat(params['to_date']), datetime.time(),
+                                        datetime.timezone.utc) + datetime.timedelta(days=1)
+
+        folder = self.partitions(funnel_id)
+        jobs = [(folder, partition, len(steps), start.timestamp(), end.timestamp(), window * 86400., unit,
+                 on_props, separator, ins, defined) for partition in range(self.n_partitions)]
+        counts = Counter()
+        for partition_counts in self.run(reduce_partition, jobs):
+            counts.update(partition_counts)
+
+        # the users who made at least each step, for each date and segment
+        reached = OrderedDict()
+        for (date, segment, level), n_users in sorted(counts.items()):
+            for group in (segment, '$overall'):
+                steps_counts = reached.setdefault(date, OrderedDict()).setdefault(group, [0] * len(steps))
+                for i_step in range(level):
+                    steps_counts[i_step] += n_users
+
+        data = OrderedDict((date, OrderedDict((group, [{'count': count, 'step_label': step, 'goal': step}
+                                                       for count, step in zip(steps_counts, steps)])
+                                              for group, steps_counts in groups.items()))
+                           for date, groups in reached.items())
+        return {'meta': {'dates': list(data.keys())}, 'data': data}
+
+    @timed()
+    def fetch(self, methods, params, http_method='GET', frmt='json') -> bytes:
+        """
+        This function answer a query as `mixbaba.mixbaba_utils.MixpanelAPI.fetch` does: only the list of the
+        funnels and the funnel queries can be answered
+
+        :param methods: List of methods to be joined, e.g. ['funnels']
+        :param params: Extra parameters associated with method
+        :param http_method: self explaining
+        :param frmt: the format in which you want the output (only json)
+        :return: the body of the response
+        """
+        params['format'] = frmt
+        if self.memo is not None and http_method == 'GET':
+            return self.memo.fetch(query_key(methods, params), lambda: self.fetch_once(methods, params))
+        return self.fetch_once(methods, params)
+
+    def fetch_once(self, methods, params) -> bytes:
+        method = '/'.join(methods)
+        if method == 'funnels/list':
+            response = [{'funnel_id': funnel_id, 'name': name} for funnel_id, (name, _, _) in self.funnels.items()]
+        elif method == 'funnels':
+            with self.lock:
+                self.n_queries += 1
+            response = self.funnel_response(params)
+        else:
+            raise ValueError(f"the query {method} cannot be answered from the export")
+        return json.dumps(response).encode('utf-8')
+
+    def request(self, methods, params, http_method='GET', frmt='json'):
+        """
+        This function answer a query (see `fetch`)
+
+        :return: what you asked
+        """
+        return json_loads(self.fetch(methods, params, http_method=http_method, frmt=frmt))
+
+    def stats(self) -> dict:
+        """
+        This function return the statistics about the queries answered so far
+
+        :return: a dict with the number of queries, of the funnels read from the export, of the lines read
+            and of the events kept
+        """
+        with self.lock:
+            return {'queries': self.n_queries, 'funnels_read': len(self.mapped), 'lines_read': self.n_read,
+                    'events_kept': self.n_kept}
+
+    def close(self):
+        """
+        This function stop the processes and delete the partitions
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        shutil.rmtree(self.folder, ignore_errors=True)
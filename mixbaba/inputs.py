@@ -12,15 +12,67 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("-f", "--funnels", help="The JSON file with the details about the funnels to be analyzed",
                         required=True)
-    parser.add_argument("-k", "--key", help="The key to authenticate within Mixpanel",
-                        required=True)
+    parser.add_argument("-k", "--key", help="The key to authenticate within Mixpanel (not needed with --export)")
     parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="increase output verbosity (max: -v)")
     parser.add_argument("-o", "--output", help="The form in which you want to get the output",
-                        choices=["terminal", "csv", 'both'], default="terminal")
+                        choices=["terminal", "csv", 'both', 'none'], default="terminal")
     parser.add_argument("-of", "--output_format", help="The format in which the output will be visualized/recorded",
                         choices=["long", 'short'], default="short")
+    parser.add_argument("-t", "--table", help="A single file with the results of all the funnels, one row for each "
+                                              "funnel, cohort and test group (.parquet, .feather, .jsonl or "
+                                              ".jsonl.gz)", default=None)
     parser.add_argument("-x", "--crossed_filters", action='store_true',
-                        help="Whether or not run with filters combinations")
+                        help="Analyze also the combinations of the cohorts of all the discriminants, skipping those "
+                             "with a cohort without data; with -mi or -mco, also the combinations of fewer "
+                             "discriminants (couples, triples, ...), from the coarse to the fine ones, skipping those "
+                             "with a cohort or a combination below the floors")
+    parser.add_argument("-rc", "--response_cache", help="A file where the responses of Mixpanel are cached, "
+                                                        "so that re-runs can skip the network", default=None)
+    parser.add_argument("-rcs", "--response_cache_size", help="The maximum size of the response cache, in MB",
+                        type=float, default=1024)
+    parser.add_argument("--refresh", action='store_true',
+                        help="Do not read the response cache (new responses are still saved in it)")
+    parser.add_argument("-rl", "--rate_limit", help="The maximum number of requests to Mixpanel in an hour",
+                        type=float, default=60)
+    parser.add_argument("-mc", "--max_concurrency", help="The maximum number of requests to Mixpanel in flight",
+                        type=int, default=5)
+    parser.add_argument("-mi", "--min_impressions", help="The combinations of filters are not analyzed if a cohort "
+                                                         "in them has a group with fewer impressions than this",
+                        type=float, default=0)
+    parser.add_argument("-mco", "--min_conversions", help="The combinations of filters are not analyzed if a cohort "
+                                                          "in them has a group with fewer conversions than this",
+                        type=float, default=0)
+    parser.add_argument("-i", "--incremental", help="A file where the counts of the funnels are stored month by month, "
+                                                      "so that the next runs ask Mixpanel only the new months",
+                        default=None)
+    parser.add_argument("-c", "--consolidate", action='store_true',
+                        help="Ask Mixpanel a single query for all the cohorts of a discriminant, instead of one each")
+    parser.add_argument("--dry-run", action='store_true', dest='dry_run',
+                        help="Only tell how many queries to Mixpanel the run would make, without making them "
+                             "(the key is not needed)")
+    parser.add_argument("-j", "--jobs", help="How many requests to Mixpanel can be made at the same time",
+                        type=int, default=1)
+    parser.add_argument("-p", "--plots", help="The folder where the plots of the posterior distributions will be saved "
+                                              "(one for each funnel and cohort)", default=None)
+    parser.add_argument("-sc", "--stats_cache", help="A file where the results of the statistical analyses are kept "
+                                                     "between runs, so that unchanged comparisons are not recomputed",
+                        default=None)
+    parser.add_argument("-scs", "--stats_cache_size", help="The maximum number of results kept in the cache",
+                        type=int, default=65536)
+    parser.add_argument("--endpoint", help="Another address for the API of Mixpanel "
+                                           "(e.g. http://127.0.0.1:8080/api, see benchmarks/fake_mixpanel.py)",
+                        default=None)
+    parser.add_argument("--export", nargs='+', help="The raw event export files of Mixpanel (JSONL, possibly "
+                                                     "gzipped): the funnels are computed from them, not asked",
+                        default=None)
+    parser.add_argument("--people", help="The export file of the profiles of Mixpanel, for the user properties "
+                                         "(with --export)", default=None)
+    parser.add_argument("--metrics", help="A file where the metrics of the run are written at the end "
+                                          "(latencies, requests, bytes, caches, memory)", default=None)
+    parser.add_argument("--metrics_format", help="The format of the metrics",
+                        choices=["json", "prometheus"], default="json")
+    parser.add_argument("-pf", "--plots_format", help="The format of the plots",
+                        choices=["png", "svg"], default="png")
 
     return parser
@@ -0,0 +1,244 @@
+from collections import OrderedDict
+import functools
+import json
+import re
+import threading
+import time
+
+# the upper bounds of the buckets of the latency histograms, in seconds (two for each decade, from 1us to 100s)
+BUCKETS = tuple(10 ** (i / 2) for i in range(-12, 5))
+
+
+class Metrics(object):
+    """
+    The metrics of a run: the latency histograms of the timed functions (see `timed`), and gauges
+    (e.g. the bytes received, the hits of the caches, the peak memory). While the metrics are disabled, which is
+    the default, the timed functions are called directly and nothing is recorded.
+    The metrics can be written as JSON or in the text format of Prometheus.
+    """
+
+    def __init__(self, enabled: bool = False, buckets: tuple = BUCKETS):
+        """
+        :param enabled: whether the metrics are recorded
+        :param buckets: the upper bounds of the buckets of the histograms, in seconds
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.timers = OrderedDict()
+        self.gauges = OrderedDict()
+
+    def observe(self, name: str, seconds: float):
+        """
+        This function record a duration in the histogram of `name`
+
+        :param name: the name of the histogram
+        :param seconds: the duration
+        """
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {'count': 0, 'sum': 0., 'max': 0., 'buckets': [0] * len(self.buckets)}
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    timer['buckets'][i] += 1
+                    break
+
+    def set(self, name: str, value: float, **labels):
+        """
+        This function set a gauge
+
+        :param name: the name of the gauge
+        :param value: the value
+        :param labels: optional, the labels of the value (e.g. stage='plan')
+        """
+        if not self.enabled:
+            return
+        key = name + ('{' + ','.join(f'{label}="{value_}"' for label, value_ in labels.items()) + '}'
+                      if labels else '')
+        with self.lock:
+            self.gauges[key] = value
+
+    def set_many(self, prefix: str, values: dict):
+        """
+        This function set a gauge for each number in a dict (e.g. what the `stats` methods return)
+
+        :param prefix: the prefix of the names of the gauges
+        :param values: the dict
+        """
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.set(f'{prefix}_{name}', value)
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.gauges.clear()
+
+    def to_dict(self) -> dict:
+        """
+        This function return all the metrics
+
+        :return: a dict with the timers (count, total, maximum and histogram of each one, where the buckets are
+            cumulative and identified by their upper bound) and the gauges
+        """
+        with self.lock:
+            timers = OrderedDict()
+            for name, timer in self.timers.items():
+                cumulative = 0
+                histogram = OrderedDict()
+                for bound, n in zip(self.buckets, timer['buckets']):
+                    cumulative += n
+                    histogram[f'{bound:.3g}'] = cumulative
+                histogram['+Inf'] = timer['count']
+                timers[name] = {'count': timer['count'], 'sum': timer['sum'], 'max': timer['max'],
+                                'buckets': histogram}
+            return {'timers': timers, 'gauges': OrderedDict(self.gauges)}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, namespace: str = 'mixbaba') -> str:
+        """
+        This function write the metrics in the text format of Prometheus: the timers become histograms
+        (`<name>_seconds`)
+
+        :param namespace: the prefix of all the names
+        :return: the text
+        """
+        metrics = self.to_dict()
+        lines = []
+        for name, timer in metrics['timers'].items():
+            full_name = f'{namespace}_{prometheus_name(name)}_seconds'
+            lines.append(f'# TYPE {full_name} histogram')
+            for bound, n in timer['buckets'].items():
+                lines.append(f'{full_name}_bucket{{le="{bound}"}} {n}')
+            lines.append(f'{full_name}_sum {timer["sum"]!r}')
+            lines.append(f'{full_name}_count {timer["count"]}')
+        typed = set()
+        for key, value in metrics['gauges'].items():
+            name, _, labels = key.partition('{')
+            full_name = f'{namespace}_{prometheus_name(name)}'
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f'# TYPE {full_name} gauge')
+            lines.append(f'{full_name}{"{" + labels if labels else ""} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename: str, frmt: str = 'json'):
+        """
+        This function write the metrics in a file
+
+        :param filename: the file
+        :param frmt: 'json' or 'prometheus'
+        """
+        if frmt == 'json':
+            text = self.to_json()
+        elif frmt == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            raise ValueError(f"Unknown format {frmt}, it should be one between 'json' and 'prometheus'")
+        with open(filename, 'w') as file:
+            file.write(text)
+
+
+def prometheus_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+# the metrics of the run
+metrics = Metrics()
+
+
+def timed(name: str = None, registry: Metrics = None):
+    """
+    This decorator record the latency of each call of a function in the metrics (by default, those of the run).
+    While the metrics are disabled, the only cost is the check of a flag.
+
+    :param name: the name of the histogram; by default, the qualified name of the function
+    :param registry: optional, the metrics where the latencies are recorded
+    :return: the decorator
+    """
+    def decorator(function):
+        timer_name = name or function.__qualname__
+        target = registry if registry is not None else metrics
+        clock = time.perf_counter
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not target.enabled:
+                return function(*args, **kwargs)
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                target.observe(timer_name, clock() - start)
+        return wrapper
+    return decorator
+
+
+def peak_memory() -> int:
+    """
+    This function return the peak memory (resident set size) of the process so far
+
+    :return: the bytes, or 0 where it cannot be known
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    import sys
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS gives bytes, Linux kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class CompileListener(object):
+    """
+    A listener of the compilations of numba, which records their durations in the metrics as `numba_compile`
+    (only the outermost ones, since compiling a kernel compiles also the kernels it calls)
+    """
+
+    def __init__(self, registry: Metrics = None):
+        self.registry = registry if registry is not None else metrics
+        self.starts = {}
+        self.listener = None
+
+    def install(self) -> bool:
+        """
+        This function start listening, if the version of numba has the events
+
+        :return: whether the listener is installed
+        """
+        try:
+            from numba.core import event
+        except ImportError:
+            return False
+        starts = self.starts
+        registry = self.registry
+
+        class Listener(event.Listener):
+            def on_start(self, ev):
+                starts.setdefault(threading.get_ident(), []).append(time.perf_counter())
+
+            def on_end(self, ev):
+                stack = starts.get(threading.get_ident())
+                if stack:
+                    start = stack.pop()
+                    if not stack:
+                        registry.observe('numba_compile', time.perf_counter() - start)
+
+        self.listener = Listener()
+        event.register('numba:compile', self.listener)
+        return True
+
+    def uninstall(self):
+        if self.listener is not None:
+            from numba.core import event
+
+            event.unregister('numba:compile', self.listener)
+            self.listener = None
@@ -1,21 +1,238 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import datetime
+import gzip
+import http.client
+import io
+import itertools
 import json
-import urllib
-import pandas as pd
-from scipy.stats import beta
-from mixbaba.beta_utils import calc_prob_between
+import queue
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+from typing import TYPE_CHECKING
+from mixbaba.cache_utils import LRUCache, QueryMemo, ResponseCache, integer_key, query_key
+from mixbaba.counts_utils import CountsStore, MonthlyStore, FunnelCounts, iter_funnel_dates, parse_funnel_response
+from mixbaba.export_utils import matches
+from mixbaba.metrics import timed
+from mixbaba.rate_utils import RateGovernor
+from mixbaba.beta_utils import BetaPosterior, prob_cache, calc_prob_between, calc_prob_between_many, \
+    calc_prob_best_many, calc_expected_loss, calc_expected_loss_many
 import numpy as np
 import warnings
-from scipy.stats._continuous_distns import beta_gen
+
+try:
+    # a faster JSON parser, if available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# the results of `make_ab_analysis`, since the same numbers come up again and again in a run
+analysis_cache = LRUCache()
+
+# all the caches of the statistics, by name (see `mixbaba.cache_utils.save_caches`)
+stats_caches = {'make_ab_analysis': analysis_cache, 'calc_prob_between': prob_cache}
+
 
 class MixpanelAPI(object):
+    """
+    The connector to the Mixpanel API. The connections are kept open and reused (also among threads),
+    responses are asked compressed, and the number of requests, the transferred bytes and the latencies are recorded.
+    The requests go through a governor, which respects the rate limits of Mixpanel and retries the throttled ones
+    (see `mixbaba.rate_utils.RateGovernor`). Optionally, the responses are kept in a cache on disk
+    (see `mixbaba.cache_utils.ResponseCache`).
+    """
     endpoint = 'https://mixpanel.com/api'
     VERSION = '2.0'
 
-    def __init__(self, token):
+    def __init__(self, token, endpoint: str = None, pool_size: int = 8, timeout: float = 300,
+                 cache: ResponseCache = None, governor: RateGovernor = None, memo: QueryMemo = None,
+                 monthly_store: MonthlyStore = None):
+        """
+        :param token: the API secret
+        :param endpoint: optional, another address for the API (e.g. 'http://localhost:8080/api')
+        :param pool_size: the maximum number of idle connections kept open
+        :param timeout: the timeout of the connections, in seconds
+        :param cache: optional, the cache on disk for the responses
+        :param governor: optional, the governor of the requests (by default, one with the limits of Mixpanel)
+        :param memo: optional, the responses of the queries made more than once in the run
+        :param monthly_store: optional, the counts of the funnels already gathered month by month in the previous runs
+            (see `fetch_funnel_counts`)
+        """
         self.token = token
+        self.monthly_store = monthly_store
+        self.cache = cache
+        self.memo = memo
+        self.governor = governor if governor is not None else RateGovernor()
+        if endpoint is not None:
+            self.endpoint = endpoint
+        self.headers = {'Authorization': 'Basic ' + base64.b64encode(self.token.encode()).decode(),
+                        'Accept-Encoding': 'gzip, deflate',
+                        'Connection': 'keep-alive'}
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+        splitted = urllib.parse.urlsplit(self.endpoint)
+        self.connection_class = http.client.HTTPSConnection if splitted.scheme == 'https' else \
+            http.client.HTTPConnection
+        self.host = splitted.netloc
+        self.origin = f'{splitted.scheme}://{splitted.netloc}'
+        self.base_path = splitted.path.rstrip('/')
+
+        self.stats_lock = threading.Lock()
+        self.n_requests = 0
+        self.n_connections = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.latencies = []
+
+    def get_connection(self) -> (http.client.HTTPConnection, bool):
+        """
+        This function return an idle connection from the pool, or a new one if there are none
+
+        :return: a tuple, (connection, whether it has been reused)
+        """
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            with self.stats_lock:
+                self.n_connections += 1
+            return self.connection_class(self.host, timeout=self.timeout), False
+
+    def release_connection(self, connection: http.client.HTTPConnection):
+        """
+        This function put a connection back in the pool, or close it if the pool is full
+
+        :param connection: the connection
+        """
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    @timed()
+    def fetch(self, methods, params, http_method='GET', frmt='json') -> bytes:
+        """
+        This function call the request to the Mixpanel API and return the (decompressed) body of the response.
+        An error status raises `urllib.error.HTTPError`, as `urllib.request.urlopen` does.
+        If there is a cache, GET requests are answered from it when possible, and the same happens
+        with the memo of the run.
+
+        :param methods: List of methods to be joined, e.g. ['events', 'properties', 'values']
+        :param params: Extra parameters associated with method
+        :param http_method: self explaining
+        :param frmt: the format in which you want the output.
+        :return: the body of the response
+        """
+        params['format'] = frmt
+        if self.memo is not None and http_method == 'GET':
+            return self.memo.fetch(query_key(methods, params), lambda: self.fetch_once(methods, params, http_method))
+        return self.fetch_once(methods, params, http_method)
+
+    def fetch_once(self, methods, params, http_method='GET') -> bytes:
+        """
+        This function make a query (with the format already in the parameters), through the cache if there is one
 
+        :param methods: List of methods to be joined
+        :param params: the parameters of the query
+        :param http_method: self explaining
+        :return: the body of the response
+        """
+        use_cache = self.cache is not None and http_method == 'GET'
+        if use_cache:
+            body = self.cache.get(methods, params)
+            if body is not None:
+                return body
+
+        path = '/'.join([self.base_path, str(self.VERSION)] + methods)
+        headers = dict(self.headers)
+        if http_method == 'GET':
+            data = None
+            path = path + '/?' + self.unicode_urlencode(params)
+        else:
+            data = self.unicode_urlencode(params).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        body = self.governor.call(lambda: self.send(http_method, path, data, headers))
+        if use_cache:
+            self.cache.put(methods, params, body)
+        return body
+
+    @timed()
+    def send(self, http_method: str, path: str, data: bytes, headers: dict) -> bytes:
+        """
+        This function make a single request on a connection of the pool
+
+        :param http_method: self explaining
+        :param path: the path of the request, with the query string
+        :param data: the body of the request, or None
+        :param headers: the headers of the request
+        :return: the (decompressed) body of the response
+        """
+        start = time.perf_counter()
+        connection, reused = self.get_connection()
+        try:
+            connection.request(http_method, path, body=data, headers=headers)
+            response = connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            connection.close()
+            if not reused:
+                raise
+            # the server closed the idle connection in the meanwhile, so we try once with a new one
+            connection = self.connection_class(self.host, timeout=self.timeout)
+            with self.stats_lock:
+                self.n_connections += 1
+            try:
+                connection.request(http_method, path, body=data, headers=headers)
+                response = connection.getresponse()
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            # e.g. a timeout: the state of the connection is unknown, so it is not reused
+            connection.close()
+            raise
+
+        try:
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(connection)
+
+        received = len(body)
+        encoding = response.getheader('Content-Encoding', '')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                # some servers send the raw deflate stream, without the zlib header
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        elapsed = time.perf_counter() - start
+
+        with self.stats_lock:
+            self.n_requests += 1
+            self.bytes_received += received
+            self.bytes_decoded += len(body)
+            self.latencies.append(elapsed)
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(self.origin + path, response.status, response.reason, response.msg,
+                                         io.BytesIO(body))
+        return body
+
+    @timed()
     def request(self, methods, params, http_method='GET', frmt='json'):
         """
         This function call the request to the Mixpanel API. Check  http://mixpanel.com/api/2.0/events/properties/values/
@@ -26,20 +243,34 @@ class MixpanelAPI(object):
         :param frmt: the format in which you wnat the output.
         :return: what you asked
         """
+        return json_loads(self.fetch(methods, params, http_method=http_method, frmt=frmt))
 
-        params['format'] = frmt
-
-        request_url = '/'.join([self.endpoint, str(self.VERSION)] + methods)
-        if http_method == 'GET':
-            data = None
-            request_url = request_url + '/?' + self.unicode_urlencode(params)
-        else:
-            data = self.unicode_urlencode(params)
+    def stats(self) -> dict:
+        """
+        This function return the statistics about the requests made so far
 
-        headers = {'Authorization': 'Basic ' + base64.b64encode(self.token.encode()).decode()}
-        request = urllib.request.Request(request_url, data, headers)
-        response = urllib.request.urlopen(request)
-        return json.loads(response.read())
+        :return: a dict with number of requests and of opened connections, bytes received (compressed) and decoded,
+            total, mean and maximum latency (in seconds)
+        """
+        with self.stats_lock:
+            latencies = list(self.latencies)
+            return {'requests': self.n_requests,
+                    'connections': self.n_connections,
+                    'bytes_received': self.bytes_received,
+                    'bytes_decoded': self.bytes_decoded,
+                    'latency_total': sum(latencies),
+                    'latency_mean': sum(latencies) / len(latencies) if latencies else 0.,
+                    'latency_max': max(latencies, default=0.)}
+
+    def close(self):
+        """
+        This function close the idle connections kept in the pool
+        """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
 
     @staticmethod
     def unicode_urlencode(params):
@@ -58,13 +289,15 @@ class MixpanelAPI(object):
         )
 
 
-def get_funnels_list(connector: MixpanelAPI) -> pd.DataFrame:
+def get_funnels_list(connector: MixpanelAPI) -> 'pd.DataFrame':
     """
     This function returns the whole list of funnels in a table containing the funnel ID and the funnel name
 
     :param connector: the connector to the Mixpanel service
     :return: a pandas DataFrame
     """
+    import pandas as pd
+
     # TODO: change dataframe to simple dict
     flist = connector.request(["funnels/list"], {})
     flist_df = pd.DataFrame(flist)
@@ -72,6 +305,7 @@ def get_funnels_list(connector: MixpanelAPI) -> pd.DataFrame:
     return flist_df
 
 
+@timed()
 def aggregate_mix_data(answer: dict) -> dict:
     """
     This function refactor the mixpanel data to have a more consistent dict for our needs
@@ -79,29 +313,18 @@ def aggregate_mix_data(answer: dict) -> dict:
     :param answer: the answer from mixpanel service, as dict
     :return: a dict containing the refactored data
     """
-    aggregated = OrderedDict({})
-
+    counts = FunnelCounts()
     for date, data in answer.items():
-        if data != {}:
-            for group, content in data.items():
-                for cont in content:
-                    if group in aggregated.keys():
-                        if cont['step_label'] in aggregated[group].keys():
-                            aggregated[group][cont['step_label']]['count'] += cont['count']
-                        else:
-                            aggregated[group][cont['step_label']] = {}
-                            aggregated[group][cont['step_label']]['count'] = cont['count']
-                    else:
-                        aggregated[group] = OrderedDict({})
-                        aggregated[group][cont['step_label']] = {}
-                        aggregated[group][cont['step_label']]['count'] = cont['count']
-    return aggregated
-
-
-def calc_uplift(beta_1: beta_gen, beta_2: beta_gen) -> float:
+        counts.add_date(data)
+    return counts.to_dict()
+
+
+def calc_uplift(beta_1: BetaPosterior, beta_2: BetaPosterior) -> float:
     """
     This function calculate the relative uplift of the beta_2 PDF over the beta_1 PDF.
     Note that the mean value of the PDFs is the number we need, not the peak value.
+    Any object with a `mean` method works (e.g. scipy.stats.beta), and with arrays of distributions
+    an array of uplifts is returned.
 
     :param beta_1: beta function (control)
     :param beta_2: beta function (test)
@@ -110,7 +333,9 @@ def calc_uplift(beta_1: beta_gen, beta_2: beta_gen) -> float:
     return (beta_2.mean() - beta_1.mean()) / beta_1.mean()
 
 
-def make_ab_analysis(imps_1: int, convs_1: int, imps_2: int, convs_2: int) -> (float, float):
+@timed()
+def make_ab_analysis(imps_1: int, convs_1: int, imps_2: int, convs_2: int, method: str = 'auto',
+                     return_error: bool = False) -> tuple:
     """
     This function return the relative uplift of test w.r.t. control,
     and the probability for test to be greater than control
@@ -119,36 +344,124 @@ def make_ab_analysis(imps_1: int, convs_1: int, imps_2: int, convs_2: int) -> (f
     :param convs_1:  number of conversions for the sample 1
     :param imps_2:  number of impressions for the sample 2
     :param convs_2:  number of conversions for the sample 2
-    :return: a tuple, (lift, probability)
+    :param method: 'exact', 'normal' or 'auto' (see `calc_prob_between`)
+    :param return_error: whether to return also the error estimate of the probability
+    :return: a tuple, (lift, probability) or (lift, probability, error estimate)
     """
+    key = integer_key(imps_1, convs_1, imps_2, convs_2)
+    cached = analysis_cache.get(key + (method,)) if key is not None else None
+    if cached is not None:
+        lift, prob, err = cached
+        return (lift, prob, err) if return_error else (lift, prob)
+
     # here we create the Beta functions for the two sets
-    a_1, b_1 = convs_1 + 1, imps_1 - convs_1 + 1
-    beta_1 = beta(a_1, b_1)
-    a_2, b_2 = convs_2 + 1, imps_2 - convs_2 + 1
-    beta_2 = beta(a_2, b_2)
+    beta_1 = BetaPosterior.from_counts(imps_1, convs_1)
+    beta_2 = BetaPosterior.from_counts(imps_2, convs_2)
 
     # calculating the lift
     lift = calc_uplift(beta_1, beta_2)
 
     # calculating the probability for Test to be better than Control
-    prob = calc_prob_between(beta_2, beta_1)
+    prob, err = calc_prob_between(beta_2, beta_1, method=method, return_error=True)
 
+    if key is not None:
+        analysis_cache.put(key + (method,), (lift, prob, err))
+    if return_error:
+        return lift, prob, err
     return lift, prob
 
 
-def get_mixpanel_data(api: MixpanelAPI, funnel_id: int, from_date: str, to_date: str, filters: {}, by: str) -> dict:
+def make_loss_analysis(imps_1: int, convs_1: int, imps_2: int, convs_2: int, method: str = 'auto') -> float:
     """
-    This function gather the data from Mixpanel using the API, eventually divided in cohort using a discriminant.
+    This function return the expected loss (in conversion rate) of choosing test instead of control
+
+    :param imps_1: number of impressions for the sample 1 (control)
+    :param convs_1:  number of conversions for the sample 1 (control)
+    :param imps_2:  number of impressions for the sample 2 (test)
+    :param convs_2:  number of conversions for the sample 2 (test)
+    :param method: 'exact', 'normal' or 'auto' (see `calc_prob_between`)
+    :return: the expected loss
+    """
+    beta_1 = BetaPosterior.from_counts(imps_1, convs_1)
+    beta_2 = BetaPosterior.from_counts(imps_2, convs_2)
+    return calc_expected_loss(beta_2, beta_1, method=method)
+
+
+@timed()
+def make_ab_analysis_many(imps_1, convs_1, imps_2, convs_2, method: str = 'auto') -> (np.ndarray, np.ndarray):
+    """
+    This function is the vectorized version of `make_ab_analysis`: it takes arrays of impressions and conversions
+    (one element per cohort) and makes all the analyses in a single call
+
+    :param imps_1: array with the number of impressions for the samples 1
+    :param convs_1: array with the number of conversions for the samples 1
+    :param imps_2: array with the number of impressions for the samples 2
+    :param convs_2: array with the number of conversions for the samples 2
+    :param method: 'exact', 'normal' or 'auto' (see `calc_prob_between`)
+    :return: a tuple of arrays, (lift, probability)
+    """
+    imps_1, convs_1, imps_2, convs_2 = [np.asarray(x, dtype=np.float64) for x in (imps_1, convs_1, imps_2, convs_2)]
+    prob, lift = calc_prob_between_many(convs_1 + 1, imps_1 - convs_1 + 1, convs_2 + 1, imps_2 - convs_2 + 1,
+                                        method=method)
+    return lift, prob
+
+
+def make_best_analysis(imps, convs) -> np.ndarray:
+    """
+    This function return, for each group (control and all the tests), the probability to be the best one.
+    Groups with missing numbers get `nan`, and are not taken into account for the others.
+
+    :param imps: list with the number of impressions of each group
+    :param convs: list with the number of conversions of each group
+    :return: an array with the probabilities
+    """
+    return make_best_analysis_many(np.ravel(imps)[None, :], np.ravel(convs)[None, :])[0]
+
+
+def make_best_analysis_many(imps, convs) -> np.ndarray:
+    """
+    This function is the vectorized version of `make_best_analysis`: each row of the arrays has the numbers of the
+    groups of a cohort, and the probabilities of all the rows are calculated at once.
+
+    :param imps: 2-D array with the number of impressions, a row for each cohort and a column for each group
+    :param convs: 2-D array with the number of conversions
+    :return: a 2-D array with the probabilities
+    """
+    imps = np.asarray(imps, dtype=np.float64)
+    convs = np.asarray(convs, dtype=np.float64)
+    # the parameters are nan for the groups with missing numbers, which are left out
+    return calc_prob_best_many(convs + 1, imps - convs + 1)
+
+
+def create_where(filters: dict) -> str:
+    """
+    This function create the `where` expression of a query from the filters
+
+    :param filters: the filters to be used (ex. {'properties.assignment': 'control'}, or for no filters {'None': 'All'})
+    :return: the expression
+    """
+    req_filt = ""
+    for i_filt, (filt_type, cohort) in enumerate(filters.items()):
+        if filt_type != 'None':
+            if i_filt > 0:
+                req_filt += " and "
+            discr_type, discriminant = filt_type.split('.')
+            req_filt += f'("{cohort}" in {discr_type}["{discriminant}"]) ' \
+                f'and (defined ({discr_type}["{discriminant}"]))'
+    return req_filt
+
+
+def create_funnel_query(funnel_id: int, from_date: str, to_date: str, filters: {}, by: str) -> dict:
+    """
+    This function create the parameters of the query made by `get_mixpanel_data`
 
-    :param api: the connector to the Mixpanel
     :param funnel_id: the funnel identifier
     :param from_date: self explaining, string formatted like "2018-01-28"
     :param to_date: self explaining
     :param filters: the filters to be used (ex. {'properties.assignment': 'control'}, or for no filters {'None': 'All'})
     :param by: the string containing the value on which breakdown the cohorts
-    :return: a dict with the data
+    :return: a dict with the parameters
     """
-
     # the aggregated data will be divided by 'assignment' property (i.e. control, test, etc)
     by_type, by_val = by.split(".")
     req_dict = {
@@ -159,19 +472,174 @@ def get_mixpanel_data(api: MixpanelAPI, funnel_id: int, from_date: str, to_date:
         'unit': 'month'
     }
     if len(filters) > 0:
-        req_filt = ""
-        for i_filt, (filt_type, cohort) in enumerate(filters.items()):
-            if filt_type != 'None':
-                if i_filt > 0:
-                    req_filt += " and "
-                discr_type, discriminant = filt_type.split('.')
-                req_filt += f'("{cohort}" in {discr_type}["{discriminant}"]) ' \
-                    f'and (defined ({discr_type}["{discriminant}"]))'
-        req_dict["where"] = req_filt
-    response_ = api.request(["funnels"], req_dict)
+        req_dict["where"] = create_where(filters)
+    return req_dict
+
+
+@timed()
+def fetch_funnel_counts(api: MixpanelAPI, req_dict: dict, today: datetime.date = None) -> FunnelCounts:
+    """
+    This function make a funnel query and sum the counts of all its dates (the buckets of its unit, a month).
+    If the connector has a `mixbaba.counts_utils.MonthlyStore`, only the months after the last complete one already
+    stored are asked, and the counts of the stored months are summed to theirs: a month (or its part in the range)
+    is complete when it ends before yesterday, whatever the timezone of the project, while the following ones will be
+    asked again. The buckets are those of the query made at once, so the counts are the same too.
+
+    :param api: the connector to the Mixpanel
+    :param req_dict: the parameters of the query (see `create_funnel_query`)
+    :param today: optional, the current date
+    :return: the counts
+    """
+    store = getattr(api, 'monthly_store', None)
+    if store is None:
+        return parse_funnel_response(api.fetch(["funnels"], req_dict))
+
+    last_complete = (today or datetime.date.today()) - datetime.timedelta(days=2)
+    one_day = datetime.timedelta(days=1)
+    query = query_key(["funnels"], {key: value for key, value in req_dict.items()
+                                    if key not in ('from_date', 'to_date')})
+    from_date = datetime.date.fromisoformat(req_dict['from_date'])
+    to_date = datetime.date.fromisoformat(req_dict['to_date'])
+
+    stored = store.stored_range(query)
+    if stored is None or stored[0] != from_date:
+        # the first bucket starts on the first day of the query, so the stored months are of another query
+        store.clear(query)
+        stored_last = from_date - one_day
+    else:
+        stored_last = stored[1]
+    # the stored buckets which are those of the range: the whole months, and the last one if it ends on the same day
+    if to_date == stored_last:
+        last_day = stored_last
+    else:
+        last_day = max(from_date, (min(to_date, stored_last) + one_day).replace(day=1)) - one_day
+    counts = store.load(query, last_day)
+
+    start = last_day + one_day
+    if start <= to_date:
+        params = dict(req_dict, from_date=start.isoformat(), to_date=to_date.isoformat())
+        # the buckets by their first day, in order
+        months = sorted(((max(datetime.date.fromisoformat(date).replace(day=1), start).isoformat(), data)
+                         for date, data in iter_funnel_dates(api.fetch(["funnels"], params))),
+                        key=lambda month: month[0])
+        # the complete buckets are stored, if they reach further than those already stored
+        complete, complete_last = [], last_day
+        for month, data in months:
+            month_start = datetime.date.fromisoformat(month).replace(day=1)
+            bucket_end = min(to_date, (month_start + datetime.timedelta(days=31)).replace(day=1) - one_day)
+            if bucket_end > last_complete:
+                break
+            complete.append((month, data))
+            complete_last = bucket_end
+        if complete_last > stored_last:
+            store.save(query, complete, from_date, complete_last)
+        for month, data in months:
+            counts.add_date(data)
+        counts.flush()
+    return counts
+
+
+@timed()
+def get_mixpanel_data(api: MixpanelAPI, funnel_id: int, from_date: str, to_date: str, filters: {}, by: str) -> dict:
+    """
+    This function gather the data from Mixpanel using the API, eventually divided in cohort using a discriminant.
 
+    :param api: the connector to the Mixpanel
+    :param funnel_id: the funnel identifier
+    :param from_date: self explaining, string formatted like "2018-01-28"
+    :param to_date: self explaining
+    :param filters: the filters to be used (ex. {'properties.assignment': 'control'}, or for no filters {'None': 'All'})
+    :param by: the string containing the value on which breakdown the cohorts
+    :return: a dict with the data
+    """
+    req_dict = create_funnel_query(funnel_id=funnel_id, from_date=from_date, to_date=to_date, filters=filters, by=by)
     # since by default the data is divided per month, we need to aggregate it
-    return aggregate_mix_data(response_['data'])
+    return fetch_funnel_counts(api, req_dict).to_dict()
+
+
+# the separator of the values of the properties in a segmentation on several properties
+SEGMENT_SEPARATOR = '|#|'
+# the number of the values of a segmentation returned by Mixpanel (by default only the top 255, at most 10000)
+SEGMENT_LIMIT = 10000
+
+
+def create_segmented_query(funnel_id: int, from_date: str, to_date: str, discriminants: list, by: str,
+                           cohorts: dict = None) -> dict:
+    """
+    This function create the parameters of the query made by `get_mixpanel_data_segmented`
+
+    :param funnel_id: the funnel identifier
+    :param from_date: self explaining, string formatted like "2018-01-28"
+    :param to_date: self explaining
+    :param discriminants: the discriminants (ex. ['user.goal', 'user.$country_code'])
+    :param by: the string containing the value on which breakdown the cohorts
+    :param cohorts: optional, the cohorts of each discriminant (ex. {'user.goal': ['PREVENT', 'PLAN']}): only the
+        users in one of them are asked
+    :return: a dict with the parameters
+    """
+    segments = []
+    for prop in [by] + list(discriminants):
+        prop_type, prop_val = prop.split(".")
+        segments.append(f'string({prop_type}["{prop_val}"])')
+    conditions = []
+    for discriminant in discriminants:
+        d_type, d_val = discriminant.split('.')
+        condition = f'(defined ({d_type}["{d_val}"]))'
+        if cohorts is not None and discriminant in cohorts:
+            condition += ' and (' + ' or '.join(f'("{cohort}" in {d_type}["{d_val}"])'
+                                                for cohort in cohorts[discriminant]) + ')'
+        conditions.append(condition)
+    return {
+        "funnel_id": funnel_id,
+        "from_date": from_date,
+        "to_date": to_date,
+        "on": f' + "{SEGMENT_SEPARATOR}" + '.join(segments),
+        "where": " and ".join(conditions),
+        "limit": SEGMENT_LIMIT,
+        'unit': 'month'
+    }
+
+
+@timed()
+def get_mixpanel_data_segmented(api: MixpanelAPI, funnel_id: int, from_date: str, to_date: str, discriminants: list,
+                                by: str, as_counts: bool = False, cohorts: dict = None) -> dict:
+    """
+    This function gather the data of all the cohorts of one or more discriminants with a single query:
+    the funnel is segmented on the groups and on the discriminants together (their values are joined
+    with `SEGMENT_SEPARATOR`), and the response is split here in the cohorts.
+
+    A cohort is asked with `"cohort" in property`, which holds also for a list containing the cohort or a text
+    containing it, while the segments are the exact values: so a cohort is left out of the result if another value
+    in the response matches it. Cohorts without data, or beyond the values Mixpanel returns, are missing as well:
+    they have to be asked one by one (see `analyze_funnel_consolidated`).
+
+    :param api: the connector to the Mixpanel
+    :param funnel_id: the funnel identifier
+    :param from_date: self explaining, string formatted like "2018-01-28"
+    :param to_date: self explaining
+    :param discriminants: the discriminants (ex. ['user.goal', 'user.$country_code'])
+    :param by: the string containing the value on which breakdown the cohorts
+    :param as_counts: whether to give the data as `mixbaba.counts_utils.FunnelCounts`
+    :param cohorts: optional, the cohorts of each discriminant (see `create_segmented_query`)
+    :return: a dict with the tuples of the cohorts as keys (ex. ('PREVENT', 'US')), and the data as `get_mixpanel_data`
+        returns it (or the counts) as values
+    """
+    req_dict = create_segmented_query(funnel_id=funnel_id, from_date=from_date, to_date=to_date,
+                                      discriminants=discriminants, by=by, cohorts=cohorts)
+    # splitting the answer in one answer for each cohort, divided by group as usual ('$overall' is dropped)
+    splitted = fetch_funnel_counts(api, req_dict).split(SEGMENT_SEPARATOR, len(discriminants) + 1)
+    if cohorts is not None:
+        # for each discriminant, the cohorts whose counts would be only a part of those asked for them
+        ambiguous = []
+        for i, discriminant in enumerate(discriminants):
+            values = {key[i] for key in splitted}
+            ambiguous.append({cohort for cohort in cohorts.get(discriminant, []) if
+                              any(value != cohort and matches(cohort, value) for value in values)})
+        splitted = OrderedDict((key, counts) for key, counts in splitted.items()
+                               if not any(value in ambiguous_ for value, ambiguous_ in zip(key, ambiguous)))
+    if as_counts:
+        return splitted
+    return OrderedDict((cohorts_, counts.to_dict()) for cohorts_, counts in splitted.items())
 
 
 def extract_ab_group_names(extracted_ab) -> (list, list):
@@ -255,8 +723,23 @@ def create_fg_names(filters: dict) -> (str, str):
     return discriminant, cohort
 
 
+def create_breakdown_filters(filters: dict, by: str, ab_group: str) -> OrderedDict:
+    """
+    This function create the filters of the query for the breakdowns of an AB group in a cohort
+
+    :param filters: the filters of the cohort (ex. {"user.goal": "PREVENT"}, or {'None': 'All'})
+    :param by: the name of the field in which the AB groups are divided
+    :param ab_group: the name of the AB group (ex. "control")
+    :return: the filters
+    """
+    brk_filters = OrderedDict({by: ab_group})
+    brk_filters.update(filters)
+    return brk_filters
+
+
+@timed()
 def analyze_funnel(api: MixpanelAPI, filters: dict, funnel_details: dict,
-                   prob_th: float = 0.95) -> OrderedDict:
+                   prob_th: float = 0.95, aggregated_data: dict = None) -> OrderedDict:
     """
     This function gather the data, makes the analysis and output the result for the given funnel.
 
@@ -264,6 +747,8 @@ def analyze_funnel(api: MixpanelAPI, filters: dict, funnel_details: dict,
     :param filters: the filters to be used in this analysis
     :param funnel_details: the dict with the details of the funnel
     :param prob_th: optional, the probability threshold to accept the hypothesis
+    :param aggregated_data: optional, the data already gathered (see `get_mixpanel_data_segmented`);
+        if not given, it is asked to Mixpanel
     :return: an OrderedDict containing the processed data
     """
 
@@ -281,8 +766,9 @@ def analyze_funnel(api: MixpanelAPI, filters: dict, funnel_details: dict,
 
     output_template = OrderedDict({'Discriminant': discriminant, 'Cohort': cohort, 'Comment': " "})
 
-    aggregated_data = get_mixpanel_data(api=api, funnel_id=funnel_id, from_date=from_date, to_date=to_date,
-                                        filters=filters, by=by)
+    if aggregated_data is None:
+        aggregated_data = get_mixpanel_data(api=api, funnel_id=funnel_id, from_date=from_date, to_date=to_date,
+                                            filters=filters, by=by)
 
     try:
         ab_groups = funnel_details['AB Groups']
@@ -295,9 +781,8 @@ def analyze_funnel(api: MixpanelAPI, filters: dict, funnel_details: dict,
     control2_present = False
     if manual_ab_names:
         control_g_name = ab_groups['Control']
-        # TODO foresee a manual selection of other test groups
-        _test_group = ab_groups['Test']
-        test_groups = [_test_group]
+        # all the test groups: 'Test', 'Test2', 'Test3', etc.
+        test_groups = [g_name for g_key, g_name in ab_groups.items() if g_key.startswith('Test')]
         if "Control2" in ab_groups.keys():
             control2_g_name = ab_groups['Control2']
             control2_present = True
@@ -356,6 +841,11 @@ def analyze_funnel(api: MixpanelAPI, filters: dict, funnel_details: dict,
             output_template['Comment'] = "The two control options appear different!"
             return output_template
 
+    # these are needed to find the best among all the groups
+    arms_names, arms_imps, arms_convs = ['Control'], [imps_ctrl], [convs_ctrl]
+    # the breakdowns are gathered once, if any test group has been analyzed
+    breakdowns_needed = False
+
     # Tests groups
     for test_g_name in test_groups:
         which = f"{test_g_name} Impressions"
@@ -368,33 +858,270 @@ def analyze_funnel(api: MixpanelAPI, filters: dict, funnel_details: dict,
                                       field=c_field, which=which)
         convs_test = output_template[which]
 
+        arms_names.append(test_g_name)
+        arms_imps.append(imps_test)
+        arms_convs.append(convs_test)
+
         if convs_test < 1:
             output_template['Comment'] += "No conversions for %s!" % test_g_name
             # TODO: check what happens with breakdowns!
         else:
-            cr, prob = make_ab_analysis(imps_ctrl, convs_ctrl, imps_test, convs_test)
+            cr, prob, err = make_ab_analysis(imps_ctrl, convs_ctrl, imps_test, convs_test, return_error=True)
             if prob > prob_th:
                 output_template['Comment'] += 'Result for %s is OK! ' % test_g_name
             else:
                 output_template['Comment'] += 'Result for %s is uncertain.' % test_g_name
-            if 'Breakdowns' in funnel_details.keys():
-                for ab_group in ab_groups.values():
-                    # 'By' become a filter:
-                    filters = {by: ab_group}
-                    for brk_type, _ in funnel_details['Breakdowns'].items():
-                        filters[discriminant] = cohort
-                        aggregated_data = get_mixpanel_data(api=api, funnel_id=funnel_id, from_date=from_date,
-                                                            to_date=to_date, filters=filters, by=brk_type)
-                        conversions = {}
-                        for d_key, d_val in aggregated_data.items():
-                            conversions[d_key] = d_val[c_field]['count']
-                        output_template[ab_group + " -- conversions details"] = conversions
-
+            breakdowns_needed = True
             output_template['%s CR improvement' % test_g_name] = cr
             output_template['%s Probability' % test_g_name] = prob
+            output_template['%s Expected loss' % test_g_name] = make_loss_analysis(imps_ctrl, convs_ctrl,
+                                                                                    imps_test, convs_test)
+            if err > 0:
+                # the probability comes from the approximation, so we give also its error estimate
+                output_template['%s Probability error' % test_g_name] = err
+
+    if breakdowns_needed and 'Breakdowns' in funnel_details.keys():
+        for ab_group in ab_groups.values():
+            # 'By' become a filter, together with the filters of this analysis
+            brk_filters = create_breakdown_filters(filters, by, ab_group)
+            for brk_type, _ in funnel_details['Breakdowns'].items():
+                aggregated_data = get_mixpanel_data(api=api, funnel_id=funnel_id, from_date=from_date,
+                                                    to_date=to_date, filters=brk_filters, by=brk_type)
+                conversions = {}
+                for d_key, d_val in aggregated_data.items():
+                    conversions[d_key] = d_val[c_field]['count']
+                output_template[ab_group + " -- conversions details"] = conversions
+
+    if len(test_groups) > 1:
+        # with several test groups we can also tell which one is the best
+        probs_best = make_best_analysis(arms_imps, arms_convs)
+        for arm_name, prob_best in zip(arms_names, probs_best):
+            output_template['%s Probability to be best' % arm_name] = prob_best
     return output_template
 
 
+def analyze_funnel_many(api: MixpanelAPI, filters_list: list, funnel_details: dict, jobs: int = 1,
+                        prob_th: float = 0.95):
+    """
+    This function makes `analyze_funnel` for many filters, eventually running `jobs` of them at the same time
+    (most of the time is spent waiting for Mixpanel). The results are given back in the same order as the filters.
+
+    Note that `analyze_funnel` has to be run once on the funnel before, because the first run fills
+    the names of the groups in `funnel_details`.
+
+    :param api: the connector to the Mixpanel
+    :param filters_list: a list with the filters to be used, one analysis for each of them
+    :param funnel_details: the dict with the details of the funnel
+    :param jobs: how many analyses can run at the same time
+    :param prob_th: optional, the probability threshold to accept the hypothesis
+    :return: a generator of the results, in the same order of `filters_list`
+    """
+    if jobs <= 1:
+        for filters in filters_list:
+            yield analyze_funnel(api=api, filters=filters, funnel_details=funnel_details, prob_th=prob_th)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(analyze_funnel, api=api, filters=filters, funnel_details=funnel_details,
+                                   prob_th=prob_th) for filters in filters_list]
+        for future in futures:
+            yield future.result()
+
+
+def analyze_funnel_consolidated(api: MixpanelAPI, filters_list: list, funnel_details: dict, jobs: int = 1,
+                                prob_th: float = 0.95):
+    """
+    This function makes `analyze_funnel` for many filters as `analyze_funnel_many` does, but asking Mixpanel only
+    one query for each set of discriminants (see `get_mixpanel_data_segmented`) instead of one for each cohort.
+    The queries are made at the beginning, eventually `jobs` at the same time.
+
+    :param api: the connector to the Mixpanel
+    :param filters_list: a list with the filters to be used, one analysis for each of them
+    :param funnel_details: the dict with the details of the funnel
+    :param jobs: how many queries can run at the same time
+    :param prob_th: optional, the probability threshold to accept the hypothesis
+    :return: a generator of the results, in the same order of `filters_list`
+    """
+    discriminants_list = list(OrderedDict.fromkeys(tuple(filters.keys()) for filters in filters_list))
+    # the cohorts asked for each discriminant: those of the funnel (as `mixbaba.plan_utils.plan_run` plans them),
+    # and any other one in the filters
+    cohorts = OrderedDict()
+    for filters in filters_list:
+        for discriminant, cohort in filters.items():
+            listed = cohorts.setdefault(discriminant, list(funnel_details.get('filters', {}).get(discriminant, [])))
+            if cohort not in listed:
+                listed.append(cohort)
+
+    def get_segmented(discriminants):
+        return get_mixpanel_data_segmented(api=api, funnel_id=funnel_details['ID'],
+                                           from_date=funnel_details['From Date'],
+                                           to_date=funnel_details['To Date'], discriminants=list(discriminants),
+                                           by=funnel_details['By'], as_counts=True,
+                                           cohorts={discriminant: cohorts[discriminant]
+                                                    for discriminant in discriminants})
+
+    def get_single(filters):
+        req_dict = create_funnel_query(funnel_id=funnel_details['ID'], from_date=funnel_details['From Date'],
+                                       to_date=funnel_details['To Date'], filters=filters, by=funnel_details['By'])
+        return fetch_funnel_counts(api, req_dict)
+
+    def run(function, arguments):
+        if jobs <= 1:
+            return list(map(function, arguments))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(function, arguments))
+
+    segmented = dict(zip(discriminants_list, run(get_segmented, discriminants_list)))
+    # the cohorts which are not in the responses (see `get_mixpanel_data_segmented`), or only with some of the groups
+    # (each value of the segmentation is a group in a cohort), are asked one by one
+    groups = list(funnel_details.get('AB Groups', {}).values())
+    missing = []
+    for filters in filters_list:
+        counts = segmented[tuple(filters.keys())].get(tuple(filters.values()))
+        if counts is None or any(group not in counts.groups for group in groups):
+            missing.append(filters)
+    for filters, counts in zip(missing, run(get_single, missing)):
+        segmented[tuple(filters.keys())][tuple(filters.values())] = counts
+
+    if 'Breakdowns' in funnel_details.keys():
+        # the breakdowns need further queries for each cohort
+        for filters in filters_list:
+            counts = segmented[tuple(filters.keys())][tuple(filters.values())]
+            yield analyze_funnel(api=api, filters=filters, funnel_details=funnel_details, prob_th=prob_th,
+                                 aggregated_data=counts.to_dict())
+        return
+
+    store = CountsStore()
+    for discriminants, splitted in segmented.items():
+        for cohorts_, counts in splitted.items():
+            store.add(funnel_details['ID'], OrderedDict(zip(discriminants, cohorts_)), counts)
+    yield from analyze_funnel_store(store, filters_list, funnel_details, prob_th=prob_th)
+
+
+@timed()
+def analyze_funnel_store(store: CountsStore, filters_list: list, funnel_details: dict,
+                         prob_th: float = 0.95) -> list:
+    """
+    This function makes the same analysis of `analyze_funnel` for many cohorts, with the data already gathered
+    in a `mixbaba.counts_utils.CountsStore`: the numbers of all the cohorts are extracted at once, and the
+    statistics are calculated on whole columns. Breakdowns are not supported.
+
+    Note that `analyze_funnel` has to be run once on the funnel before, because the first run fills
+    the names of the groups in `funnel_details`.
+
+    :param store: the store with the counts
+    :param filters_list: a list with the filters selecting the cohorts, one analysis for each of them
+    :param funnel_details: the dict with the details of the funnel
+    :param prob_th: optional, the probability threshold to accept the hypothesis
+    :return: a list with the results, in the same order of `filters_list`
+    """
+    funnel_id = funnel_details['ID']
+    ab_groups = funnel_details['AB Groups']
+    test_groups = [g_name for g_key, g_name in ab_groups.items() if g_key.startswith('Test')]
+    control_groups = [ab_groups[g_key] for g_key in ('Control', 'Control2') if g_key in ab_groups]
+    groups = control_groups + test_groups
+
+    # a row for each cohort, a column for each group
+    imps = store.extract(funnel_id, filters_list, groups, funnel_details['Impression field name'])
+    convs = store.extract(funnel_id, filters_list, groups, funnel_details['Conversion field name'])
+
+    results = []
+    for filters in filters_list:
+        discriminant, cohort = create_fg_names(filters)
+        results.append(OrderedDict({'Discriminant': discriminant, 'Cohort': cohort, 'Comment': " "}))
+    imps_ctrl, convs_ctrl = imps[:, 0], convs[:, 0]
+    for result, imp, conv in zip(results, imps_ctrl, convs_ctrl):
+        result['Control Impressions'] = imp
+        result['Control Conversions'] = conv
+
+    # the cohorts which have been analyzed till the end
+    valid = np.ones(len(filters_list), dtype=bool)
+    if 'Control2' in ab_groups:
+        imps_ctrl2, convs_ctrl2 = imps[:, 1], convs[:, 1]
+        for result, imp, conv in zip(results, imps_ctrl2, convs_ctrl2):
+            result['Control2 Impressions'] = imp
+            result['Control2 Conversions'] = conv
+        _, prob = make_ab_analysis_many(imps_ctrl, convs_ctrl, imps_ctrl2, convs_ctrl2)
+        with np.errstate(invalid='ignore'):
+            # 0.40 Number to be studied!! (see `analyze_funnel`)
+            valid = np.abs(prob - 0.5) < 0.40
+        # the two control options are compatible, so we can sum up the numbers
+        imps_ctrl, convs_ctrl = imps_ctrl + imps_ctrl2, convs_ctrl + convs_ctrl2
+        for result in itertools.compress(results, ~valid):
+            result['Comment'] = "The two control options appear different!"
+    results_valid = list(itertools.compress(results, valid))
+    imps_ctrl, convs_ctrl = imps_ctrl[valid], convs_ctrl[valid]
+
+    first_test = len(control_groups)
+    for i_test, test_g_name in enumerate(test_groups):
+        imps_test, convs_test = imps[valid, first_test + i_test], convs[valid, first_test + i_test]
+        a_ctrl, b_ctrl = convs_ctrl + 1, imps_ctrl - convs_ctrl + 1
+        a_test, b_test = convs_test + 1, imps_test - convs_test + 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prob, lift, err = calc_prob_between_many(a_ctrl, b_ctrl, a_test, b_test, return_error=True)
+            loss = calc_expected_loss_many(a_ctrl, b_ctrl, a_test, b_test)
+            no_convs = convs_test < 1
+        for i, result in enumerate(results_valid):
+            result[f"{test_g_name} Impressions"] = imps_test[i]
+            result[f"{test_g_name} Conversions"] = convs_test[i]
+            if no_convs[i]:
+                result['Comment'] += "No conversions for %s!" % test_g_name
+                continue
+            if prob[i] > prob_th:
+                result['Comment'] += 'Result for %s is OK! ' % test_g_name
+            else:
+                result['Comment'] += 'Result for %s is uncertain.' % test_g_name
+            result['%s CR improvement' % test_g_name] = lift[i]
+            result['%s Probability' % test_g_name] = prob[i]
+            result['%s Expected loss' % test_g_name] = loss[i]
+            if err[i] > 0:
+                # the probability comes from the approximation, so we give also its error estimate
+                result['%s Probability error' % test_g_name] = err[i]
+
+    if len(test_groups) > 1:
+        # with several test groups we can also tell which one is the best
+        arms_names = ['Control'] + test_groups
+        arms_imps = np.column_stack([imps_ctrl, imps[valid, first_test:]])
+        arms_convs = np.column_stack([convs_ctrl, convs[valid, first_test:]])
+        for result, probs_best in zip(results_valid, make_best_analysis_many(arms_imps, arms_convs)):
+            for arm_name, prob_best in zip(arms_names, probs_best):
+                result['%s Probability to be best' % arm_name] = prob_best
+    return results
+
+
+def iter_combinations(filters: dict, is_viable=None, min_depth: int = 2, max_depth: int = None):
+    """
+    This function walk the combinations of the filters from the coarse to the fine ones: first all the couples of
+    discriminants, then the triples, and so on. A combination is skipped if any of the combinations it is made of
+    (e.g. a single cohort, or a couple) is not viable: it would have even less data.
+    Since the combinations are created one at a time, `is_viable` can use the results of those already given.
+
+    :param filters: a dict containing the filters, with the discriminants as keys and the lists of cohorts as values
+    :param is_viable: optional, a function which takes a combination and returns False if it has too few data
+        (and True also if it has not been analyzed)
+    :param min_depth: the minimum number of discriminants in a combination
+    :param max_depth: optional, the maximum number of discriminants in a combination (by default, all of them)
+    :return: a generator of the combinations, as dicts like {"user.goal": "PREVENT", "user.$country_code": "US"}
+    """
+    if max_depth is None:
+        max_depth = len(filters)
+    for depth in range(max(min_depth, 1), max_depth + 1):
+        # the cohorts are walked in the order of the former np.meshgrid: the last discriminant changes slowest,
+        # then the previous ones, and the first two are swapped (so with two discriminants the second is the fastest)
+        order = list(range(depth - 1, 1, -1)) + [0, 1][:depth]
+        for discriminants in itertools.combinations(filters.keys(), depth):
+            for values in itertools.product(*[filters[discriminants[i]] for i in order]):
+                cohorts = [None] * depth
+                for i, value in zip(order, values):
+                    cohorts[i] = value
+                combination = OrderedDict(zip(discriminants, cohorts))
+                if is_viable is not None and not all(
+                        is_viable(OrderedDict(part)) for size in range(1, depth)
+                        for part in itertools.combinations(combination.items(), size)):
+                    continue
+                yield combination
+
+
 def get_combinations(filters: dict) -> list:
     """
     Given that the cross-filtering option has been specified, this function create the combinations of the filters.
@@ -402,14 +1129,26 @@ def get_combinations(filters: dict) -> list:
     :param filters: a dict containing the filters
     :return: a list with all the combinations
     """
-    unrolled_filters = [[discriminant + ':' + cohort for cohort in cohorts] for discriminant, cohorts in
-                        filters.items()]
-    combinations = np.array(np.meshgrid(*unrolled_filters)).T.reshape(-1, len(filters))
-    comb_dicted = []
-    for comb in combinations:
-        tmb_comb = {}
-        for flt_val in comb:
-            tmp_flt, tmp_val = flt_val.split(":")
-            tmb_comb[tmp_flt] = tmp_val
-        comb_dicted.append(tmb_comb)
-    return comb_dicted
+    return [dict(combination) for combination in iter_combinations(filters, min_depth=len(filters))]
+
+
+def is_above_floor(result: dict, min_impressions: float = 0, min_conversions: float = 0) -> bool:
+    """
+    This function check if all the groups in a result of `analyze_funnel` have enough impressions and conversions.
+    A missing number counts as too low.
+
+    :param result: the result of `analyze_funnel`
+    :param min_impressions: the minimum number of impressions of each group
+    :param min_conversions: the minimum number of conversions of each group
+    :return: True if all the groups are above the floor
+    """
+    for key, value in result.items():
+        if key.endswith(' Impressions'):
+            floor = min_impressions
+        elif key.endswith(' Conversions'):
+            floor = min_conversions
+        else:
+            continue
+        if not value >= floor:
+            return False
+    return True
@@ -1,6 +1,8 @@
-import pandas as pd
+from collections import OrderedDict
+import os
+import numpy as np
 from tqdm import tqdm
-from tabulate import tabulate
+from mixbaba.metrics import timed
 
 
 class Bcolors:
@@ -20,8 +22,13 @@ def print_form(str2print, how='b') -> str:
 
 
 def return_long_output(what: list, where: str, f_id: int, ab_groups: dict, fun_name: str):
+    # pandas and tabulate are slow to load, so they are imported only when needed
+    import pandas as pd
+    from tabulate import tabulate
+
     # create a DataFrame for convenience
     df = pd.DataFrame(what)
+    df = add_uplift_intervals(df, ab_groups)
 
     if where == "terminal" or where == "both":
         tqdm.write("-----------------------------------------------------")
@@ -41,6 +48,45 @@ def return_long_output(what: list, where: str, f_id: int, ab_groups: dict, fun_n
         df.to_csv(filename)
 
 
+def add_uplift_intervals(df, ab_groups: dict, level: float = 0.95):
+    """
+    This function add to the results the credible intervals of the CR improvement of each test group,
+    calculated at once for all the rows. The new columns are put just after the CR improvement.
+
+    :param df: the DataFrame with the results
+    :param ab_groups: the dict with the names of the groups
+    :param level: the probability contained in the intervals
+    :return: the updated DataFrame
+    """
+    from mixbaba.beta_utils import calc_uplift_interval
+
+    imps_ctrl = df['Control Impressions'].to_numpy(dtype=np.float64)
+    convs_ctrl = df['Control Conversions'].to_numpy(dtype=np.float64)
+    if 'Control2 Impressions' in df.columns:
+        # where the analysis has been made, the two control groups have been summed up
+        imps_ctrl = imps_ctrl + df['Control2 Impressions'].to_numpy(dtype=np.float64)
+        convs_ctrl = convs_ctrl + df['Control2 Conversions'].to_numpy(dtype=np.float64)
+
+    for g_key, test_g_name in ab_groups.items():
+        cr_column = f'{test_g_name} CR improvement'
+        if not g_key.startswith('Test') or cr_column not in df.columns:
+            continue
+        imps_test = df[f'{test_g_name} Impressions'].to_numpy(dtype=np.float64)
+        convs_test = df[f'{test_g_name} Conversions'].to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            low, high = calc_uplift_interval(convs_ctrl + 1, imps_ctrl - convs_ctrl + 1,
+                                             convs_test + 1, imps_test - convs_test + 1, level=level)
+        # no interval where there is no CR improvement
+        missing = df[cr_column].isna().to_numpy()
+        low[missing] = np.nan
+        high[missing] = np.nan
+
+        position = df.columns.get_loc(cr_column) + 1
+        df.insert(position, f'{test_g_name} CR improvement high', high)
+        df.insert(position, f'{test_g_name} CR improvement low', low)
+    return df
+
+
 def create_group(row):
     if row['Discriminant'] == 'None':
         return 'All.' + row['Cohort']
@@ -57,10 +103,79 @@ def create_group(row):
         return row['Discriminant'].split('.')[1] + "." + row['Cohort']
 
 
+def group_labels(discriminants, cohorts):
+    """
+    This function make the names of the cohorts (as `create_group` does for a row) for all the rows at once,
+    e.g. "goal.PREVENT" for the discriminant "user.goal" and the cohort "PREVENT", or "All.All" without filters
+
+    :param discriminants: a pandas Series with the discriminants (see `mixbaba.mixbaba_utils.create_fg_names`)
+    :param cohorts: a pandas Series with the cohorts, aligned with the discriminants
+    :return: a pandas Series with the names
+    """
+    import pandas as pd
+
+    discriminants = pd.Series(discriminants, dtype=object).reset_index(drop=True)
+    cohorts = pd.Series(cohorts, dtype=object).reset_index(drop=True)
+    labels = ('All.' + cohorts).astype(object)
+    filtered = discriminants != 'None'
+    if not filtered.any():
+        return labels
+
+    # one row for each filter of a combination, in order
+    names = discriminants[filtered].str.split('+').explode().str.split('.').str[1]
+    values = cohorts[filtered].str.split('+').explode()
+    parts = (names + '.' + values).to_frame('part')
+    parts['position'] = parts.groupby(level=0).cumcount()
+    parts = parts.set_index('position', append=True)['part'].unstack()
+
+    combined = parts[0]
+    for position in parts.columns[1:]:
+        more = parts[position].notna()
+        combined = combined.where(~more, combined + '+' + parts[position])
+    labels[filtered] = combined
+    return labels
+
+
+@timed()
+def create_plot_jobs(what: list, f_id: int, ab_groups: dict, folder: str, frmt: str = 'png') -> list:
+    """
+    This function prepare the jobs for `mixbaba.beta_utils.render_posteriors`: one plot for each row
+    of the results, with the posterior distributions of all the groups
+
+    :param what: the list with the results (see `analyze_funnel`)
+    :param f_id: the funnel ID
+    :param ab_groups: the dict with the names of the groups
+    :param folder: the folder where the plots will be saved
+    :param frmt: the format of the plots (png or svg)
+    :return: a list with the jobs
+    """
+    groups = ['Control'] + ['Control2'] * ('Control2' in ab_groups) + \
+        [g_name for g_key, g_name in ab_groups.items() if g_key.startswith('Test')]
+    jobs = []
+    for row in what:
+        params = []
+        names = []
+        for group in groups:
+            imps = row.get(f"{group} Impressions", np.nan)
+            convs = row.get(f"{group} Conversions", np.nan)
+            if not (np.isnan(imps) or np.isnan(convs)):
+                params.append((convs + 1, imps - convs + 1))
+                names.append(group)
+        if len(params) > 0:
+            label = create_group(row).replace(os.sep, '_')
+            jobs.append((os.path.join(folder, f'{f_id}-{label}.{frmt}'), params, names))
+    return jobs
+
+
 def return_short_output(what, where, f_id, ab_groups, fun_name):
+    # pandas and tabulate are slow to load, so they are imported only when needed
+    import pandas as pd
+    from tabulate import tabulate
+
     # create a DataFrame for convenience
     df = pd.DataFrame(what)
-    df['Group'] = df.apply(lambda row: create_group(row), axis=1)
+    df = add_uplift_intervals(df, ab_groups)
+    df['Group'] = group_labels(df['Discriminant'], df['Cohort']).to_numpy()
 
     df.drop(columns=['Comment', 'Discriminant', 'Cohort'], inplace=True)
     cols = df.columns.tolist()
@@ -85,8 +200,135 @@ def return_short_output(what, where, f_id, ab_groups, fun_name):
     pass
 
 
+@timed()
 def return_output(what: list, where: str, how: str, f_id: int, ab_groups: dict, fun_name: str):
     if how == 'long':
         return_long_output(what=what, where=where, f_id=f_id, ab_groups=ab_groups, fun_name=fun_name)
     elif how == 'short':
         return_short_output(what=what, where=where, f_id=f_id, ab_groups=ab_groups, fun_name=fun_name)
+
+
+# the formats of the results table, by the extension of its file
+TABLE_FORMATS = OrderedDict([('.parquet', 'parquet'), ('.feather', 'feather'), ('.arrow', 'feather'),
+                             ('.jsonl', 'jsonl'), ('.jsonl.gz', 'jsonl')])
+
+# the columns of the results table of each test group, and those of the results where they come from
+TABLE_TEST_COLUMNS = OrderedDict([('test_impressions', 'Impressions'), ('test_conversions', 'Conversions'),
+                                  ('cr_improvement', 'CR improvement'),
+                                  ('cr_improvement_low', 'CR improvement low'),
+                                  ('cr_improvement_high', 'CR improvement high'),
+                                  ('probability', 'Probability'), ('probability_error', 'Probability error'),
+                                  ('expected_loss', 'Expected loss'),
+                                  ('probability_to_be_best', 'Probability to be best')])
+TABLE_CONTROL_COLUMNS = OrderedDict([('control_impressions', 'Control Impressions'),
+                                     ('control_conversions', 'Control Conversions'),
+                                     ('control2_impressions', 'Control2 Impressions'),
+                                     ('control2_conversions', 'Control2 Conversions'),
+                                     ('control_probability_to_be_best', 'Control Probability to be best')])
+TABLE_COUNTS = ['control_impressions', 'control_conversions', 'control2_impressions', 'control2_conversions',
+                'test_impressions', 'test_conversions']
+
+
+def table_format(filename: str) -> str:
+    """
+    This function tell the format of the results table from the extension of its file
+
+    :param filename: the file
+    :return: 'parquet', 'feather' or 'jsonl'
+    """
+    for extension, frmt in sorted(TABLE_FORMATS.items(), key=lambda item: -len(item[0])):
+        if filename.lower().endswith(extension):
+            return frmt
+    raise ValueError(f"Unknown format of the results table {filename}, its extension should be one between "
+                     f"{', '.join(TABLE_FORMATS)}")
+
+
+class ResultsTable(object):
+    """
+    A single table with the results of all the funnels, one row for each funnel, cohort and test group, with
+    the same columns whatever the names of the groups are. It is saved in a columnar format (Parquet or Feather,
+    which need pyarrow, compressed with zstd) or as JSON lines (gzipped if the file ends with .gz).
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: the file of the table; its extension gives the format (see `TABLE_FORMATS`)
+        """
+        self.filename = filename
+        self.format = table_format(filename)
+        if self.format in ('parquet', 'feather'):
+            # better to know it now than at the end of the run
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError(f"pyarrow is needed to write {filename} (pip install mixbaba[table]), "
+                                  f"otherwise the table can be written as .jsonl")
+        self.frames = []
+
+    def add(self, what: list, f_id: int, ab_groups: dict, fun_name: str):
+        """
+        This function add the results of a funnel to the table
+
+        :param what: the list with the results (see `analyze_funnel`)
+        :param f_id: the funnel ID
+        :param ab_groups: the dict with the names of the groups
+        :param fun_name: the name of the funnel
+        """
+        import pandas as pd
+
+        df = pd.DataFrame(what)
+        df = add_uplift_intervals(df, ab_groups)
+        n_rows = len(df)
+        common = OrderedDict([('funnel_id', np.full(n_rows, f_id, dtype=np.int64)),
+                              ('funnel_name', np.full(n_rows, fun_name, dtype=object)),
+                              ('group', group_labels(df['Discriminant'], df['Cohort']).to_numpy()),
+                              ('discriminant', df['Discriminant'].to_numpy(dtype=object)),
+                              ('cohort', df['Cohort'].to_numpy(dtype=object))])
+        controls = df.reindex(columns=list(TABLE_CONTROL_COLUMNS.values())).to_numpy(dtype=np.float64)
+        comments = df['Comment'].str.strip().to_numpy(dtype=object)
+
+        test_groups = [g_name for g_key, g_name in ab_groups.items() if g_key.startswith('Test')]
+        frames = []
+        for position, test_g_name in enumerate(test_groups):
+            columns = OrderedDict(common)
+            columns['test_group'] = np.full(n_rows, test_g_name, dtype=object)
+            columns.update(zip(TABLE_CONTROL_COLUMNS, controls.T))
+            tests = df.reindex(columns=[f'{test_g_name} {column}' for column in TABLE_TEST_COLUMNS.values()])
+            columns.update(zip(TABLE_TEST_COLUMNS, tests.to_numpy(dtype=np.float64).T))
+            columns['comment'] = comments
+            # the index keeps the test groups of a result together, once the frames are sorted
+            frames.append(pd.DataFrame(columns, index=np.arange(n_rows) * len(test_groups) + position))
+        if len(frames) > 0:
+            self.frames.append(pd.concat(frames).sort_index())
+
+    def to_frame(self):
+        """
+        This function return the table
+
+        :return: a pandas DataFrame
+        """
+        import pandas as pd
+
+        if len(self.frames) > 0:
+            df = pd.concat(self.frames, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=['funnel_id', 'funnel_name', 'group', 'discriminant', 'cohort', 'test_group'] +
+                              list(TABLE_CONTROL_COLUMNS) + list(TABLE_TEST_COLUMNS) + ['comment'])
+        for column in TABLE_COUNTS:
+            df[column] = df[column].astype('Int64')
+        return df
+
+    def save(self) -> int:
+        """
+        This function write the table in its file
+
+        :return: the number of the rows
+        """
+        df = self.to_frame()
+        if self.format == 'parquet':
+            df.to_parquet(self.filename, compression='zstd', index=False)
+        elif self.format == 'feather':
+            df.to_feather(self.filename, compression='zstd')
+        else:
+            df.to_json(self.filename, orient='records', lines=True, compression='infer')
+        return len(df)
@@ -0,0 +1,119 @@
+from collections import Counter, OrderedDict
+from mixbaba.cache_utils import query_key
+from mixbaba.mixbaba_utils import create_funnel_query, create_segmented_query, create_breakdown_filters, \
+    get_combinations, iter_combinations
+
+
+class QueryPlan(object):
+    """
+    The queries to Mixpanel needed by a run, with the number of times each one is made
+    """
+
+    def __init__(self):
+        # for each query, the funnel it is made for (None for the list of funnels) and its key
+        self.queries = []
+        self.uses = Counter()
+        # what cannot be known before the run
+        self.notes = []
+
+    def add(self, funnel_id, methods: list, params: dict, frmt: str = 'json'):
+        """
+        This function add a query to the plan
+
+        :param funnel_id: the funnel the query is made for, or None
+        :param methods: the methods of the query
+        :param params: the parameters of the query
+        :param frmt: the format of the response (see `mixbaba.mixbaba_utils.MixpanelAPI.fetch`)
+        """
+        key = query_key(methods, dict(params, format=frmt))
+        self.queries.append((funnel_id, key))
+        self.uses[key] += 1
+
+    @property
+    def n_planned(self) -> int:
+        return len(self.queries)
+
+    @property
+    def n_unique(self) -> int:
+        return len(self.uses)
+
+    def summary(self) -> OrderedDict:
+        """
+        This function count the queries of each funnel
+
+        :return: an OrderedDict with the funnel as key, and a tuple (planned queries, unique queries) as value
+        """
+        keys = OrderedDict()
+        for funnel_id, key in self.queries:
+            keys.setdefault(funnel_id, []).append(key)
+        return OrderedDict((funnel_id, (len(f_keys), len(set(f_keys)))) for funnel_id, f_keys in keys.items())
+
+    def report(self) -> str:
+        """
+        This function describe the plan
+
+        :return: a text with a line for each funnel, and the totals
+        """
+        lines = []
+        for funnel_id, (planned, unique) in self.summary().items():
+            name = "the list of the funnels" if funnel_id is None else f"funnel {funnel_id}"
+            lines.append(f"{name}: {planned} queries ({unique} unique)")
+        lines.append(f"total: {self.n_planned} queries planned, {self.n_unique} to be made")
+        lines += [f"note: {note}" for note in self.notes]
+        return '\n'.join(lines)
+
+
+def plan_run(funnels: list, crossed: bool = False, consolidate: bool = False, all_depths: bool = False) -> QueryPlan:
+    """
+    This function list all the queries a run is going to make, as the command line tool makes them:
+    the overall analysis, the single filters and (with `crossed`) their combinations, and the breakdowns.
+    The combinations skipped because of too few data (see `mixbaba.mixbaba_utils.iter_combinations`) cannot be known
+    in advance, so they are counted as made, while the cohorts that a segmented query leaves out and that are asked
+    again one by one (see `mixbaba.mixbaba_utils.analyze_funnel_consolidated`) are not counted.
+
+    :param funnels: the list with the details of the funnels (the content of the JSON file)
+    :param crossed: whether the combinations of the filters are analyzed
+    :param consolidate: whether the cohorts are asked with a query for each set of discriminants
+    :param all_depths: whether the combinations of fewer discriminants (couples, triples, ...) are analyzed too,
+        and not only those of all of them
+    :return: the plan
+    """
+    plan = QueryPlan()
+    plan.add(None, ["funnels/list"], {})
+
+    for funnel_details in funnels:
+        funnel_id = funnel_details['ID']
+        dates = {'funnel_id': funnel_id, 'from_date': funnel_details['From Date'],
+                 'to_date': funnel_details['To Date']}
+        by = funnel_details['By']
+        filters = funnel_details.get('filters', {})
+
+        filters_list = [{discriminant: cohort} for discriminant, cohorts in filters.items() for cohort in cohorts]
+        if crossed:
+            if all_depths:
+                filters_list += [dict(combination) for combination in iter_combinations(filters)]
+            else:
+                filters_list += get_combinations(filters)
+
+        plan.add(funnel_id, ["funnels"], create_funnel_query(filters={'None': 'All'}, by=by, **dates))
+        if consolidate:
+            for discriminants in OrderedDict.fromkeys(tuple(f.keys()) for f in filters_list):
+                plan.add(funnel_id, ["funnels"], create_segmented_query(
+                    discriminants=list(discriminants), by=by,
+                    cohorts={discriminant: filters[discriminant] for discriminant in discriminants}, **dates))
+        else:
+            for cohort_filters in filters_list:
+                plan.add(funnel_id, ["funnels"], create_funnel_query(filters=cohort_filters, by=by, **dates))
+
+        if 'Breakdowns' in funnel_details:
+            if 'AB Groups' not in funnel_details:
+                plan.notes.append(f"the breakdowns of the funnel {funnel_id} are not counted, since the names of "
+                                  f"the groups will be found in the data")
+                continue
+            for cohort_filters in [{'None': 'All'}] + filters_list:
+                for ab_group in funnel_details['AB Groups'].values():
+                    brk_filters = create_breakdown_filters(cohort_filters, by, ab_group)
+                    for brk_type in funnel_details['Breakdowns']:
+                        plan.add(funnel_id, ["funnels"], create_funnel_query(filters=brk_filters, by=brk_type,
+                                                                            **dates))
+    return plan
@@ -0,0 +1,195 @@
+from email.utils import parsedate_to_datetime
+import datetime
+import http.client
+import random
+import threading
+import time
+import urllib.error
+
+# the statuses after which a request is tried again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value, now: datetime.datetime = None):
+    """
+    This function read the Retry-After header, which can be a number of seconds or a date
+
+    :param value: the value of the header (or None)
+    :param now: optional, the current time (UTC)
+    :return: the seconds to wait, or None if the header is missing or invalid
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max((date - now).total_seconds(), 0.)
+
+
+class RateGovernor(object):
+    """
+    The governor of the requests to Mixpanel. It respects the limits of the query API (by default 60 queries per
+    hour, with a token bucket, and 5 concurrent queries), waits as asked by Retry-After, retries the throttled or
+    failed requests with exponential backoff and jitter, and adapts the number of requests in flight:
+    it grows by one every `limit` successes and it is halved after an error (additive increase,
+    multiplicative decrease), and it does not grow while the latency is much higher than usual.
+    """
+
+    def __init__(self, per_hour: float = 60, max_concurrency: int = 5, max_retries: int = 5,
+                 base_backoff: float = 1., max_backoff: float = 300., slow_factor: float = 2.,
+                 clock=time.monotonic, sleep=time.sleep, rand=random.random):
+        """
+        :param per_hour: the maximum number of requests in an hour (also the largest burst)
+        :param max_concurrency: the maximum number of requests in flight
+        :param max_retries: how many times a failed request is tried again
+        :param base_backoff: the wait, in seconds, before the first retry (it doubles at each retry)
+        :param max_backoff: the maximum wait, in seconds, before a retry
+        :param slow_factor: how much slower than the average a response has to be to stop the growth of concurrency
+        :param clock: the function returning the current time, in seconds
+        :param sleep: the function to wait, in seconds
+        :param rand: the function returning a random number in [0, 1), for the jitter
+        """
+        self.capacity = float(per_hour)
+        self.rate = per_hour / 3600.
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.slow_factor = slow_factor
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+
+        self.condition = threading.Condition()
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.blocked_until = 0.
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.mean_latency = None
+
+        self.n_retries = 0
+        self.n_throttled = 0
+        self.waited = 0.
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        This function wait until a request can be made: a slot of concurrency and a token have to be available,
+        and the server must not have asked to wait
+        """
+        with self.condition:
+            while True:
+                while self.in_flight >= max(int(self.limit), 1):
+                    self.condition.wait()
+                now = self.clock()
+                self.refill(now)
+                wait = max(self.blocked_until - now, (1. - self.tokens) / self.rate if self.tokens < 1. else 0.)
+                if wait <= 0.:
+                    self.tokens -= 1.
+                    self.in_flight += 1
+                    return
+                # waiting without the lock, so that the other threads can release their slots
+                self.condition.release()
+                try:
+                    self.sleep(wait)
+                finally:
+                    self.condition.acquire()
+                self.waited += wait
+
+    def release(self, latency: float = None, error: bool = False, retry_after: float = None, throttled: bool = False):
+        """
+        This function free the slot of a request, and use its outcome to tune the concurrency
+
+        :param latency: the time the request took, in seconds
+        :param error: whether the request failed (throttled, server error or broken connection)
+        :param retry_after: the seconds the server asked to wait, if any
+        :param throttled: whether the server refused the request because of the rate limits
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = self.clock()
+            if error:
+                self.limit = max(self.limit / 2., 1.)
+            elif latency is not None:
+                if self.mean_latency is None or latency <= self.slow_factor * self.mean_latency:
+                    self.limit = min(self.limit + 1. / self.limit, float(self.max_concurrency))
+                self.mean_latency = latency if self.mean_latency is None else \
+                    0.8 * self.mean_latency + 0.2 * latency
+            if throttled:
+                self.n_throttled += 1
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif throttled:
+                # the hourly budget is over for the server, whatever we counted, and it did not say how long to wait
+                self.refill(now)
+                self.tokens = min(self.tokens, 0.)
+            self.condition.notify_all()
+
+    def backoff(self, attempt: int) -> float:
+        """
+        This function return the wait before a retry: exponential in the number of attempts, with a random jitter
+
+        :param attempt: the number of the failed attempts so far (from 1)
+        :return: the seconds to wait
+        """
+        delay = min(self.base_backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * (0.5 + 0.5 * self.rand())
+
+    def call(self, function):
+        """
+        This function run a request through the governor, trying it again if it is throttled or it fails.
+        The errors which are not worth a retry (e.g. 404), or the last one, are raised.
+
+        :param function: the function making the request, which raises `urllib.error.HTTPError` for error statuses
+        :return: what the function returns
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            start = self.clock()
+            try:
+                result = function()
+            except urllib.error.HTTPError as e:
+                retryable = e.code in RETRY_STATUSES
+                retry_after = parse_retry_after(e.headers.get('Retry-After')) if e.headers is not None else None
+                self.release(error=retryable, retry_after=retry_after, throttled=e.code == 429)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+            except (http.client.HTTPException, OSError):
+                self.release(error=True)
+                if attempt >= self.max_retries:
+                    raise
+            except BaseException:
+                self.release()
+                raise
+            else:
+                self.release(latency=self.clock() - start)
+                return result
+            attempt += 1
+            with self.condition:
+                self.n_retries += 1
+            wait = self.backoff(attempt)
+            self.sleep(wait)
+            with self.condition:
+                self.waited += wait
+
+    def stats(self) -> dict:
+        """
+        This function return the statistics about the governed requests
+
+        :return: a dict with the number of retries and of throttled requests, the total wait (in seconds)
+            and the actual limit of concurrency
+        """
+        with self.condition:
+            return {'retries': self.n_retries, 'throttled': self.n_throttled, 'waited': self.waited,
+                    'concurrency': self.limit}
@@ -37,6 +37,13 @@ setuptools.setup(
         "tabulate"
     ],
 
+    extras_require={
+        "fast": ["orjson"],
+        "stream": ["ijson>=3.1"],
+        "bench": ["mpmath"],
+        "table": ["pyarrow"]
+    },
+
     tests_require=['nose'],
 
     test_suite="tests",
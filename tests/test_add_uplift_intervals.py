@@ -0,0 +1,26 @@
+from unittest import TestCase
+import pandas as pd
+from mixbaba.output_utils import add_uplift_intervals
+import numpy as np
+
+
+class TestAdd_uplift_intervals(TestCase):
+
+    def test_add_uplift_intervals(self):
+        """
+        Checks the intervals against a Monte Carlo simulation, and that they are missing where the CR improvement is
+        """
+        df = pd.DataFrame([{'Control Impressions': 10000, 'Control Conversions': 100, 'test Impressions': 10000,
+                            'test Conversions': 120, 'test CR improvement': 0.198, 'test Probability': 0.912},
+                           {'Control Impressions': 300, 'Control Conversions': 0, 'test Impressions': 298,
+                            'test Conversions': 0, 'test CR improvement': np.nan, 'test Probability': np.nan}])
+        df = add_uplift_intervals(df, {'Control': 'control', 'Test': 'test'})
+        self.assertEqual(df.columns.tolist()[4:7], ['test CR improvement', 'test CR improvement low',
+                                                    'test CR improvement high'])
+
+        rng = np.random.RandomState(42)
+        uplift = rng.beta(121, 9881, size=2000000) / rng.beta(101, 9901, size=2000000) - 1
+        expected = np.quantile(uplift, [0.025, 0.975])
+        self.assertTrue(np.allclose(df.loc[0, ['test CR improvement low', 'test CR improvement high']].to_numpy(
+            dtype=float), expected, atol=2e-3))
+        self.assertTrue(np.isnan(df.loc[1, 'test CR improvement low']))
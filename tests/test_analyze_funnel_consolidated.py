@@ -0,0 +1,122 @@
+from unittest import TestCase
+import copy
+import json
+import os
+import re
+from mixbaba.mixbaba_utils import analyze_funnel, analyze_funnel_many, analyze_funnel_consolidated, \
+    get_combinations, SEGMENT_SEPARATOR
+
+
+class SegmentingAPI(object):
+    """
+    A stand-in for the Mixpanel connector, where the counts of each cohort are the ones of the mock response
+    multiplied by a different number. It answers both the queries filtered with `where` and the segmented ones.
+    """
+    filters = {'user.goal': ['PREVENT', 'PLAN'], 'user.$country_code': ['US', 'UK', 'SE']}
+
+    def __init__(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_resp.json"), 'r') as f:
+            self.response = json.load(f)
+        self.queries = []
+
+    def factor(self, cohorts: dict) -> int:
+        factor = 1
+        for discriminant, cohort in cohorts.items():
+            factor *= 2 + self.filters[discriminant].index(cohort)
+        return factor
+
+    def scaled(self, content: list, factor: int) -> list:
+        content = copy.deepcopy(content)
+        for step in content:
+            step['count'] *= factor
+        return content
+
+    def request(self, methods, params, http_method='GET', frmt='json'):
+        self.queries.append(params)
+        response = copy.deepcopy(self.response)
+        if SEGMENT_SEPARATOR not in params['on']:
+            cohorts = {f'{d_type}.{d_val}': cohort for cohort, d_type, d_val in
+                       re.findall(r'\("([^"]*)" in (\w+)\["([^"]*)"\]\)', params.get('where', ''))}
+            for date, data in response['data'].items():
+                if any(cohort not in self.filters[discriminant] for discriminant, cohort in cohorts.items()):
+                    # a cohort without any data
+                    data.clear()
+                for group in data:
+                    data[group] = self.scaled(data[group], self.factor(cohorts))
+            return response
+
+        discriminants = [f'{d_type}.{d_val}' for d_type, d_val in
+                         re.findall(r'string\((\w+)\["([^"]*)"\]\)', params['on'])[1:]]
+        combinations = get_combinations({d: self.filters[d] for d in discriminants})
+        for date, data in response['data'].items():
+            segmented = {}
+            for group, content in data.items():
+                if group == '$overall':
+                    segmented[group] = content
+                    continue
+                for cohorts in combinations:
+                    segment = SEGMENT_SEPARATOR.join([group] + [cohorts[d] for d in discriminants])
+                    segmented[segment] = self.scaled(content, self.factor(cohorts))
+            response['data'][date] = segmented
+        return response
+
+    def fetch(self, methods, params, http_method='GET', frmt='json'):
+        return json.dumps(self.request(methods, params, http_method=http_method, frmt=frmt)).encode()
+
+
+class TestAnalyze_funnel_consolidated(TestCase):
+    funnel_details = {"ID": 1, "From Date": "2018-01-28", "To Date": "2018-12-28",
+                      "Impression field name": "AB-MONTHLYTHERM-IMPRESSION", "Conversion field name": "Payment",
+                      "By": "properties.assignment"}
+
+    def test_analyze_funnel_consolidated(self):
+        """
+        Checks that the consolidated queries give the same results as one query for each cohort,
+        with one query for each set of discriminants
+        """
+        api = SegmentingAPI()
+        funnel_details = copy.deepcopy(self.funnel_details)
+        analyze_funnel(api=api, filters={'None': 'All'}, funnel_details=funnel_details)
+        filters_list = [{discriminant: cohort} for discriminant, cohorts in api.filters.items()
+                        for cohort in cohorts] + get_combinations(api.filters)
+
+        api.queries = []
+        expected = list(analyze_funnel_many(api, filters_list, funnel_details))
+        self.assertEqual(len(api.queries), len(filters_list))
+
+        api.queries = []
+        consolidated = list(analyze_funnel_consolidated(api, filters_list, funnel_details, jobs=2))
+        self.assertEqual(len(api.queries), 3)
+        self.assertEqual(consolidated, expected)
+        self.assertGreater(len({result['Control Impressions'] for result in consolidated}), 1)
+
+    def test_missing_cohort(self):
+        """
+        Checks that a cohort without data gives the same empty result in both the modes
+        """
+        api = SegmentingAPI()
+        funnel_details = copy.deepcopy(self.funnel_details)
+        analyze_funnel(api=api, filters={'None': 'All'}, funnel_details=funnel_details)
+        api.filters = {'user.goal': ['PREVENT']}
+        api.queries = []
+        result, = analyze_funnel_consolidated(api, [{'user.goal': 'PREGNANT'}], funnel_details)
+        self.assertEqual(result['Cohort'], 'PREGNANT')
+        self.assertTrue(all(value != value for key, value in result.items() if key.endswith('Impressions')))
+        # the cohort missing from the segmented response is asked alone
+        self.assertEqual(len(api.queries), 2)
+
+    def test_ambiguous_cohort(self):
+        """
+        Checks that a cohort is asked alone if another value in the segmented response matches it ("US" in "USA"),
+        since the segments would count only the users with exactly that value
+        """
+        api = SegmentingAPI()
+        funnel_details = copy.deepcopy(self.funnel_details)
+        analyze_funnel(api=api, filters={'None': 'All'}, funnel_details=funnel_details)
+        api.filters = {'user.$country_code': ['US', 'USA', 'UK']}
+        filters_list = [{'user.$country_code': 'US'}, {'user.$country_code': 'UK'}]
+        api.queries = []
+        consolidated = list(analyze_funnel_consolidated(api, filters_list, funnel_details))
+        self.assertEqual(len(api.queries), 2)
+        self.assertIn('("US" in user["$country_code"])', api.queries[1]['where'])
+        self.assertEqual(consolidated, list(analyze_funnel_many(api, filters_list, funnel_details)))
@@ -0,0 +1,61 @@
+from unittest import TestCase
+import copy
+import json
+import os
+import threading
+import time
+from mixbaba.mixbaba_utils import analyze_funnel, analyze_funnel_many
+
+
+class SlowAPI(object):
+    """
+    A stand-in for the Mixpanel connector, which answers every query with the mock response after a delay
+    """
+    delay = 0.05
+
+    def __init__(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_resp.json"), 'r') as f:
+            self.response = json.load(f)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def request(self, methods, params, http_method='GET', frmt='json'):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return copy.deepcopy(self.response)
+
+    def fetch(self, methods, params, http_method='GET', frmt='json'):
+        return json.dumps(self.request(methods, params, http_method=http_method, frmt=frmt)).encode()
+
+
+class TestAnalyze_funnel_many(TestCase):
+    funnel_details = {"ID": 1, "From Date": "2018-01-28", "To Date": "2018-12-28",
+                      "Impression field name": "AB-MONTHLYTHERM-IMPRESSION", "Conversion field name": "Payment",
+                      "By": "properties.assignment"}
+
+    def test_analyze_funnel_many(self):
+        """
+        Checks that the concurrent analyses give the same results, in the same order, as the sequential ones
+        """
+        api = SlowAPI()
+        funnel_details = copy.deepcopy(self.funnel_details)
+        analyze_funnel(api=api, filters={'None': 'All'}, funnel_details=funnel_details)
+        filters_list = [{'user.goal': goal} for goal in ['PREVENT', 'PLAN', 'PREGNANT']] + \
+                       [{'user.$country_code': country} for country in ['US', 'UK', 'SE', 'DE']]
+
+        sequential = list(analyze_funnel_many(api, filters_list, funnel_details))
+        self.assertEqual(api.max_in_flight, 1)
+
+        start = time.perf_counter()
+        concurrent = list(analyze_funnel_many(api, filters_list, funnel_details, jobs=7))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(concurrent, sequential)
+        self.assertEqual([result['Cohort'] for result in concurrent], [list(f.values())[0] for f in filters_list])
+        self.assertGreater(api.max_in_flight, 1)
+        self.assertLess(elapsed, len(filters_list) * api.delay)
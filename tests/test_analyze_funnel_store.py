@@ -0,0 +1,67 @@
+from unittest import TestCase
+from collections import OrderedDict
+import numpy as np
+from mixbaba.counts_utils import CountsStore, FunnelCounts
+from mixbaba.mixbaba_utils import analyze_funnel, analyze_funnel_store
+
+
+def make_counts(numbers: dict) -> FunnelCounts:
+    counts = FunnelCounts()
+    counts.add_date({group: [{'step_label': 'Imp', 'count': imps}, {'step_label': 'Pay', 'count': convs}]
+                     for group, (imps, convs) in numbers.items()})
+    return counts
+
+
+class TestAnalyze_funnel_store(TestCase):
+    funnel_details = {"ID": 7, "From Date": "2018-01-28", "To Date": "2018-12-28",
+                      "Impression field name": "Imp", "Conversion field name": "Pay", "By": "properties.assignment",
+                      "AB Groups": {"Control": "control", "Control2": "control2", "Test": "test", "Test2": "test2"}}
+
+    cohorts = OrderedDict([
+        ('US', {'control': (10000, 300), 'control2': (9800, 290), 'test': (10100, 360), 'test2': (9900, 280)}),
+        # the two controls are too different
+        ('UK', {'control': (5000, 100), 'control2': (5000, 200), 'test': (5000, 150), 'test2': (5000, 120)}),
+        # no conversions in a test, and a missing test
+        ('SE', {'control': (800, 20), 'control2': (790, 21), 'test': (810, 0)}),
+        ('DE', {'control': (2000000, 40000), 'control2': (2000000, 40100), 'test': (2000000, 40900),
+                'test2': (2000000, 39000)}),
+    ])
+
+    def test_analyze_funnel_store(self):
+        """
+        Checks that the columnar analysis gives the same results of the analysis of each cohort
+        """
+        store = CountsStore()
+        filters_list = []
+        for country, numbers in self.cohorts.items():
+            filters = {'user.$country_code': country}
+            store.add(self.funnel_details['ID'], filters, make_counts(numbers))
+            filters_list.append(filters)
+        # a cohort without data
+        filters_list.append({'user.$country_code': 'IT'})
+
+        results = analyze_funnel_store(store, filters_list, self.funnel_details)
+        self.assertEqual(len(results), len(filters_list))
+        for filters, result in zip(filters_list, results):
+            numbers = self.cohorts.get(filters['user.$country_code'], {})
+            expected = analyze_funnel(api=None, filters=filters, funnel_details=dict(self.funnel_details),
+                                      aggregated_data=make_counts(numbers).to_dict())
+            self.assertEqual(list(result.keys()), list(expected.keys()))
+            for key, value in expected.items():
+                if isinstance(value, str):
+                    self.assertEqual(result[key], value)
+                else:
+                    np.testing.assert_allclose(result[key], value, rtol=1e-9, atol=1e-12, err_msg=key)
+
+    def test_table(self):
+        store = CountsStore()
+        store.add(1, {'user.goal': 'PLAN'}, make_counts({'control': (10, 1)}))
+        store.add(2, {'user.goal': 'PLAN'}, make_counts({'test': (20, 2)}))
+        table = store.table()
+        self.assertEqual(table.dtype.names, CountsStore.COLUMNS)
+        np.testing.assert_array_equal(table['funnel'], [0, 0, 1, 1])
+        np.testing.assert_array_equal(table['cohort'], [0, 0, 0, 0])
+        np.testing.assert_array_equal(table['group'], [0, 0, 1, 1])
+        np.testing.assert_array_equal(table['count'], [10, 1, 20, 2])
+        np.testing.assert_array_equal(store.extract(2, [{'user.goal': 'PLAN'}], ['control', 'test'], 'Pay'),
+                                      [[np.nan, 2]])
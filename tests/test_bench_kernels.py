@@ -0,0 +1,41 @@
+from unittest import TestCase, skipIf
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import bench_kernels  # noqa: E402
+from mixbaba.beta_utils import g  # noqa: E402
+
+
+class TestBenchKernels(TestCase):
+
+    @skipIf(bench_kernels.mpmath is None, "mpmath is not installed")
+    def test_reference(self):
+        """
+        Checks that the high precision reference agrees with the exact kernel, whatever parameter is the smallest
+        """
+        for a, b, c, d in [(3, 7, 5, 2), (101, 9901, 121, 9881), (40, 1000, 80, 300), (7, 3, 2, 5)]:
+            reference = float(bench_kernels.mp_g(a, b, c, d, max_terms=1e4))
+            self.assertTrue(np.allclose(reference, g(a, b, c, d), rtol=0, atol=1e-11))
+        self.assertIsNone(bench_kernels.mp_g(1e5, 1e5, 1e5, 1e5, max_terms=1e4))
+
+    def test_compare(self):
+        """
+        Checks that only slower kernels, larger allocations and larger errors than the tolerances are regressions
+        """
+        baseline = {'g|1e+02|0.1': {'latency': 1e-5, 'allocations': 100, 'error': 1e-10},
+                    'g|1e+04|0.1': {'latency': 1e-5, 'allocations': 100, 'error': 1e-10}}
+        same = {key: dict(value) for key, value in baseline.items()}
+        self.assertEqual(bench_kernels.compare(same, baseline), [])
+
+        # a single case a bit slower is noise
+        noisy = {key: dict(value) for key, value in baseline.items()}
+        noisy['g|1e+02|0.1']['latency'] = 1.4e-5
+        self.assertEqual(bench_kernels.compare(noisy, baseline), [])
+
+        worse = {'g|1e+02|0.1': {'latency': 3e-5, 'allocations': 5000, 'error': 1e-3},
+                 'g|1e+04|0.1': {'latency': 1e-5, 'allocations': 100, 'error': 1e-10}}
+        regressions = bench_kernels.compare(worse, baseline)
+        self.assertEqual(len(regressions), 4)
+        self.assertTrue(regressions[-1].startswith('g: '))
@@ -0,0 +1,42 @@
+from unittest import TestCase
+from scipy.stats import beta
+from mixbaba.beta_utils import BetaPosterior, calc_prob_between
+from mixbaba.mixbaba_utils import calc_uplift
+import numpy as np
+
+
+class TestBetaPosterior(TestCase):
+
+    def test_same_as_scipy(self):
+        """
+        Checks that the posterior behaves as the frozen scipy distribution
+        """
+        posterior = BetaPosterior.from_counts(10000, 100)
+        reference = beta(101, 9901)
+        x = np.linspace(0.005, 0.015, 11)
+        self.assertEqual(posterior.args, reference.args)
+        self.assertAlmostEqual(posterior.mean(), reference.mean())
+        self.assertAlmostEqual(posterior.var(), reference.var())
+        self.assertTrue(np.allclose(posterior.pdf(x), reference.pdf(x)))
+        self.assertTrue(np.allclose(posterior.logpdf(x), reference.logpdf(x)))
+
+    def test_mixed_with_scipy(self):
+        """
+        Checks that posteriors and scipy distributions can be used together
+        """
+        prob = calc_prob_between(BetaPosterior(80, 300), beta(40, 1000))
+        self.assertAlmostEqual(prob, calc_prob_between(beta(80, 300), beta(40, 1000)))
+        self.assertAlmostEqual(calc_uplift(beta(101, 9901), BetaPosterior(121, 9881)), 0.19801980)
+
+    def test_arrays(self):
+        """
+        Checks that posteriors with arrays of parameters give the same results of the single ones
+        """
+        posterior_1 = BetaPosterior.from_counts([10000, 1561], [100, 5])
+        posterior_2 = BetaPosterior.from_counts([10000, 1411], [120, 5])
+        probs = calc_prob_between(posterior_2, posterior_1)
+        uplifts = calc_uplift(posterior_1, posterior_2)
+        self.assertEqual(len(posterior_1), 2)
+        for i in range(2):
+            self.assertAlmostEqual(probs[i], calc_prob_between(posterior_2[i], posterior_1[i]))
+            self.assertAlmostEqual(uplifts[i], calc_uplift(posterior_1[i], posterior_2[i]))
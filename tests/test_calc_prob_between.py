@@ -1,6 +1,8 @@
 from unittest import TestCase
 from scipy.stats import beta
+from scipy.integrate import quad
 from mixbaba.mixbaba_utils import calc_prob_between
+from mixbaba.beta_utils import g0, hiter
 import numpy as np
 
 class TestCalc_prob_between(TestCase):
@@ -26,3 +28,83 @@ class TestCalc_prob_between(TestCase):
         result = calc_prob_between(beta_1, beta_2)  # result should be almost zero
         self.assertGreater(result, 0.)
         self.assertTrue(np.allclose(result, 0.))
+
+    def test_calc_prob_symmetries(self):
+        """
+        This test checks that moving the smallest parameter in the last position (symmetries of the article)
+        gives the same result of the plain recurrence over the last parameter
+        """
+        for a, b, c, d in [(3, 7, 5, 2), (101, 9901, 121, 9881), (40, 1000, 80, 300), (7, 3, 2, 5)]:
+            expected = g0(a, b, c) + sum(hiter(a, b, c, d))
+            result = calc_prob_between(beta(a, b), beta(c, d))
+            self.assertTrue(np.allclose(result, expected, rtol=1e-9, atol=1e-12))
+
+    def test_calc_prob_large(self):
+        """
+        This test checks a comparison with one million impressions against the numerical integration
+        """
+        beta_1 = beta(301, 1e6 - 299)
+        beta_2 = beta(281, 1e6 - 279)
+        result = calc_prob_between(beta_1, beta_2)
+        expected = quad(lambda x: beta_1.pdf(x) * beta_2.cdf(x), 0, 1e-3, points=[3e-4], limit=200)[0]
+        self.assertTrue(np.allclose(result, expected, atol=1e-8))
+
+    def test_calc_prob_approx(self):
+        """
+        This test checks that the normal approximation falls within its error bound from the exact result
+        """
+        for a, b, c, d in [(1e5, 1e5, 1e5 + 300, 1e5), (2e5, 1e8, 2e5 + 800, 1e8), (1e3, 1e5, 1.05e3, 1e5)]:
+            exact = calc_prob_between(beta(a, b), beta(c, d), method='exact')
+            approx, err = calc_prob_between(beta(a, b), beta(c, d), method='normal', return_error=True)
+            self.assertGreater(err, 0.)
+            self.assertLessEqual(abs(exact - approx), err)
+
+    def test_calc_prob_approx_sweep(self):
+        """
+        This test checks the error estimate of the normal approximation just above the threshold, where it is
+        largest: rare conversions (skewed distributions), groups of different size and means close to each other.
+        The reference is the integral on a fine grid, since with such parameters the exact series loses precision.
+        """
+        def log_density(x, a, b):
+            # the log of the Beta density, up to a constant, taken from the mode for keeping the precision
+            mode = (a - 1) / (a + b - 2)
+            return (a - 1) * np.log(x / mode) + (b - 1) * np.log1p((mode - x) / (1 - mode))
+
+        def integrate(a, b, c, d, n_points=200001):
+            mean = np.array([a / (a + b), c / (c + d)])
+            std = np.sqrt(np.array([a * b / (a + b + 1), c * d / (c + d + 1)])) / np.array([a + b, c + d])
+            x = np.linspace(max((mean - 15 * std).min(), 0.), (mean + 15 * std).max(), n_points)[1:]
+            pdf_1, pdf_2 = np.exp(log_density(x, a, b)), np.exp(log_density(x, c, d))
+            cdf_2 = np.concatenate([[0.], np.cumsum((pdf_2[1:] + pdf_2[:-1]) * np.diff(x) / 2)])
+            return np.trapezoid(pdf_1 * cdf_2, x) / np.trapezoid(pdf_1, x) / cdf_2[-1]
+
+        for a in [1e5 + 1, 3e5]:
+            for rate in [0.1, 1e-3, 1e-5]:
+                b = np.floor(a / rate) - a
+                for size in [1, 3, 10]:
+                    for shift in [0, 1, 3]:
+                        c = np.floor(a * size + shift * np.sqrt(a * size))
+                        d = b * size - (c - a * size)
+                        prob, err = calc_prob_between(beta(c, d), beta(a, b), return_error=True)
+                        self.assertGreater(err, 0.)
+                        self.assertLessEqual(abs(prob - integrate(c, d, a, b)), err)
+
+    def test_calc_prob_auto(self):
+        """
+        This test checks that the 'auto' method uses the approximation only for large parameters
+        """
+        _, err = calc_prob_between(beta(40, 1000), beta(80, 300), return_error=True)
+        self.assertEqual(err, 0.)
+        _, err = calc_prob_between(beta(2e5, 1e8), beta(2e5, 1e8), return_error=True)
+        self.assertGreater(err, 0.)
+        self.assertLess(err, 1e-5)
+
+    def test_calc_prob_integers(self):
+        """
+        This test checks that large integer parameters (as the counts give them) do not overflow in the approximation
+        """
+        a, b, c, d = 10 ** 5 + 1, 10 ** 7 - 10 ** 5 + 1, 10 ** 5 + 317, 10 ** 7 - 10 ** 5 - 315
+        prob, err = calc_prob_between(beta(a, b), beta(c, d), method='normal', return_error=True)
+        # the exact result is 0.23897592
+        self.assertAlmostEqual(prob, 0.23897592, places=6)
+        self.assertLess(err, 1e-5)
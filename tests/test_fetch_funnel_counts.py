@@ -0,0 +1,101 @@
+from unittest import TestCase
+import datetime
+import json
+import os
+import sys
+import tempfile
+from mixbaba.counts_utils import MonthlyStore, parse_funnel_response
+from mixbaba.mixbaba_utils import create_funnel_query, fetch_funnel_counts
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from fake_mixpanel import FakeMixpanel  # noqa: E402
+
+
+class MonthlyAPI(object):
+    """
+    A stand-in for the Mixpanel connector, which answers the funnel queries as the local stand-in of Mixpanel does
+    (the users are counted once in each bucket), without serving them
+    """
+
+    def __init__(self, fake, monthly_store=None):
+        self.fake = fake
+        self.monthly_store = monthly_store
+        self.ranges = []
+
+    def fetch(self, methods, params, http_method='GET', frmt='json'):
+        self.ranges.append((params['from_date'], params['to_date']))
+        return json.dumps(self.fake.funnel(params)).encode()
+
+
+class TestFetch_funnel_counts(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.fake = FakeMixpanel(n_cohorts=2)
+        self.api = MonthlyAPI(self.fake, MonthlyStore(os.path.join(self.folder.name, 'monthly.sqlite')))
+
+    def tearDown(self):
+        self.api.monthly_store.close()
+        self.fake.server_close()
+        self.folder.cleanup()
+
+    @staticmethod
+    def query(from_date, to_date):
+        return create_funnel_query(funnel_id=1, from_date=from_date, to_date=to_date,
+                                   filters={'user.d0': 'c1'}, by='properties.assignment')
+
+    def fetch(self, from_date, to_date, today):
+        """
+        This function return the counts fetched incrementally, after checking that they are those of a full fetch
+        """
+        counts = fetch_funnel_counts(self.api, self.query(from_date, to_date),
+                                     today=datetime.date.fromisoformat(today)).to_dict()
+        full = fetch_funnel_counts(MonthlyAPI(self.fake), self.query(from_date, to_date)).to_dict()
+        self.assertEqual(counts, full)
+        return counts
+
+    def test_incremental(self):
+        """
+        Checks that only the months not complete, or not stored, are asked again, and that the counts are those of
+        the whole range asked at once
+        """
+        self.fetch('2019-01-15', '2019-03-10', today='2019-03-10')
+        # January (from the 15th) and February are complete
+        self.fetch('2019-01-15', '2019-04-20', today='2019-04-20')
+        self.assertEqual(self.api.ranges, [('2019-01-15', '2019-03-10'), ('2019-03-01', '2019-04-20')])
+
+        # a range ending before the stored months asks again only its last month
+        self.fetch('2019-01-15', '2019-02-10', today='2019-04-20')
+        self.assertEqual(self.api.ranges[2:], [('2019-02-01', '2019-02-10')])
+        # and the months stored are still used
+        self.fetch('2019-01-15', '2019-03-31', today='2019-04-20')
+        self.assertEqual(len(self.api.ranges), 3)
+
+    def test_range_end(self):
+        """
+        Checks that the last bucket of a range ending within a month is stored when it is complete, but used only for a
+        range ending on the same day
+        """
+        self.fetch('2019-01-15', '2019-02-10', today='2019-04-20')
+        self.fetch('2019-01-15', '2019-02-10', today='2019-04-20')
+        self.fetch('2019-01-15', '2019-03-10', today='2019-04-20')
+        self.assertEqual(self.api.ranges, [('2019-01-15', '2019-02-10'), ('2019-02-01', '2019-03-10')])
+
+    def test_other_start(self):
+        """
+        Checks that the stored months are asked again if the range starts on another day, since the first month would
+        have other days
+        """
+        self.fetch('2019-01-05', '2019-03-10', today='2019-04-01')
+        self.fetch('2019-01-01', '2019-03-10', today='2019-04-01')
+        self.assertEqual(self.api.ranges, [('2019-01-05', '2019-03-10'), ('2019-01-01', '2019-03-10')])
+
+    def test_unique_users(self):
+        """
+        Checks that the sum of the days of a month counts more users than the month, which is why the days are not
+        stored
+        """
+        month = parse_funnel_response(self.api.fetch(["funnels"], self.query('2019-01-01', '2019-01-31')))
+        days = parse_funnel_response(self.api.fetch(["funnels"], dict(self.query('2019-01-01', '2019-01-31'),
+                                                                      unit='day')))
+        self.assertLess(month.count('control', 'Impression'), days.count('control', 'Impression'))
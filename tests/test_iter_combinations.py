@@ -0,0 +1,69 @@
+from unittest import TestCase
+from collections import OrderedDict
+from mixbaba.mixbaba_utils import iter_combinations, get_combinations, is_above_floor
+import numpy as np
+
+
+class TestIter_combinations(TestCase):
+    filters = OrderedDict([('user.goal', ['PREVENT', 'PLAN']), ('user.$country_code', ['US', 'UK', 'SE']),
+                           ('properties.time', ['10:00', '22:00'])])
+
+    def test_get_combinations(self):
+        """
+        Checks that all the full combinations are there, also with values containing ':'
+        """
+        combinations = get_combinations(self.filters)
+        self.assertEqual(len(combinations), 12)
+        self.assertEqual(combinations[0], {'user.goal': 'PREVENT', 'user.$country_code': 'US',
+                                           'properties.time': '10:00'})
+        self.assertEqual(len({tuple(c.values()) for c in combinations}), 12)
+
+    def test_get_combinations_order(self):
+        """
+        Checks that the combinations come in the order they had when built with np.meshgrid, with three and four
+        discriminants, so that the crossed rows of the output are not reordered
+        """
+        filters = OrderedDict(self.filters, **{'user.plan': ['free', 'pro']})
+        for n in [2, 3, 4]:
+            some = OrderedDict(list(filters.items())[:n])
+            grid = np.array(np.meshgrid(*some.values())).T.reshape(-1, n)
+            expected = [dict(zip(some.keys(), values)) for values in grid.tolist()]
+            self.assertEqual(get_combinations(some), expected)
+            self.assertEqual([dict(c) for c in iter_combinations(some, min_depth=n)], expected)
+
+    def test_coarse_to_fine(self):
+        depths = [len(combination) for combination in iter_combinations(self.filters)]
+        self.assertEqual(depths, [2] * (6 + 4 + 6) + [3] * 12)
+
+    def test_pruning(self):
+        """
+        Checks that the combinations containing a cohort, or a combination, without enough data are skipped,
+        and that the results given while walking are used
+        """
+        too_small = [{'user.$country_code': 'SE'}]
+
+        def is_viable(combination):
+            return dict(combination) not in too_small
+
+        walked = []
+        for combination in iter_combinations(self.filters, is_viable=is_viable):
+            walked.append(dict(combination))
+            if combination == {'user.goal': 'PLAN', 'properties.time': '22:00'}:
+                too_small.append(walked[-1])
+
+        self.assertFalse(any(c.get('user.$country_code') == 'SE' for c in walked))
+        self.assertEqual(len([c for c in walked if len(c) == 2]), 4 + 4 + 4)
+        full = [c for c in walked if len(c) == 3]
+        # PREVENT/PLAN x US/UK x 10:00/22:00, without PLAN+22:00
+        self.assertEqual(len(full), 6)
+        self.assertNotIn({'user.goal': 'PLAN', 'user.$country_code': 'US', 'properties.time': '22:00'}, full)
+
+    def test_is_above_floor(self):
+        result = OrderedDict([('Discriminant', 'user.goal'), ('Cohort', 'PLAN'), ('Comment', ' '),
+                              ('Control Impressions', 1000), ('Control Conversions', 20),
+                              ('test Impressions', 900), ('test Conversions', 9), ('test Probability', 0.1)])
+        self.assertTrue(is_above_floor(result))
+        self.assertTrue(is_above_floor(result, min_impressions=900, min_conversions=9))
+        self.assertFalse(is_above_floor(result, min_conversions=10))
+        result['test Impressions'] = float('nan')
+        self.assertFalse(is_above_floor(result))
@@ -0,0 +1,50 @@
+from unittest import TestCase
+import os
+import tempfile
+from mixbaba.cache_utils import LRUCache, integer_key, save_caches, load_caches
+from mixbaba.mixbaba_utils import make_ab_analysis, analysis_cache
+import numpy as np
+
+
+class TestLRUCache(TestCase):
+
+    def test_lru_cache(self):
+        """
+        Checks that the oldest entries are forgotten and that hits and misses are counted
+        """
+        cache = LRUCache(maxsize=2)
+        cache.put((1, 2), (0.1,))
+        cache.put((3, 4), (0.2,))
+        self.assertEqual(cache.get((1, 2)), (0.1,))
+        cache.put((5, 6), (0.3,))
+        self.assertIsNone(cache.get((3, 4)))
+        self.assertEqual(cache.get((5, 6)), (0.3,))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'size': 2, 'maxsize': 2})
+
+    def test_integer_key(self):
+        self.assertEqual(integer_key(10, 2.0, np.int64(3)), (10, 2, 3))
+        self.assertIsNone(integer_key(10, np.nan))
+        self.assertIsNone(integer_key(10, 2.5))
+
+    def test_save_load(self):
+        """
+        Checks that the caches are saved on disk and loaded back
+        """
+        cache = LRUCache()
+        cache.put((1, 2, 'auto'), (0.1, 0.2))
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'cache.json')
+            save_caches({'test': cache}, filename)
+            loaded = LRUCache()
+            load_caches({'test': loaded, 'other': LRUCache()}, filename)
+        self.assertEqual(loaded.get((1, 2, 'auto')), (0.1, 0.2))
+
+    def test_make_ab_analysis_cached(self):
+        """
+        Checks that a repeated analysis is taken from the cache
+        """
+        analysis_cache.clear()
+        result = make_ab_analysis(10000, 100, 10000, 120)
+        self.assertEqual(analysis_cache.stats()['misses'], 1)
+        self.assertEqual(make_ab_analysis(10000, 100, 10000, 120), result)
+        self.assertEqual(analysis_cache.stats()['hits'], 1)
@@ -19,3 +19,14 @@ class TestMake_ab_analysis(TestCase):
         uplift2, prob2 = make_ab_analysis(self.imps_1, self.convs_1, self.imps_1, self.convs_1)
         self.assertAlmostEqual(uplift2, 0.0)
         self.assertAlmostEqual(prob2, 0.5)
+
+    def test_make_ab_analysis_error(self):
+        """
+        Checks that the exact calculation is used (zero error) for ordinary numbers, and the approximation for huge ones
+        """
+        _, prob, err = make_ab_analysis(self.imps_1, self.convs_1, self.imps_2, self.convs_2, return_error=True)
+        self.assertAlmostEqual(prob, 0.91201253)
+        self.assertEqual(err, 0.)
+        _, prob, err = make_ab_analysis(10 ** 8, 5 * 10 ** 6, 10 ** 8, 5 * 10 ** 6 + 3000, return_error=True)
+        self.assertAlmostEqual(prob, 0.83477060, places=6)
+        self.assertGreater(err, 0.)
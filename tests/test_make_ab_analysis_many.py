@@ -0,0 +1,29 @@
+from unittest import TestCase
+from mixbaba.mixbaba_utils import make_ab_analysis, make_ab_analysis_many
+import numpy as np
+
+
+class TestMake_ab_analysis_many(TestCase):
+    imps_1 = [10000, 10000, 6175, 1561, 1e6]
+    convs_1 = [100, 100, 25, 5, 300]
+    imps_2 = [10000, 10000, 6016, 1411, 1e6]
+    convs_2 = [120, 100, 37, 5, 280]
+
+    def test_make_ab_analysis_many(self):
+        """
+        Checks that the vectorized analysis gives the same results of the analysis made one cohort at a time
+        """
+        lifts, probs = make_ab_analysis_many(self.imps_1, self.convs_1, self.imps_2, self.convs_2)
+        self.assertEqual(lifts.shape, (5,))
+        for i, args in enumerate(zip(self.imps_1, self.convs_1, self.imps_2, self.convs_2)):
+            lift, prob = make_ab_analysis(*args)
+            self.assertAlmostEqual(lifts[i], lift)
+            self.assertAlmostEqual(probs[i], prob)
+
+    def test_make_ab_analysis_many_nan(self):
+        """
+        Checks that missing numbers give `nan` only on their own cohort
+        """
+        lifts, probs = make_ab_analysis_many([np.nan, 10000], [np.nan, 100], [10000, 10000], [120, 120])
+        self.assertTrue(np.isnan(probs[0]))
+        self.assertAlmostEqual(probs[1], 0.91201253)
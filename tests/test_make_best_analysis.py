@@ -0,0 +1,52 @@
+from unittest import TestCase
+from mixbaba.mixbaba_utils import make_ab_analysis, make_best_analysis, make_best_analysis_many
+import numpy as np
+
+
+class TestMake_best_analysis(TestCase):
+
+    def test_make_best_analysis_two(self):
+        """
+        Checks that with only two groups the probability to be best is the one of the A/B analysis
+        """
+        _, prob = make_ab_analysis(10000, 100, 10000, 120)
+        probs = make_best_analysis([10000, 10000], [100, 120])
+        self.assertAlmostEqual(probs[1], prob)
+        self.assertAlmostEqual(probs.sum(), 1.)
+
+    def test_make_best_analysis_many(self):
+        """
+        Checks the results for several groups against a Monte Carlo simulation
+        """
+        imps = [10000, 10000, 10000, 10000, 10000, 10000]
+        convs = [100, 105, 110, 90, 120, 100]
+        probs = make_best_analysis(imps, convs)
+
+        rng = np.random.RandomState(42)
+        samples = rng.beta(np.array(convs)[:, None] + 1, np.array(imps)[:, None] - np.array(convs)[:, None] + 1,
+                           size=(len(imps), 200000))
+        expected = np.bincount(samples.argmax(axis=0), minlength=len(imps)) / samples.shape[1]
+        self.assertTrue(np.allclose(probs, expected, atol=5e-3))
+
+    def test_make_best_analysis_nan(self):
+        """
+        Checks that a group with missing numbers is excluded
+        """
+        probs = make_best_analysis([10000, np.nan, 10000], [100, np.nan, 120])
+        self.assertTrue(np.isnan(probs[1]))
+        self.assertAlmostEqual(probs[0] + probs[2], 1.)
+
+    def test_make_best_analysis_many(self):
+        """
+        Checks that the probabilities of many cohorts at once are those of each cohort, also with missing numbers and
+        with large numbers (whose ranges are not the exact quantiles)
+        """
+        imps = np.array([[10000, 10000, 10000], [500, np.nan, 480], [np.nan, np.nan, np.nan],
+                         [10 ** 7, 10 ** 7, np.nan]])
+        convs = np.array([[100, 105, 120], [3, np.nan, 0], [np.nan, np.nan, np.nan], [10 ** 5, 10 ** 5 + 300, np.nan]])
+        probs = make_best_analysis_many(imps, convs)
+        for row, (imp, conv) in enumerate(zip(imps, convs)):
+            np.testing.assert_allclose(probs[row], make_best_analysis(imp, conv), atol=1e-12)
+        self.assertTrue(np.isnan(probs[2]).all())
+        _, prob = make_ab_analysis(10 ** 7, 10 ** 5, 10 ** 7, 10 ** 5 + 300, method='exact')
+        self.assertAlmostEqual(probs[3, 1], prob)
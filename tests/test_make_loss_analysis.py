@@ -0,0 +1,46 @@
+from unittest import TestCase
+from mixbaba.mixbaba_utils import make_loss_analysis
+from mixbaba.beta_utils import calc_expected_loss_many
+import numpy as np
+
+
+class TestMake_loss_analysis(TestCase):
+
+    def test_make_loss_analysis(self):
+        """
+        Checks the expected loss against a Monte Carlo simulation
+        """
+        rng = np.random.RandomState(42)
+        for imps_1, convs_1, imps_2, convs_2 in [(10000, 100, 10000, 120), (1561, 5, 1411, 5), (500, 40, 600, 30)]:
+            loss = make_loss_analysis(imps_1, convs_1, imps_2, convs_2)
+            control = rng.beta(convs_1 + 1, imps_1 - convs_1 + 1, size=1000000)
+            test = rng.beta(convs_2 + 1, imps_2 - convs_2 + 1, size=1000000)
+            expected = np.maximum(control - test, 0).mean()
+            self.assertTrue(np.allclose(loss, expected, rtol=1e-2))
+
+    def test_make_loss_analysis_approx(self):
+        """
+        Checks that the normal approximation agrees with the exact calculation
+        """
+        exact = make_loss_analysis(10 ** 6, 2 * 10 ** 5, 10 ** 6, 2 * 10 ** 5 + 500, method='exact')
+        approx = make_loss_analysis(10 ** 6, 2 * 10 ** 5, 10 ** 6, 2 * 10 ** 5 + 500, method='normal')
+        self.assertTrue(np.allclose(exact, approx, rtol=1e-3))
+
+    def test_make_loss_analysis_integers(self):
+        """
+        Checks that the normal approximation is right also with large integer counts, which must not overflow
+        """
+        imps_1, convs_1, imps_2, convs_2 = 10 ** 7, 5 * 10 ** 5, 10 ** 7, 5 * 10 ** 5 + 1000
+        approx = make_loss_analysis(imps_1, convs_1, imps_2, convs_2, method='normal')
+        # the exact result is 7.738273e-06
+        self.assertTrue(np.allclose(approx, 7.738273e-06, rtol=1e-3))
+
+    def test_calc_expected_loss_many(self):
+        """
+        Checks that the vectorized calculation gives the same results of the one made one cohort at a time
+        """
+        imps_1, convs_1, imps_2, convs_2 = [10000, 1561], [100, 5], [10000, 1411], [120, 5]
+        losses = calc_expected_loss_many(np.add(convs_1, 1), np.subtract(imps_1, convs_1) + 1,
+                                         np.add(convs_2, 1), np.subtract(imps_2, convs_2) + 1)
+        for i in range(2):
+            self.assertAlmostEqual(losses[i], make_loss_analysis(imps_1[i], convs_1[i], imps_2[i], convs_2[i]))
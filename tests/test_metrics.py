@@ -0,0 +1,65 @@
+from unittest import TestCase
+import json
+import os
+import tempfile
+from mixbaba.metrics import Metrics, timed
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.registry = Metrics()
+
+        @timed('work', registry=self.registry)
+        def work(x):
+            return x * 2
+
+        self.work = work
+
+    def test_disabled(self):
+        """
+        Checks that nothing is recorded while the metrics are disabled
+        """
+        self.assertEqual(self.work(3), 6)
+        self.registry.set('bytes', 10)
+        self.assertEqual(self.registry.to_dict(), {'timers': {}, 'gauges': {}})
+
+    def test_enabled(self):
+        """
+        Checks the histograms of the timed functions, also when they raise, and the gauges with labels
+        """
+        self.registry.enabled = True
+        for x in range(5):
+            self.work(x)
+        with self.assertRaises(TypeError):
+            self.work(None)
+        self.registry.set('stage_seconds', 1.5, stage='plan')
+        self.registry.set_many('api', {'requests': 3, 'name': 'x', 'ok': True})
+
+        metrics = self.registry.to_dict()
+        timer = metrics['timers']['work']
+        self.assertEqual(timer['count'], 6)
+        self.assertEqual(timer['buckets']['+Inf'], 6)
+        # the buckets are cumulative
+        counts = list(timer['buckets'].values())
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(metrics['gauges'], {'stage_seconds{stage="plan"}': 1.5, 'api_requests': 3})
+
+    def test_formats(self):
+        """
+        Checks the JSON and the Prometheus outputs
+        """
+        self.registry.enabled = True
+        self.work(1)
+        self.registry.set('stage_seconds', 2., stage='output')
+        with tempfile.TemporaryDirectory() as folder:
+            self.registry.save(os.path.join(folder, 'metrics.json'))
+            with open(os.path.join(folder, 'metrics.json')) as file:
+                self.assertEqual(json.load(file)['timers']['work']['count'], 1)
+        text = self.registry.to_prometheus()
+        self.assertIn('# TYPE mixbaba_work_seconds histogram', text)
+        self.assertIn('mixbaba_work_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('mixbaba_work_seconds_count 1', text)
+        self.assertIn('mixbaba_stage_seconds{stage="output"} 2.0', text)
+        with self.assertRaises(ValueError):
+            self.registry.save('metrics.txt', frmt='xml')
@@ -0,0 +1,149 @@
+from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import http.client
+import json
+import threading
+import time
+import urllib.error
+import zlib
+from mixbaba.cache_utils import QueryMemo, query_key
+from mixbaba.mixbaba_utils import MixpanelAPI
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if 'missing' in self.path:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if 'slow' in self.path:
+            # the client gives up before the response
+            time.sleep(0.5)
+            self.close_connection = True
+            return
+        body = json.dumps({'path': self.path, 'auth': self.headers['Authorization']}).encode()
+        if 'deflate' in self.path:
+            # the raw deflate stream, without the zlib header
+            compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'deflate')
+        elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMixpanelAPI(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.connections = 0
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api = MixpanelAPI('secret', endpoint=f'http://127.0.0.1:{self.server.server_address[1]}/api')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """
+        Checks that the connection is reused, that the responses are compressed and that the stats are recorded
+        """
+        for i in range(5):
+            answer = self.api.request(['funnels'], {'funnel_id': i, 'where': 'a and b'})
+            self.assertTrue(answer['path'].startswith(f'/api/2.0/funnels/?funnel_id={i}&where=a+and+b'))
+            self.assertEqual(answer['auth'], 'Basic c2VjcmV0')
+        self.assertEqual(self.server.connections, 1)
+        stats = self.api.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['connections'], 1)
+        self.assertLess(stats['bytes_received'], stats['bytes_decoded'] + 5 * 20)
+        self.assertGreater(stats['latency_total'], 0.)
+
+    def test_http_error(self):
+        """
+        Checks that an error status raises the same exception of urllib
+        """
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.api.request(['missing'], {})
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(context.exception.url,
+                         f'http://127.0.0.1:{self.server.server_address[1]}/api/2.0/missing/?format=json')
+        # the connection is still usable
+        self.api.request(['funnels'], {})
+        self.assertEqual(self.server.connections, 1)
+
+    def test_memo(self):
+        """
+        Checks that a query planned twice is sent only once
+        """
+        self.api.memo = QueryMemo({query_key(['funnels'], {'funnel_id': 1, 'format': 'json'}): 2})
+        first = self.api.request(['funnels'], {'funnel_id': 1})
+        second = self.api.request(['funnels'], {'funnel_id': 1})
+        self.api.request(['funnels'], {'funnel_id': 1})
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_raw_deflate(self):
+        """
+        Checks that a body compressed with deflate is decoded also without the zlib header
+        """
+        answer = self.api.request(['deflate'], {})
+        self.assertEqual(answer['path'], '/api/2.0/deflate/?format=json')
+
+    def test_timeout(self):
+        """
+        Checks that a connection which timed out is closed and not put back in the pool
+        """
+        closed = []
+
+        class Connection(http.client.HTTPConnection):
+            def close(self):
+                closed.append(self)
+                super().close()
+
+        self.api.connection_class = Connection
+        self.api.timeout = 0.2
+        self.api.request(['funnels'], {})
+        with self.assertRaises(OSError):
+            # on the connection reused from the pool
+            self.api.send('GET', '/api/2.0/slow/', None, self.api.headers)
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(self.api.pool.qsize(), 0)
+
+    def test_close(self):
+        """
+        Checks that closing the connector closes the idle connections of the pool
+        """
+        closed = []
+
+        class Connection(http.client.HTTPConnection):
+            def close(self):
+                closed.append(self)
+                super().close()
+
+        self.api.connection_class = Connection
+        self.api.request(['funnels'], {})
+        self.api.close()
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(self.api.pool.qsize(), 0)
@@ -0,0 +1,106 @@
+from unittest import TestCase
+import datetime
+import gzip
+import json
+import os
+import tempfile
+from mixbaba.export_utils import OfflineAPI
+from mixbaba.mixbaba_utils import get_mixpanel_data, get_mixpanel_data_segmented, get_funnels_list
+
+
+def at(day, hour=12):
+    return datetime.datetime(2019, 1, 1, hour, tzinfo=datetime.timezone.utc).timestamp() + (day - 1) * 86400
+
+
+def event(name, user, day, **props):
+    return {'event': name, 'properties': dict(props, distinct_id=user, time=at(day))}
+
+
+class TestOfflineAPI(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        # u4 converts out of the window, u5 before the impression, u6 starts after the range,
+        # u7 sees the impression twice and its events are in both files
+        files = [
+            [event('Imp', 'u1', 2, assignment='control'), event('Pay', 'u1', 3),
+             event('Imp', 'u2', 5, assignment='control'), event('Other', 'u2', 6),
+             event('Imp', 'u3', 4, assignment='test'), event('Pay', 'u3', 20),
+             event('Imp', 'u7', 8, assignment='control')],
+            [event('Imp', 'u4', 6, assignment='test'), event('Pay', 'u4', 60),
+             event('Pay', 'u5', 1), event('Imp', 'u5', 7, assignment='test'),
+             event('Imp', 'u6', 41, assignment='test'), event('Pay', 'u6', 42),
+             event('Pay', 'u7', 10), event('Imp', 'u7', 9, assignment='control')]]
+        self.files = []
+        for i, events in enumerate(files):
+            path = os.path.join(self.folder.name, f'export-{i}.jsonl.gz')
+            with gzip.open(path, 'wt') as file:
+                file.write('\n'.join(map(json.dumps, events)) + '\n')
+            self.files.append(path)
+        self.people = os.path.join(self.folder.name, 'people.jsonl')
+        with open(self.people, 'w') as file:
+            for user, goal in [('u1', 'PLAN'), ('u2', 'PREVENT'), ('u3', 'PLAN'), ('u4', 'PLAN')]:
+                file.write(json.dumps({'$distinct_id': user, '$properties': {'goal': goal}}) + '\n')
+        self.funnels = [{'ID': 1, 'Name': 'AB1', 'From Date': '2019-01-01', 'To Date': '2019-01-31',
+                         'Impression field name': 'Imp', 'Conversion field name': 'Pay',
+                         'By': 'properties.assignment'}]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def get_data(self, api, filters):
+        return get_mixpanel_data(api=api, funnel_id=1, from_date='2019-01-01', to_date='2019-01-31',
+                                 filters=filters, by='properties.assignment')
+
+    def test_funnel(self):
+        """
+        Checks the counts of the users at each step, with and without filters, and the list of the funnels
+        """
+        api = OfflineAPI(self.files, self.funnels, people=self.people, processes=1, n_partitions=3)
+        try:
+            self.assertEqual(get_funnels_list(api).loc[1]['name'], 'AB1')
+
+            data = self.get_data(api, {'None': 'All'})
+            self.assertEqual((data['control']['Imp']['count'], data['control']['Pay']['count']), (3, 2))
+            self.assertEqual((data['test']['Imp']['count'], data['test']['Pay']['count']), (3, 1))
+
+            data = self.get_data(api, {'user.goal': 'PLAN'})
+            self.assertEqual((data['control']['Imp']['count'], data['control']['Pay']['count']), (1, 1))
+            self.assertEqual((data['test']['Imp']['count'], data['test']['Pay']['count']), (2, 1))
+
+            segmented = get_mixpanel_data_segmented(api=api, funnel_id=1, from_date='2019-01-01',
+                                                    to_date='2019-01-31', discriminants=['user.goal'],
+                                                    by='properties.assignment')
+            for group in ['control', 'test']:
+                self.assertEqual(segmented[('PLAN',)][group], data[group])
+            self.assertEqual(segmented[('PREVENT',)]['control']['Pay']['count'], 0)
+            # the export is read once for all the queries of the funnel
+            self.assertEqual(api.stats()['funnels_read'], 1)
+            self.assertEqual(api.stats()['queries'], 3)
+        finally:
+            api.close()
+        self.assertFalse(os.path.exists(api.folder))
+
+    def test_processes(self):
+        """
+        Checks that the files and the partitions read by a pool of processes give the same counts
+        """
+        api = OfflineAPI(self.files, self.funnels, people=self.people, processes=1, n_partitions=3)
+        pool_api = OfflineAPI(self.files, self.funnels, people=self.people, processes=2, n_partitions=3)
+        try:
+            for filters in [{'None': 'All'}, {'user.goal': 'PLAN'}]:
+                self.assertEqual(self.get_data(pool_api, filters), self.get_data(api, filters))
+        finally:
+            api.close()
+            pool_api.close()
+
+    def test_unsupported(self):
+        """
+        Checks that the queries which cannot be answered from the export raise an error
+        """
+        api = OfflineAPI(self.files, self.funnels, processes=1)
+        try:
+            with self.assertRaises(ValueError):
+                api.request(['events'], {})
+        finally:
+            api.close()
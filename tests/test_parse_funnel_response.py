@@ -0,0 +1,63 @@
+from unittest import TestCase, skipIf
+import io
+import json
+import os
+import numpy as np
+from mixbaba.mixbaba_utils import aggregate_mix_data
+from mixbaba.counts_utils import FunnelCounts, iter_funnel_dates, parse_funnel_response, ijson
+
+
+class TestParse_funnel_response(TestCase):
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_resp.json"), 'rb') as f:
+            self.body = f.read()
+        self.expected = aggregate_mix_data(json.loads(self.body)['data'])
+
+    def test_parse_funnel_response(self):
+        """
+        Checks that the counts are the same reading the response at once, incrementally and from a file
+        """
+        self.assertEqual(parse_funnel_response(self.body).to_dict(), self.expected)
+        self.assertEqual(parse_funnel_response(self.body, stream_threshold=0).to_dict(), self.expected)
+        self.assertEqual(parse_funnel_response(io.BytesIO(self.body)).to_dict(), self.expected)
+
+    @skipIf(ijson is None, "ijson is not installed")
+    def test_iter_funnel_dates(self):
+        """
+        Checks that the dates read incrementally, from the bytes and from a file, are those of the whole response
+        """
+        expected = list(json.loads(self.body)['data'].items())
+        self.assertEqual(list(iter_funnel_dates(self.body, stream_threshold=0)), expected)
+        self.assertEqual(list(iter_funnel_dates(io.BytesIO(self.body))), expected)
+        self.assertEqual(list(iter_funnel_dates(self.body, stream_threshold=len(self.body))), expected)
+
+    def test_counts(self):
+        """
+        Checks the matrix of the counts, also when the groups and the steps change from a date to another
+        and the buffers are flushed several times
+        """
+        counts = FunnelCounts(flush_size=4)
+        counts.add_date({'control': [{'step_label': 'Imp', 'count': 10}, {'step_label': 'Pay', 'count': 1}]})
+        counts.add_date({})
+        counts.add_date({'test': [{'step_label': 'Imp', 'count': 7}],
+                         'control': [{'step_label': 'Imp', 'count': 5}, {'step_label': 'Pay', 'count': 2}]})
+        counts.add_date({'test': [{'step_label': 'Other', 'count': 3}, {'step_label': 'Pay', 'count': 1}]})
+        counts.flush()
+        np.testing.assert_array_equal(counts.counts, [[15, 3, 0], [7, 1, 3]])
+        self.assertEqual(counts.count('control', 'Pay'), 3)
+        self.assertTrue(np.isnan(counts.count('control', 'Other')))
+        self.assertTrue(np.isnan(counts.count('test2', 'Pay')))
+        self.assertEqual(list(counts.to_dict()['control'].keys()), ['Imp', 'Pay'])
+
+    def test_split(self):
+        counts = FunnelCounts()
+        counts.add_date({'control|US': [{'step_label': 'Imp', 'count': 10}],
+                         'test|US': [{'step_label': 'Imp', 'count': 9}],
+                         'control|UK': [{'step_label': 'Imp', 'count': 4}],
+                         '$overall': [{'step_label': 'Imp', 'count': 23}]})
+        splitted = counts.split('|', 2)
+        self.assertEqual(list(splitted.keys()), [('US',), ('UK',)])
+        self.assertEqual(splitted[('US',)].to_dict(), {'control': {'Imp': {'count': 10}},
+                                                        'test': {'Imp': {'count': 9}}})
+        self.assertEqual(splitted[('UK',)].count('control', 'Imp'), 4)
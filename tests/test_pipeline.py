@@ -0,0 +1,109 @@
+from unittest import TestCase
+import os
+import gzip
+import json
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from fake_mixpanel import FakeMixpanel  # noqa: E402
+from bench_pipeline import write_funnels  # noqa: E402
+
+
+class TestPipeline(TestCase):
+
+    def setUp(self):
+        self.server = FakeMixpanel(n_cohorts=3)
+        self.server.start()
+        self.folder = tempfile.TemporaryDirectory()
+        write_funnels(os.path.join(self.folder.name, 'funnels.json'), n_funnels=2, n_discriminants=2, n_cohorts=3,
+                      days=28)
+
+    def tearDown(self):
+        self.server.stop()
+        self.folder.cleanup()
+
+    def run_tool(self, *options) -> str:
+        command = [sys.executable, os.path.join(ROOT, 'bin', 'mixbaba'), '-f', 'funnels.json', '-k', 'any',
+                   '--endpoint', self.server.endpoint, '-rl', '1e9'] + list(options)
+        out = subprocess.run(command, cwd=self.folder.name, env=dict(os.environ, PYTHONPATH=ROOT),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return out.stdout.decode()
+
+    def test_end_to_end(self):
+        """
+        Checks that the command line tool runs against the local stand-in of Mixpanel, and that a query for each
+        cohort or a query for each discriminant give the same results
+        """
+        out = self.run_tool('-x')
+        self.assertIn('Funnel 2', out)
+        self.assertIn('d0.c2+d1.c1', out)
+        n_requests = self.server.n_requests
+        # the list, and for each funnel the overall analysis, 6 cohorts and 9 combinations
+        self.assertEqual(n_requests, 1 + 2 * (1 + 6 + 9))
+
+        self.assertEqual(self.run_tool('-x', '-c'), out)
+        # the list, and for each funnel the overall analysis, 2 discriminants and 1 combination
+        self.assertEqual(self.server.n_requests - n_requests, 1 + 2 * (1 + 2 + 1))
+
+    def test_dropped_segments(self):
+        """
+        Checks that the cohorts left out of a segmented response (Mixpanel returns only its top values) are asked
+        one by one, so that the results are the same
+        """
+        out = self.run_tool('-x')
+        self.server.max_segments = 4
+        n_requests = self.server.n_requests
+        self.assertEqual(self.run_tool('-x', '-c'), out)
+        self.assertGreater(self.server.n_requests - n_requests, 1 + 2 * (1 + 2 + 1))
+
+    def test_dry_run(self):
+        """
+        Checks that the plan of the run is given without the key of Mixpanel and without any request
+        """
+        command = [sys.executable, os.path.join(ROOT, 'bin', 'mixbaba'), '-f', 'funnels.json', '-x', '--dry-run',
+                   '-i', 'monthly.sqlite']
+        out = subprocess.run(command, cwd=self.folder.name, env=dict(os.environ, PYTHONPATH=ROOT),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode()
+        self.assertIn('queries planned', out)
+        self.assertIn('note: in the incremental mode', out)
+        self.assertEqual(self.server.n_requests, 0)
+
+    def test_incremental(self):
+        """
+        Checks that the incremental mode, where the memo of the queries is off, gives the results of a normal run, and
+        that a second run asks only the list of the funnels
+        """
+        out = self.run_tool('-x', '-i', 'monthly.sqlite')
+        self.assertEqual(out, self.run_tool('-x'))
+        n_requests = self.server.n_requests
+        self.assertEqual(self.run_tool('-x', '-i', 'monthly.sqlite'), out)
+        self.assertEqual(self.server.n_requests - n_requests, 1)
+
+    def test_failure(self):
+        """
+        Checks that the partitions of the export are deleted also when the run stops halfway (here, since the file of
+        the output can not be written)
+        """
+        with gzip.open(os.path.join(self.folder.name, 'export.jsonl.gz'), 'wt') as file:
+            for i in range(20):
+                file.write(json.dumps({'event': 'Imp', 'properties': {
+                    'distinct_id': f'u{i}', 'time': 1546500000, 'assignment': 'control' if i % 2 else 'test'}}) + '\n')
+        with open(os.path.join(self.folder.name, 'funnels.json'), 'w') as file:
+            json.dump([{'ID': 1, 'Name': 'AB1', 'From Date': '2019-01-01', 'To Date': '2019-01-31',
+                        'Impression field name': 'Imp', 'Conversion field name': 'Pay',
+                        'By': 'properties.assignment'}], file)
+        os.mkdir(os.path.join(self.folder.name, '1-AB1.csv'))
+        partitions = os.path.join(self.folder.name, 'tmp')
+        os.mkdir(partitions)
+
+        command = [sys.executable, os.path.join(ROOT, 'bin', 'mixbaba'), '-f', 'funnels.json', '--export',
+                   'export.jsonl.gz', '-o', 'csv']
+        process = subprocess.run(command, cwd=self.folder.name,
+                                 env=dict(os.environ, PYTHONPATH=ROOT, TMPDIR=partitions),
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.assertNotEqual(process.returncode, 0)
+        self.assertIn(b'IsADirectoryError', process.stderr)
+        self.assertEqual(os.listdir(partitions), [])
@@ -0,0 +1,87 @@
+from unittest import TestCase
+import threading
+import time
+from mixbaba.cache_utils import QueryMemo
+from mixbaba.plan_utils import plan_run
+
+
+class TestPlan_run(TestCase):
+    funnel = {"ID": 1, "From Date": "2018-01-28", "To Date": "2018-12-28",
+              "Impression field name": "AB-IMPRESSION", "Conversion field name": "Payment",
+              "By": "properties.assignment",
+              "filters": {"user.goal": ["PREVENT", "PLAN"], "user.$country_code": ["US", "UK", "SE"]}}
+
+    def test_plan_run(self):
+        plan = plan_run([self.funnel])
+        # the list of funnels, the overall analysis and the 5 cohorts
+        self.assertEqual((plan.n_planned, plan.n_unique), (7, 7))
+        plan = plan_run([self.funnel], crossed=True)
+        self.assertEqual((plan.n_planned, plan.n_unique), (13, 13))
+        plan = plan_run([self.funnel], crossed=True, consolidate=True)
+        # the overall analysis, one query for each discriminant and one for the couple
+        self.assertEqual((plan.n_planned, plan.n_unique), (5, 5))
+
+    def test_plan_run_depths(self):
+        """
+        Checks that only the combinations of all the discriminants are planned, unless all the depths are walked
+        """
+        funnel = dict(self.funnel, filters={"user.a": ["1", "2"], "user.b": ["1", "2"], "user.c": ["1", "2"]})
+        plan = plan_run([funnel], crossed=True)
+        # the list of funnels, the overall analysis, the 6 cohorts and the 8 triples
+        self.assertEqual(plan.n_planned, 1 + 1 + 6 + 8)
+        plan = plan_run([funnel], crossed=True, all_depths=True)
+        # and the 12 couples
+        self.assertEqual(plan.n_planned, 1 + 1 + 6 + 12 + 8)
+
+    def test_duplicates(self):
+        """
+        Checks that the same funnel analyzed with other fields, and the breakdowns, are planned only once
+        """
+        other_fields = dict(self.funnel, **{"Conversion field name": "Signup"})
+        with_breakdowns = dict(self.funnel, **{"AB Groups": {"Control": "control", "Test": "test"},
+                                               "Breakdowns": {"user.plan": "", "user.age": ""}})
+        plan = plan_run([self.funnel, other_fields, with_breakdowns])
+        # 6 cohorts, each with 2 groups and 2 breakdowns
+        self.assertEqual(plan.n_planned, 1 + 3 * 6 + 6 * 2 * 2)
+        self.assertEqual(plan.n_unique, 1 + 6 + 6 * 2 * 2)
+        self.assertEqual(plan.summary()[1], (3 * 6 + 6 * 2 * 2, 6 + 6 * 2 * 2))
+
+        plan = plan_run([dict(self.funnel, **{"Breakdowns": {"user.plan": ""}})])
+        self.assertEqual(plan.n_planned, 7)
+        self.assertEqual(len(plan.notes), 1)
+        self.assertIn('total: 7 queries planned, 7 to be made', plan.report())
+
+
+class TestQueryMemo(TestCase):
+
+    def test_query_memo(self):
+        """
+        Checks that a query planned several times is made once, also by concurrent threads, and that its response
+        is forgotten after the last use
+        """
+        memo = QueryMemo({'a': 3, 'b': 1})
+        calls = []
+
+        def make(key):
+            def function():
+                calls.append(key)
+                time.sleep(0.05)
+                return key.encode()
+            return function
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(memo.fetch('a', make('a')))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'a'] * 3)
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(memo.stats(), {'hits': 2, 'kept': 0})
+
+        # once the planned uses are over, or for queries asked once, nothing is kept
+        self.assertEqual(memo.fetch('a', make('a')), b'a')
+        self.assertEqual(memo.fetch('b', make('b')), b'b')
+        self.assertEqual(memo.fetch('c', make('c')), b'c')
+        self.assertEqual(calls, ['a', 'a', 'b', 'c'])
+        self.assertEqual(memo.bodies, {})
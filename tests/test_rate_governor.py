@@ -0,0 +1,93 @@
+from unittest import TestCase
+from email.message import Message
+import datetime
+import urllib.error
+from mixbaba.rate_utils import RateGovernor, parse_retry_after
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def http_error(code, retry_after=None):
+    headers = Message()
+    if retry_after is not None:
+        headers['Retry-After'] = retry_after
+    return urllib.error.HTTPError('http://mixpanel.com/api', code, 'error', headers, None)
+
+
+class TestRateGovernor(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_governor(self, **kwargs):
+        return RateGovernor(clock=self.clock, sleep=self.clock.sleep, rand=lambda: 1., **kwargs)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120.)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        now = datetime.datetime(2019, 1, 15, 10, 0, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(parse_retry_after('Tue, 15 Jan 2019 10:00:30 GMT', now), 30.)
+
+    def test_hourly_limit(self):
+        """
+        Checks that after the burst the requests are spaced to stay within the hourly limit
+        """
+        governor = self.make_governor(per_hour=60)
+        for _ in range(62):
+            governor.call(lambda: None)
+        self.assertEqual(self.clock.sleeps, [60., 60.])
+
+    def test_retry_after(self):
+        """
+        Checks that a throttled request waits as asked by the server, and that errors halve the concurrency
+        """
+        governor = self.make_governor(max_concurrency=4)
+        answers = [http_error(429, '30'), http_error(503), 'ok']
+
+        def request():
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        self.assertEqual(governor.call(request), 'ok')
+        # 1 second of backoff, then the rest of the 30 asked; then 2 seconds of backoff
+        self.assertEqual(self.clock.sleeps, [1., 29., 2.])
+        stats = governor.stats()
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['throttled'], 1)
+        # 4, halved twice, then grown by one after the success
+        self.assertEqual(stats['concurrency'], 2.)
+
+    def test_no_retry(self):
+        """
+        Checks that a request which cannot succeed, or which fails too many times, raises the error
+        """
+        governor = self.make_governor(max_retries=2)
+
+        def missing():
+            raise http_error(404)
+
+        def broken():
+            raise http_error(500)
+
+        with self.assertRaises(urllib.error.HTTPError):
+            governor.call(missing)
+        self.assertEqual(self.clock.sleeps, [])
+        with self.assertRaises(urllib.error.HTTPError):
+            governor.call(broken)
+        self.assertEqual(self.clock.sleeps, [1., 2.])
+        self.assertEqual(governor.in_flight, 0)
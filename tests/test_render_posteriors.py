@@ -0,0 +1,49 @@
+from unittest import TestCase
+import os
+import tempfile
+from mixbaba.beta_utils import render_posteriors, posterior_range
+from mixbaba.output_utils import create_plot_jobs
+
+
+class TestRender_posteriors(TestCase):
+    what = [{'Discriminant': 'None', 'Cohort': 'All', 'Control Impressions': 10000, 'Control Conversions': 100,
+             'test Impressions': 10000, 'test Conversions': 120},
+            {'Discriminant': 'user.goal', 'Cohort': 'PLAN', 'Control Impressions': 1561, 'Control Conversions': 5,
+             'test Impressions': 1411, 'test Conversions': 5}]
+    ab_groups = {'Control': 'control', 'Test': 'test'}
+
+    def test_create_plot_jobs(self):
+        jobs = create_plot_jobs(self.what, 123, self.ab_groups, 'plots', 'svg')
+        self.assertEqual([job[0] for job in jobs], [os.path.join('plots', '123-All.All.svg'),
+                                                    os.path.join('plots', '123-goal.PLAN.svg')])
+        self.assertEqual(jobs[0][1], [(101, 9901), (121, 9881)])
+        self.assertEqual(jobs[0][2], ['Control', 'test'])
+
+    def test_create_plot_jobs_control2(self):
+        """
+        Checks that the second control group is plotted, since its results are under the 'Control2' columns
+        """
+        what = [dict(self.what[0], **{'Control2 Impressions': 9000, 'Control2 Conversions': 95})]
+        jobs = create_plot_jobs(what, 123, {'Control': 'control', 'Control2': 'control_b', 'Test': 'test'}, 'plots')
+        self.assertEqual(jobs[0][1], [(101, 9901), (96, 8906), (121, 9881)])
+        self.assertEqual(jobs[0][2], ['Control', 'Control2', 'test'])
+
+    def test_render_posteriors(self):
+        """
+        Checks that the plots are saved, both in a single process and in parallel
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            jobs = create_plot_jobs(self.what, 123, self.ab_groups, folder, 'png')
+            for processes in (1, 2):
+                saved = render_posteriors(jobs, processes=processes)
+                self.assertEqual(saved, [job[0] for job in jobs])
+                for filename in saved:
+                    self.assertGreater(os.path.getsize(filename), 0)
+                    os.remove(filename)
+
+    def test_posterior_range(self):
+        """
+        Checks that the range contains the bulk of the distributions
+        """
+        linf, lsup = posterior_range([(101, 9901), (121, 9881)])
+        self.assertTrue(0.005 < linf < 0.01 < 0.012 < lsup < 0.02)
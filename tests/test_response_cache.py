@@ -0,0 +1,59 @@
+from unittest import TestCase
+import datetime
+import os
+import tempfile
+import time
+from mixbaba.cache_utils import ResponseCache, response_ttl
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.folder.name, 'cache', 'responses.sqlite')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_response_ttl(self):
+        today = datetime.date(2019, 1, 15)
+        self.assertIsNone(response_ttl({'to_date': '2018-12-28'}, 60, today))
+        self.assertEqual(response_ttl({'to_date': '2019-01-15'}, 60, today), 60)
+        self.assertEqual(response_ttl({'to_date': '2019-01-14'}, 60, today), 60)
+        self.assertEqual(response_ttl({}, 60, today), 60)
+
+    def test_get_put(self):
+        """
+        Checks that responses are found independently on the order of the parameters, that they survive a new
+        connection to the database, and that the short lived ones expire
+        """
+        cache = ResponseCache(self.filename, short_ttl=0.2)
+        cache.put(['funnels'], {'funnel_id': 1, 'to_date': '2018-12-28'}, b'{"old": 1}')
+        cache.put(['funnels/list'], {'format': 'json'}, b'[]')
+        self.assertEqual(cache.get(['funnels'], {'to_date': '2018-12-28', 'funnel_id': 1}), b'{"old": 1}')
+        self.assertIsNone(cache.get(['funnels'], {'funnel_id': 2, 'to_date': '2018-12-28'}))
+        cache.close()
+
+        cache = ResponseCache(self.filename, short_ttl=0.2)
+        self.assertEqual(cache.get(['funnels/list'], {'format': 'json'}), b'[]')
+        time.sleep(0.3)
+        self.assertIsNone(cache.get(['funnels/list'], {'format': 'json'}))
+        self.assertEqual(cache.get(['funnels'], {'funnel_id': 1, 'to_date': '2018-12-28'}), b'{"old": 1}')
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(ResponseCache(self.filename, bypass=True).get(['funnels'], {'funnel_id': 1,
+                                                                                     'to_date': '2018-12-28'}), None)
+
+    def test_eviction(self):
+        """
+        Checks that the least recently used responses are removed when the cache is full
+        """
+        cache = ResponseCache(self.filename, max_bytes=2500)
+        bodies = [os.urandom(1000) for _ in range(3)]
+        cache.put(['funnels'], {'funnel_id': 0, 'to_date': '2018-12-28'}, bodies[0])
+        cache.put(['funnels'], {'funnel_id': 1, 'to_date': '2018-12-28'}, bodies[1])
+        cache.get(['funnels'], {'funnel_id': 0, 'to_date': '2018-12-28'})
+        cache.put(['funnels'], {'funnel_id': 2, 'to_date': '2018-12-28'}, bodies[2])
+        self.assertEqual(cache.get(['funnels'], {'funnel_id': 0, 'to_date': '2018-12-28'}), bodies[0])
+        self.assertIsNone(cache.get(['funnels'], {'funnel_id': 1, 'to_date': '2018-12-28'}))
+        self.assertEqual(cache.get(['funnels'], {'funnel_id': 2, 'to_date': '2018-12-28'}), bodies[2])
+        self.assertEqual(cache.stats()['entries'], 2)
@@ -0,0 +1,66 @@
+from unittest import TestCase
+import gzip
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from mixbaba.output_utils import ResultsTable, create_group, group_labels
+
+
+class TestResults_table(TestCase):
+
+    def test_group_labels(self):
+        """
+        Checks that the names of the cohorts made at once are those made row by row
+        """
+        rows = [{'Discriminant': 'None', 'Cohort': 'All'},
+                {'Discriminant': 'user.goal', 'Cohort': 'PREVENT'},
+                {'Discriminant': 'user.goal+properties.$os', 'Cohort': 'PREVENT+iOS'},
+                {'Discriminant': 'user.a+user.b+user.c', 'Cohort': 'x+y+z'}]
+        df = pd.DataFrame(rows)
+        self.assertEqual(group_labels(df['Discriminant'], df['Cohort']).tolist(), [create_group(row) for row in rows])
+
+    def test_results_table(self):
+        """
+        Checks that the table has a row for each result and test group, in order, with the same columns for all the
+        funnels, and that it is written as gzipped JSON lines
+        """
+        ab_groups = {'Control': 'control', 'Test': 'test', 'Test2': 'test2'}
+        what = [{'Discriminant': 'None', 'Cohort': 'All', 'Comment': ' Result for test is uncertain.',
+                 'Control Impressions': 1000, 'Control Conversions': 50, 'test Impressions': 1000,
+                 'test Conversions': 60, 'test CR improvement': 0.2, 'test Probability': 0.83,
+                 'test Expected loss': 0.001, 'test2 Impressions': 900, 'test2 Conversions': 0},
+                {'Discriminant': 'user.goal', 'Cohort': 'PREVENT', 'Comment': 'The two control options appear different!',
+                 'Control Impressions': 10, 'Control Conversions': 1}]
+        table = ResultsTable('results.jsonl.gz')
+        table.add(what=what, f_id=7, ab_groups=ab_groups, fun_name='First')
+        table.add(what=what[:1], f_id=3, ab_groups={'Control': 'a', 'Test': 'b'}, fun_name='Second')
+        df = table.to_frame()
+
+        self.assertEqual(df[['funnel_id', 'group', 'test_group']].values.tolist(),
+                         [[7, 'All.All', 'test'], [7, 'All.All', 'test2'], [7, 'goal.PREVENT', 'test'],
+                          [7, 'goal.PREVENT', 'test2'], [3, 'All.All', 'b']])
+        self.assertEqual(str(df['control_impressions'].dtype), 'Int64')
+        self.assertEqual(df['test_conversions'].tolist()[:2], [60, 0])
+        # the second funnel has no results for its test group 'b'
+        self.assertEqual(df['test_impressions'].isna().tolist()[2:], [True, True, True])
+        self.assertAlmostEqual(df.loc[0, 'probability'], 0.83)
+        self.assertTrue(np.isnan(df.loc[1, 'cr_improvement']))
+        self.assertLess(df.loc[0, 'cr_improvement_low'], 0.2)
+        self.assertEqual(df.loc[0, 'comment'], 'Result for test is uncertain.')
+
+        with tempfile.TemporaryDirectory() as folder:
+            table.filename = os.path.join(folder, 'results.jsonl.gz')
+            self.assertEqual(table.save(), 5)
+            with gzip.open(table.filename, 'rt') as file:
+                lines = [json.loads(line) for line in file]
+        self.assertEqual(list(lines[0]), df.columns.tolist())
+        self.assertIsNone(lines[2]['test_impressions'])
+
+    def test_table_format(self):
+        """
+        Checks that an unknown extension is refused at once
+        """
+        with self.assertRaises(ValueError):
+            ResultsTable('results.csv')
@@ -0,0 +1,20 @@
+from unittest import TestCase
+import os
+import subprocess
+import sys
+
+
+class TestStartup(TestCase):
+
+    def test_no_heavy_imports(self):
+        """
+        Checks that importing the modules used by the command line tool does not load plotting and tables libraries,
+        which are imported only when they are needed
+        """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        check = "import sys\n" \
+                "import mixbaba.mixbaba_utils, mixbaba.output_utils, mixbaba.inputs\n" \
+                "print(' '.join(m for m in ['matplotlib', 'pandas', 'tabulate', 'scipy.stats'] if m in sys.modules))"
+        out = subprocess.run([sys.executable, '-c', check], env=dict(os.environ, PYTHONPATH=root),
+                             stdout=subprocess.PIPE, check=True)
+        self.assertEqual(out.stdout.decode().split(), [])